@@ -67,7 +67,7 @@ def collect():
         print("Remaining Non-callback Messages:")
         while p_handler.get_running_plugins():
             try:
-                msg = p_handler.next_msg()
+                msg = p_handler.next_msg(timeout=1)
                 m_handler.print_msg(msg)
                 if msg.get_status() == "fin":
                     p_handler.stop_plugin(msg.get_issuer())
@@ -0,0 +1,361 @@
+#!/bin/env python3
+
+"""
+$LICENSE
+
+Benchmark suite of the Multiprocessing Plugin System (MPPS).
+Runs the synthetic plugin benchmarks/plugins/synth and writes the results
+as one JSON document, so results of different releases can be compared.
+
+    python3 benchmarks/bench.py [--quick] [--output FILE] [scenario ...]
+
+Scenarios:
+- throughput: messages/sec and MB/sec from the send of the first message
+  to the read of the last, per transport, message size and batch size
+- serializer: throughput of the serializers of mpps.serializer for small
+  and large binary 'data' messages over the pipe transport
+- latency: p50/p90/p99 of the time from PluginClass._send to the delivery
+  at a fixed message rate, reading with next_msg versus add_callback
+- startup: latency of run_plugin, of the first message and of stop_plugin
+- memory: RSS and PSS per plugin process for N plugins started with
+  start_all and stopped with stop_all
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from queue import Empty
+from mpps.pluginmanager import PluginManager
+
+SYNTH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     "plugins", "synth")
+SCENARIOS = ("throughput", "serializer", "latency", "startup", "memory")
+
+
+class Setup:
+    """ Temporary plugin and config folder with 'n' synthetic plugins
+    named synth0 ... synth<n-1>, all configured with 'config' """
+
+    def __init__(self, n, config):
+        self._tmp = tempfile.TemporaryDirectory(prefix="mpps-bench-")
+        self.plugins = os.path.join(self._tmp.name, "plugins")
+        self.conf = os.path.join(self._tmp.name, "conf")
+        os.mkdir(self.plugins)
+        os.mkdir(self.conf)
+        self.names = ["synth" + str(i) for i in range(n)]
+        for name in self.names:
+            os.symlink(SYNTH, os.path.join(self.plugins, name))
+        self.configure(config)
+
+    def configure(self, config):
+        for name in self.names:
+            with open(os.path.join(self.conf, name + ".conf"), "w") as f:
+                json.dump(config, f)
+
+    def manager(self, args, **kwargs):
+        return PluginManager(self.plugins, self.conf,
+                             start_method=args.start_method, **kwargs)
+
+    def close(self):
+        self._tmp.cleanup()
+
+
+def percentiles(values, scale=1.0):
+    """ Returns p50, p90, p99 and max of values multiplied by scale """
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(q):
+        return values[min(len(values) - 1, int(q * len(values)))] * scale
+    return {"p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99),
+            "max": values[-1] * scale}
+
+
+def read_until_fin(manager, plugin, handle):
+    """ Reads the messages of plugin until 'fin' and calls handle(msg,
+    time of the read) for every 'data' message """
+    while True:
+        try:
+            msgs = manager.next_msgs(plugin, 1024)
+        except Empty:
+            msgs = [manager.next_msg(plugin, timeout=None)]
+        now = time.monotonic()
+        for msg in msgs:
+            if msg.get_status() == "fin":
+                return
+            if msg.get_status() == "data":
+                handle(msg, now)
+
+
+def measure_throughput(args, setup, manager, size, batch):
+    """ Runs synth0 once and returns the throughput of its 'data'
+    messages """
+    count = 5000 if args.quick else 20000
+    budget = 64 << 20 if args.quick else 256 << 20
+    n = min(count, max(100, budget // size))
+    setup.configure({"count": n, "size": size, "batch": batch})
+    first = []
+    last = []
+    received = []
+
+    def handle(msg, now):
+        if not first:
+            first.append(msg.get_sent_time())
+        received.append(1)
+        last[:] = [now]
+    manager.run_plugin("synth0")
+    read_until_fin(manager, "synth0", handle)
+    manager.stop_plugin("synth0")
+    seconds = last[0] - first[0]
+    return {"size": size, "batch": batch, "messages": len(received),
+            "seconds": seconds, "msgs_per_sec": len(received) / seconds,
+            "mb_per_sec": len(received) * size / seconds / 1e6}
+
+
+def bench_throughput(args):
+    results = []
+    setup = Setup(1, {})
+    try:
+        for transport in ("pipe", "manager"):
+            manager = setup.manager(args, transport=transport)
+            manager.load_plugin("synth0")
+            for size in (16, 1024, 65536):
+                for batch in (1, 64):
+                    result = {"transport": transport}
+                    result.update(measure_throughput(args, setup, manager,
+                                                     size, batch))
+                    results.append(result)
+                    report(args, "throughput", result)
+            del manager
+    finally:
+        setup.close()
+    return results
+
+
+def bench_serializer(args):
+    results = []
+    setup = Setup(1, {})
+    try:
+        manager = setup.manager(args)
+        manager.load_plugin("synth0")
+        # below the shared memory threshold of the plugins
+        for size in (16, 65536, 524288):
+            for serializer in ("pickle", "pickle5", "json"):
+                manager.set_serializer("synth0", serializer)
+                result = {"serializer": serializer}
+                result.update(measure_throughput(args, setup, manager, size,
+                                                 1))
+                results.append(result)
+                report(args, "serializer", result)
+        del manager
+    finally:
+        setup.close()
+    return results
+
+
+def bench_latency(args):
+    results = []
+    rate = 500 if args.quick else 1000
+    seconds = 1 if args.quick else 3
+    setup = Setup(1, {"count": rate * seconds, "rate": rate, "size": 16})
+    try:
+        for mode in ("next_msg", "callback"):
+            manager = setup.manager(args)
+            manager.load_plugin("synth0")
+            latencies = []
+            if mode == "next_msg":
+                manager.run_plugin("synth0")
+                while True:
+                    msg = manager.next_msg("synth0", timeout=None)
+                    if msg.get_status() == "fin":
+                        break
+                    if msg.get_status() == "data":
+                        latencies.append(time.monotonic() -
+                                         msg.get_sent_time())
+            else:
+                done = threading.Event()
+
+                def handler(msg):
+                    if msg.get_status() == "data":
+                        latencies.append(time.monotonic() -
+                                         msg.get_sent_time())
+                    elif msg.get_status() == "fin":
+                        done.set()
+                manager.add_callback(handler, "synth0")
+                manager.run_plugin("synth0")
+                done.wait()
+            manager.stop_plugin("synth0")
+            result = {"mode": mode, "rate": rate,
+                      "messages": len(latencies)}
+            result.update({k + "_us": v for k, v in
+                           percentiles(latencies, 1e6).items()})
+            results.append(result)
+            report(args, "latency", result)
+            if mode == "callback":
+                manager.shutdown_callbacks()
+            del manager
+    finally:
+        setup.close()
+    return results
+
+
+def bench_startup(args):
+    runs = 20 if args.quick else 100
+    setup = Setup(1, {"idle": 60})
+    start = []
+    ready = []
+    stop = []
+    try:
+        manager = setup.manager(args)
+        manager.load_plugin("synth0")
+        for i in range(runs):
+            t0 = time.perf_counter()
+            manager.run_plugin("synth0")
+            t1 = time.perf_counter()
+            while manager.next_msg("synth0", timeout=None).get_status() \
+                    != "fin":
+                pass
+            t2 = time.perf_counter()
+            manager.stop_plugin("synth0")
+            t3 = time.perf_counter()
+            start.append(t1 - t0)
+            ready.append(t2 - t0)
+            stop.append(t3 - t2)
+        del manager
+    finally:
+        setup.close()
+    result = {"runs": runs}
+    for name, values in (("start", start), ("ready", ready),
+                         ("stop", stop)):
+        result.update({name + "_" + k + "_ms": v for k, v in
+                       percentiles(values, 1e3).items()})
+    report(args, "startup", result)
+    return [result]
+
+
+def _memory(pid):
+    """ Returns (RSS, PSS) of a process in bytes, PSS is None if
+    /proc/<pid>/smaps_rollup is not available """
+    rss = pss = None
+    try:
+        with open("/proc/" + str(pid) + "/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Rss:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("Pss:"):
+                    pss = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return rss, pss
+
+
+def bench_memory(args):
+    results = []
+    counts = [n for n in (1, 10, 100, 1000) if n <= args.max_plugins]
+    for n in counts:
+        setup = Setup(n, {"idle": 3600})
+        try:
+            manager = setup.manager(args)
+            t0 = time.perf_counter()
+            failed = manager.start_all(setup.names)
+            t1 = time.perf_counter()
+            for name in setup.names:
+                while manager.next_msg(name, timeout=None).get_status() \
+                        != "fin":
+                    pass
+            t2 = time.perf_counter()
+            rss = pss = 0
+            for name in setup.names:
+                if name in failed:
+                    continue
+                process = manager._get_running(name)[0]
+                r, p = _memory(process.pid)
+                rss += r or 0
+                pss = None if p is None or pss is None else pss + p
+            manager_rss, manager_pss = _memory(os.getpid())
+            t3 = time.perf_counter()
+            manager.stop_all()
+            t4 = time.perf_counter()
+            started = n - len(failed)
+            result = {
+                "plugins": n, "failed": len(failed),
+                "start_all_seconds": t1 - t0, "ready_seconds": t2 - t0,
+                "stop_seconds": t4 - t3,
+                "rss_per_plugin": rss / started if started else None,
+                "pss_per_plugin": pss / started
+                if started and pss is not None else None,
+                "manager_rss": manager_rss, "manager_pss": manager_pss}
+            results.append(result)
+            report(args, "memory", result)
+            del manager
+        finally:
+            setup.close()
+    return results
+
+
+def report(args, scenario, result):
+    """ Prints a result line to stderr """
+    if not args.quiet:
+        print(scenario + ": " + json.dumps(result), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MPPS benchmark suite")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help="one of " + ", ".join(SCENARIOS) +
+                        ", default all")
+    parser.add_argument("--quick", action="store_true",
+                        help="fewer and smaller runs")
+    parser.add_argument("--output", help="JSON result file, default stdout")
+    parser.add_argument("--start-method", default=None,
+                        help="multiprocessing start method of the plugins")
+    parser.add_argument("--max-plugins", type=int, default=1000,
+                        help="largest N of the memory scenario")
+    parser.add_argument("--quiet", action="store_true",
+                        help="no progress output on stderr")
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario '" + scenario + "'")
+    if args.quick and args.max_plugins == 1000:
+        args.max_plugins = 100
+
+    with open(os.path.join(ROOT, "VERSION")) as f:
+        version = f.read().strip()
+    document = {
+        "version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "start_method": args.start_method or
+        multiprocessing.get_start_method(),
+        "quick": args.quick,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": {}}
+    benchmarks = {"throughput": bench_throughput,
+                  "serializer": bench_serializer, "latency": bench_latency,
+                  "startup": bench_startup, "memory": bench_memory}
+    for scenario in args.scenarios or SCENARIOS:
+        document["results"][scenario] = benchmarks[scenario](args)
+
+    text = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/bin/env python3
+
+"""
+$LICENSE
+
+Synthetic plugin of the benchmark suite. Configured by '<name>.conf':
+- "count": number of 'data' messages, default 0
+- "size": content size in bytes, default 16
+- "rate": messages per second, 0 sends as fast as possible
+- "batch": messages per send_many call, 1 sends with _send
+- "idle": seconds the plugin stays alive after 'fin'
+"""
+
+import time
+
+from mpps.plugin import PluginClass
+
+
+def init(com, config, name):
+    return SynthPlugin(com, config, name)
+
+
+class SynthPlugin(PluginClass):
+
+    def run(self):
+        config = self._config if isinstance(self._config, dict) else {}
+        count = config.get("count", 0)
+        batch = max(1, config.get("batch", 1))
+        rate = config.get("rate", 0)
+        payload = b"x" * config.get("size", 16)
+        interval = 1.0 / rate if rate else 0
+        start = time.monotonic()
+        sent = 0
+        while sent < count:
+            n = min(batch, count - sent)
+            if interval:
+                delay = start + sent * interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if n == 1:
+                self._send("data", payload)
+            else:
+                self.send_many([("data", payload)] * n)
+            sent += n
+        self._send("fin", "")
+        time.sleep(config.get("idle", 0))
+
+if __name__ == "__main__":
+    pass
@@ -49,8 +49,9 @@ def collect():
         for i in p_list:
             print("> " + i)
 
-            p_handler.load_plugin(i)
-            p_handler.run_plugin(i)
+        failed = p_handler.start_all(p_list)
+        for i in failed:
+            print("> " + i + " failed: " + str(failed[i]))
 
         print("\n")
 
@@ -4,13 +4,16 @@ $LICENSE
 
 This module is providing a simple plugin infrastructure.
 The plugins are created as separated processes. For the communicaton,
-multiprocessing.Queue is used.
+the channels of a mpps.transport backend are used.
 
 $VERSION
 
 """
 
-__all__ = ["plugin", "pluginmanager"]
+__all__ = ["asyncmanager", "config", "discovery", "executor", "flow",
+           "journal", "plugin", "pluginmanager", "preload", "profiling",
+           "replica", "serializer", "shm", "stats", "supervisor",
+           "transport", "workerpool"]
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,307 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+asyncio front-end for the PluginManager.
+Channels and process sentinels of the plugins are registered with the
+event loop (loop.add_reader), so messages and plugin exits are handled in
+the event loop thread as soon as they are readable, without polling and
+without helper threads.
+
+$VERSION
+
+"""
+
+import asyncio
+
+from queue import Empty
+from mpps.pluginmanager import PluginManager
+from mpps.replica import ProcessGroup
+
+
+class AsyncPluginManager:
+    """
+    Wraps a PluginManager for use in asyncio applications.
+    Messages of all plugins started by this object are available through
+    'async for msg in manager.messages()'. Completion of a plugin can be
+    awaited with 'await manager.wait_plugin(plugin)'.
+    All methods have to be called from the thread running the event loop.
+    """
+    _DRAIN_LIMIT = 64
+    _RESTART_POLL = 0.05        # seconds, see _on_restart
+
+    def __init__(self, pluginpath, configpath, **kwargs):
+        """ Arguments are passed to PluginManager """
+        self.manager = PluginManager(pluginpath, configpath, **kwargs)
+        self._queue = asyncio.Queue()
+        self._done = {}
+        self._watched = {}
+
+    def get_plugins(self):
+        """ Returns a list containing all plugins """
+        return self.manager.get_plugins()
+
+    def get_loaded_plugins(self):
+        """ Returns a list containing loaded plugins """
+        return self.manager.get_loaded_plugins()
+
+    def get_running_plugins(self):
+        """ Returns a list containing all running plugins """
+        return self.manager.get_running_plugins()
+
+    def load_plugin(self, plugin):
+        """ Loads a plugin, see PluginManager.load_plugin """
+        self.manager.load_plugin(plugin)
+
+    async def run_plugin(self, plugin_in, replicas=None, profile=None):
+        """
+        Runs a previously loaded plugin and registers its channel and process
+        with the running event loop. The event loop keeps running while the
+        plugin is started. Raises the exceptions of PluginManager.run_plugin.
+        """
+        plugin = str(plugin_in)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.manager.run_plugin, plugin,
+                                   replicas, profile)
+        self._watch(plugin)
+
+    async def start_all(self, plugins, parallelism=None, replicas=None):
+        """
+        Loads and runs all plugins in parallel, see PluginManager.start_all.
+        The event loop keeps running while the plugins are started. Returns
+        the dict of failed plugins.
+        """
+        loop = asyncio.get_running_loop()
+        plugins = [str(p) for p in plugins]
+        failed = await loop.run_in_executor(
+            None, self.manager.start_all, plugins, parallelism, replicas)
+        for plugin in plugins:
+            if plugin not in failed:
+                self._watch(plugin)
+        return failed
+
+    def _watch(self, plugin):
+        """ Registers channel and process of a started plugin with the
+        running event loop """
+        loop = asyncio.get_running_loop()
+        self._done[plugin] = loop.create_future()
+        self._watched[plugin] = self._attach(plugin)
+        self._on_readable(plugin)       # messages sent by init()
+
+    def _attach(self, plugin):
+        """ Registers channel and processes of the current run of plugin.
+        Returns the entry of self._watched. """
+        loop = asyncio.get_running_loop()
+        process, p = self.manager._get_running(plugin)
+        com = p.get_com()
+        waitable = com.waitable()
+        if waitable is None:
+            handle = loop.call_soon(self._poll, plugin)
+        else:
+            # the descriptor, the channel of a replaced run may be closed
+            # before it is unregistered
+            handle = waitable.fileno()
+            loop.add_reader(handle, self._on_readable, plugin)
+        return (handle, self._add_sentinels(plugin, process), com)
+
+    def _rewatch(self, plugin):
+        """ Registers the new run of a plugin replaced by
+        PluginManager.reload_plugin. Returns False if the run is the watched
+        one. """
+        try:
+            process, p = self.manager._get_running(plugin)
+        except KeyError:
+            return False
+        if plugin not in self._watched or \
+           p.get_com() is self._watched[plugin][2]:
+            return False
+        self._unwatch(plugin)
+        self._watched[plugin] = self._attach(plugin)
+        return True
+
+    def _add_sentinels(self, plugin, process):
+        loop = asyncio.get_running_loop()
+        if isinstance(process, ProcessGroup):
+            sentinels = process.sentinels
+        else:
+            sentinels = [process.sentinel]
+        for sentinel in sentinels:
+            loop.add_reader(sentinel, self._on_exit, plugin)
+        return list(sentinels)
+
+    async def reload_plugin(self, plugin_in, timeout=None):
+        """ Imports a plugin again and rolls its run over, see
+        PluginManager.reload_plugin. The event loop keeps running
+        meanwhile. """
+        plugin = str(plugin_in)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.manager.reload_plugin, plugin,
+                                   timeout)
+        if self._rewatch(plugin):
+            self._on_readable(plugin)
+
+    async def stop_plugin(self, plugin_in, timeout=None):
+        """ Stops a plugin started by run_plugin, see
+        PluginManager.stop_plugin. The event loop keeps running while the
+        plugin ends, msgs it sends meanwhile are put to messages(). Pending
+        wait_plugin calls return None if the plugin sent no 'fin'. """
+        plugin = str(plugin_in)
+        self._unwatch(plugin)
+        loop = asyncio.get_running_loop()
+        msgs = await loop.run_in_executor(None, self.manager.stop_plugin,
+                                          plugin, timeout)
+        self._deliver(plugin, msgs)
+        self._finish(plugin, None)
+
+    async def stop_all(self, timeout=None):
+        """ Stops all plugins started by this object at once, see
+        PluginManager.stop_all """
+        plugins = list(self._watched.keys())
+        for plugin in plugins:
+            self._unwatch(plugin)
+        loop = asyncio.get_running_loop()
+        stopped = await loop.run_in_executor(None, self.manager.stop_all,
+                                             timeout, plugins)
+        for plugin in plugins:
+            self._deliver(plugin, stopped.get(plugin, []))
+            self._finish(plugin, None)
+
+    async def request(self, plugin_in, payload, key=None):
+        """ Sends a request to a running plugin and returns the reply, see
+        PluginManager.request """
+        return await asyncio.wrap_future(
+            self.manager.request(plugin_in, payload, key))
+
+    async def wait_plugin(self, plugin_in):
+        """ Waits until the plugin sent 'fin' and returns that message.
+        Returns None if the plugin ended without sending 'fin'. """
+        return await asyncio.shield(self._done[str(plugin_in)])
+
+    async def messages(self):
+        """ Asynchronous iterator over the messages of all plugins started
+        by run_plugin. Messages of one plugin keep their order. """
+        while True:
+            yield await self._queue.get()
+
+    async def close(self):
+        """ Stops all plugins started by this object """
+        await self.stop_all()
+
+    def _read(self, plugin):
+        """ Moves available messages of plugin to the message queue. Returns
+        the number of messages, None if the plugin is not running anymore.
+        """
+        try:
+            msgs = self.manager.next_msgs(plugin, self._DRAIN_LIMIT)
+        except Empty:
+            return 0
+        except KeyError:
+            return None
+        self._deliver(plugin, msgs)
+        return len(msgs)
+
+    def _deliver(self, plugin, msgs):
+        """ Puts msgs of plugin to the message queue """
+        for msg in msgs:
+            self._queue.put_nowait(msg)
+            if msg.get_status() == "fin":
+                self._finish(plugin, msg)
+
+    def _on_readable(self, plugin):
+        self._rewatch(plugin)
+        if not self._read(plugin):
+            return
+        try:
+            process, p = self.manager._get_running(plugin)
+        except KeyError:
+            return
+        if p.get_com().pending():
+            asyncio.get_running_loop().call_soon(self._on_readable, plugin)
+
+    def _poll(self, plugin):
+        """ Fallback for channels without waitable object """
+        if self._rewatch(plugin):
+            return
+        if plugin in self._watched and self._read(plugin) is not None:
+            handle = asyncio.get_running_loop().call_later(
+                self.manager._POLL_INTERVAL, self._poll, plugin)
+            self._watched[plugin] = (handle,) + self._watched[plugin][1:]
+
+    def _on_exit(self, plugin):
+        """ Called when a plugin process ended. Once all processes of the
+        plugin ended, reads the remaining messages and stops the plugin.
+        Plugins supervised by the PluginManager are left to the supervisor,
+        the processes of a reloaded plugin are replaced by its new run.
+        """
+        if self._rewatch(plugin):
+            self._on_readable(plugin)
+            return
+        try:
+            process, p = self.manager._get_running(plugin)
+        except KeyError:
+            process = None
+        if isinstance(process, ProcessGroup) and process.is_alive():
+            loop = asyncio.get_running_loop()
+            sentinels = self._watched[plugin][1]
+            for child in process.processes:
+                if not child.is_alive() and child.sentinel in sentinels:
+                    loop.remove_reader(child.sentinel)
+                    sentinels.remove(child.sentinel)
+            return
+        if process is not None and self.manager._supervised(plugin):
+            loop = asyncio.get_running_loop()
+            for sentinel in self._watched[plugin][1]:
+                loop.remove_reader(sentinel)
+            self._watched[plugin][1].clear()
+            loop.call_later(self._RESTART_POLL, self._on_restart, plugin,
+                            process)
+            return
+        while self._read(plugin):
+            pass
+        self._unwatch(plugin)
+        try:
+            self._deliver(plugin, self.manager.stop_plugin(plugin))
+        except (KeyError, RuntimeError):
+            pass                        # stopped by another call
+        self._finish(plugin, None)
+
+    def _on_restart(self, plugin, process):
+        """ Polls a supervised plugin whose processes ended until it is
+        restarted or the supervisor gave up. Messages appended by the
+        supervisor do not make the channel readable. """
+        if plugin not in self._watched:
+            return
+        self._on_readable(plugin)
+        try:
+            current, p = self.manager._get_running(plugin)
+        except KeyError:
+            return
+        if current is not process:
+            self._watched[plugin][1].extend(
+                self._add_sentinels(plugin, current))
+        elif self.manager._supervised(plugin):
+            asyncio.get_running_loop().call_later(
+                self._RESTART_POLL, self._on_restart, plugin, process)
+        else:
+            self._on_exit(plugin)
+
+    def _unwatch(self, plugin):
+        if plugin not in self._watched:
+            return
+        loop = asyncio.get_running_loop()
+        handle, sentinels, com = self._watched.pop(plugin)
+        if isinstance(handle, asyncio.Handle):
+            handle.cancel()
+        else:
+            loop.remove_reader(handle)
+        for sentinel in sentinels:
+            loop.remove_reader(sentinel)
+
+    def _finish(self, plugin, msg):
+        done = self._done.get(plugin)
+        if done is not None and not done.done():
+            done.set_result(msg)
+
+
+if __name__ == "__main__":
+    pass
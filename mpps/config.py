@@ -0,0 +1,116 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Cached plugin configs and hot reload.
+The '<plugin>.conf' files are parsed once per change: every load checks
+modification time, size and inode of the file and only reads it if one of
+them changed. Runs get a copy of the cached config. A PluginManager with a
+watch interval checks the configs of its running plugins in a Watcher
+thread and pushes changed configs to the plugin processes, where
+PluginClass.on_config applies them.
+
+$VERSION
+
+"""
+
+import json
+import os
+import threading
+import weakref
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(path):
+    """ Returns the ConfigCache of the config folder 'path', shared by all
+    users in this process """
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = ConfigCache(path)
+        return cache
+
+
+def _copy(config):
+    """ Copies the dicts and lists of a parsed config, the cached object is
+    shared by all runs """
+    if config.__class__ is dict:
+        return {k: _copy(v) for k, v in config.items()}
+    if config.__class__ is list:
+        return [_copy(v) for v in config]
+    return config
+
+
+class ConfigCache:
+    """ Parsed '<plugin>.conf' files of the folder 'path' """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def path(self, name):
+        """ Path of the config file of plugin 'name' """
+        return os.path.join(self._path, name + ".conf")
+
+    def stamp(self, name):
+        """ Returns the version of the config file of plugin 'name', None
+        if it does not exist """
+        try:
+            st = os.stat(self.path(name))
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def get(self, name):
+        """ Returns a copy of the parsed config of plugin 'name'. Raises
+        OSError if the file cannot be read and ValueError if it is not valid
+        JSON. """
+        stamp = self.stamp(name)
+        entry = self._entries.get(name)
+        if entry is None or entry[0] != stamp or stamp is None:
+            with open(self.path(name), "r") as f:
+                config = json.loads(f.read())
+            entry = (stamp, config)
+            with self._lock:
+                self._entries[name] = entry
+        return _copy(entry[1])
+
+
+class Watcher:
+    """
+    Calls PluginManager._watch every 'interval' seconds in a daemon
+    thread. Only holds a weak reference to the manager.
+    """
+
+    def __init__(self, manager, interval):
+        if interval <= 0:
+            raise ValueError("Watch interval has to be positive")
+        self._manager = weakref.ref(manager)
+        self._interval = interval
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._main, daemon=True,
+                                        name="mpps-watcher")
+        self._thread.start()
+
+    def _main(self):
+        while not self._done.wait(self._interval):
+            manager = self._manager()
+            if manager is None:
+                return
+            try:
+                manager._watch()
+            finally:
+                manager = None
+
+    def close(self):
+        """ Stops the watcher thread """
+        self._done.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    pass
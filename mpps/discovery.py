@@ -0,0 +1,190 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Plugin discovery with a persisted index.
+A plugin is a sub-directory of the plugin folder containing the main
+module '__init__.py'. The index stores the modification time of the plugin
+folder and of every sub-directory. On the next scan, only directories with a
+changed modification time are examined again, the plugin folder itself is
+only listed if entries were added or removed. The index is kept outside the
+plugin folder, writing it would change the modification time of the folder.
+Imported plugin modules carry a digest of their sources (source_stamp) in
+'__mpps_stamp__', used to detect changed plugins and stale modules.
+
+$VERSION
+
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import time
+
+INDEX_FOLDER = "mpps"       # in the user cache folder
+
+
+def default_index(path):
+    """ Returns the index file of the plugin folder 'path' in the user cache
+    folder ($XDG_CACHE_HOME or ~/.cache) """
+    cache = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(cache, INDEX_FOLDER, name + ".json")
+
+
+class PluginIndex:
+    """
+    Index of the plugins found in 'path'. The index is saved as JSON to
+    'index_path', by default to default_index(path). An index inside the
+    plugin folder is valid, but the folder is listed again on every scan
+    after the index was written. An index which cannot be read or written
+    is ignored.
+    """
+    _VERSION = 1
+    _RACY = 2 * 10**9       # mtimes this close to a scan are checked again
+
+    def __init__(self, path, mainmodule="__init__", index_path=None):
+        self._path = path
+        self._main = mainmodule + ".py"
+        self._index_path = index_path
+        if index_path is None:
+            self._index_path = default_index(path)
+        self._root = None
+        self._dirs = {}             # name: [mtime_ns, is_plugin]
+
+    def _load(self):
+        try:
+            with open(self._index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get("version") != self._VERSION or \
+           index.get("path") != os.path.abspath(self._path):
+            return
+        self._root = index["root"]
+        self._dirs = index["dirs"]
+
+    def _save(self):
+        """ Writes the index. Entries modified shortly before the scan are
+        stored without mtime, so changes within the timestamp resolution
+        are not missed. """
+        limit = time.time_ns() - self._RACY
+        dirs = {}
+        for name, (mtime, plugin) in self._dirs.items():
+            dirs[name] = [mtime if mtime is not None and mtime < limit
+                          else None, plugin]
+        root = self._root if self._root is not None and \
+            self._root < limit else None
+        index = {"version": self._VERSION,
+                 "path": os.path.abspath(self._path),
+                 "root": root, "dirs": dirs}
+        tmp = self._index_path + "." + str(os.getpid())
+        try:
+            folder = os.path.dirname(self._index_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp, self._index_path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def scan(self):
+        """ Updates the index and returns a dict of plugin name: path of the
+        main module. Returns the cached result for unchanged directories.
+        """
+        if self._root is None and not self._dirs:
+            self._load()
+        changed = False
+        root = os.stat(self._path).st_mtime_ns
+        if root != self._root:
+            names = [e.name for e in os.scandir(self._path) if e.is_dir()]
+            self._dirs = {name: self._dirs.get(name, [None, False])
+                          for name in names}
+            self._root = root
+            changed = True
+        plugins = {}
+        for name, entry in list(self._dirs.items()):
+            location = os.path.join(self._path, name)
+            try:
+                mtime = os.stat(location).st_mtime_ns
+            except OSError:
+                self._dirs.pop(name)
+                changed = True
+                continue
+            if mtime != entry[0]:
+                entry[0] = mtime
+                entry[1] = os.path.isfile(os.path.join(location, self._main))
+                changed = True
+            if entry[1]:
+                plugins[name] = os.path.join(location, self._main)
+        if changed:
+            self._save()
+        return plugins
+
+
+def source_stamp(path):
+    """ Returns a digest of name, size and modification time of the Python
+    files in the folder of the plugin main module 'path' and its
+    sub-directories """
+    digest = hashlib.sha1()
+    root = os.path.dirname(path)
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for name in sorted(files):
+            if not name.endswith(".py"):
+                continue
+            try:
+                st = os.stat(os.path.join(folder, name))
+            except OSError:
+                continue
+            digest.update((os.path.relpath(os.path.join(folder, name), root) +
+                           "\0" + str(st.st_size) + "\0" +
+                           str(st.st_mtime_ns) + "\0").encode())
+    return digest.hexdigest()
+
+
+def load_module(name, path):
+    """ Imports the module at 'path' as 'name'. A module already imported
+    under that name is executed again, like imp.load_module did. """
+    stamp = source_stamp(path)      # taken first, a change meanwhile is
+                                    # detected later
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    module.__mpps_stamp__ = stamp
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        sys.modules.pop(name, None)
+        raise
+    return module
+
+
+def reload_module(name, path):
+    """ Imports the module at 'path' as 'name' again, its submodules are
+    imported again on their next import. The previous modules are restored
+    if the import fails. """
+    prefix = name + "."
+    saved = {n: m for n, m in list(sys.modules.items())
+             if n == name or n.startswith(prefix)}
+    for n in saved:
+        del sys.modules[n]
+    try:
+        return load_module(name, path)
+    except BaseException:
+        for n in list(sys.modules):
+            if n.startswith(prefix):
+                del sys.modules[n]
+        sys.modules.update(saved)
+        raise
+
+
+if __name__ == "__main__":
+    pass
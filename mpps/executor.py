@@ -0,0 +1,93 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Bounded thread pool used by the PluginManager to execute message callbacks.
+
+$VERSION
+
+"""
+
+import collections
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SerialExecutor:
+    """
+    Executes callbacks on a pool of reused threads.
+    Tasks submitted with the same key (the plugin name) are executed one
+    after another in submission order. Tasks of different keys run in
+    parallel on up to 'max_workers' threads.
+    """
+    _BATCH = 32                 # tasks per key before the thread is yielded
+
+    def __init__(self, max_workers=None, max_pending=None):
+        """
+        - max_workers is the maximum number of callback threads. Defaults to
+        the default of concurrent.futures.ThreadPoolExecutor.
+        - max_pending limits the number of queued tasks. If reached, submit
+        blocks until a task is finished. None means unlimited. Tasks
+        submitted by a callback are queued without waiting, the callback
+        thread may be the one finishing the tasks.
+        """
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix="mpps-callback")
+        self._lock = threading.Lock()
+        self._local = threading.local()     # set in the callback threads
+        self._queues = {}
+        self._pending = None
+        if max_pending is not None:
+            self._pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, key, func, *args):
+        """ Queues func(*args) behind all tasks previously submitted for key
+        """
+        permit = self._pending is not None and \
+            not getattr(self._local, "worker", False)
+        if permit:
+            self._pending.acquire()
+        with self._lock:
+            if key in self._queues:
+                self._queues[key].append((func, args, permit))
+                return
+            self._queues[key] = collections.deque([(func, args, permit)])
+        self._pool.submit(self._drain, key)
+
+    def _drain(self, key):
+        """ Executes the queued tasks of key. After _BATCH tasks the key is
+        resubmitted to the pool so other keys are not starved. """
+        self._local.worker = True
+        done = 0
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    self._queues.pop(key)
+                    return
+                func, args, permit = queue.popleft()
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                if permit:
+                    self._pending.release()
+            done += 1
+            if done == self._BATCH:
+                try:
+                    self._pool.submit(self._drain, key)
+                    return
+                except RuntimeError:
+                    done = 0            # shutting down, finish in this thread
+
+    def shutdown(self, wait=True):
+        """ Stops accepting tasks. If wait is set, blocks until all queued
+        tasks are done. """
+        self._pool.shutdown(wait=wait)
+
+
+if __name__ == "__main__":
+    pass
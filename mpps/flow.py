@@ -0,0 +1,295 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Flow control for the message channel of a plugin.
+The plugin process counts the messages and bytes it sent, the reading side
+counts the messages it read in shared counters. A plugin whose unread
+messages reach the capacity blocks or drops 'data' messages, depending on
+the overflow policy. Other messages are never dropped. Shared memory
+contents of dropped messages are unlinked.
+
+$VERSION
+
+"""
+
+import collections
+import multiprocessing
+import random
+import threading
+import time
+
+from mpps.shm import SharedPayload
+
+POLICIES = ("block", "drop_oldest", "drop_newest", "sample")
+
+
+def _size(msg):
+    """ Size of a message content in bytes as counted for the capacity """
+    content = msg.get_content()
+    if isinstance(content, SharedPayload):
+        return content.size
+    if isinstance(content, (bytes, bytearray, str)):
+        return len(content)
+    if isinstance(content, memoryview):
+        return content.nbytes
+    return 0
+
+
+class FlowControl:
+    """
+    Capacity and overflow policy of the message channel of a plugin.
+    - count is the maximum number of unread messages
+    - size is the maximum number of unread content bytes of bytes-like and
+    str contents
+    - policy is one of POLICIES:
+        block: the plugin waits in _send until there is room
+        drop_newest: new 'data' messages are dropped
+        drop_oldest: 'data' messages are held back by the plugin, if the
+        held and the unread messages reach the capacity the oldest held
+        message is dropped
+        sample: like drop_oldest, but a random sample of the held messages
+        is kept. The held messages are not kept in order.
+    - slots is the number of replicas, which share the capacity equally
+    """
+
+    def __init__(self, count=None, size=None, policy="block", slots=1):
+        if policy not in POLICIES:
+            raise ValueError("Policy '" + str(policy) + "' is not defined")
+        if count is not None and count < 1:
+            raise ValueError("Capacity has to be at least 1 message")
+        self.count = count
+        self.size = size
+        if count is not None and slots > 1:
+            self.count = max(1, count // slots)
+        if size is not None and slots > 1:
+            self.size = max(1, size // slots)
+        self.policy = policy
+        # per slot: messages read, messages dropped
+        self._counters = multiprocessing.RawArray("Q", 2 * slots)
+        self._slots = slots
+
+    def consumed(self, msgs):
+        """ Called by the reading side for every list of read msgs """
+        for msg in msgs:
+            slot = getattr(msg, "_replica", None) or 0
+            if slot < self._slots:
+                self._counters[2 * slot] += 1
+
+    def dropped(self):
+        """ Returns the number of dropped messages of all replicas """
+        return sum(self._counters[1::2])
+
+    def sender(self, channel, slot=0):
+        """ Returns the Sender used by the plugin process of replica 'slot'
+        """
+        return Sender(self, channel, slot)
+
+
+class Sender:
+    """ Sending side of a FlowControl, used by one plugin process """
+    _DRAIN_INTERVAL = 0.05      # max wait before held msgs are retried
+
+    def __init__(self, flow, channel, slot):
+        self._flow = flow
+        self._channel = channel
+        self._slot = slot
+        self._lock = threading.Lock()
+        self._sizes = collections.deque()   # sizes of unread sent msgs
+        self._bytes = 0
+        self._acked = 0
+        self._held = collections.deque()
+        if flow.policy == "sample":
+            self._held = []                 # reservoir, see _hold
+        self._held_bytes = 0
+        self._overflow = 0                  # msgs offered while holding
+        self._drainer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        state["_drainer"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """ Starts counting at the msgs read so far. Called when the plugin
+        process starts, a restarted process does not know the msgs of the
+        previous one. """
+        with self._lock:
+            self._sizes.clear()
+            self._bytes = 0
+            self._acked = self._flow._counters[2 * self._slot]
+
+    def _update(self):
+        """ Forgets the msgs read by the other side """
+        consumed = self._flow._counters[2 * self._slot]
+        while self._acked < consumed and self._sizes:
+            self._bytes -= self._sizes.popleft()
+            self._acked += 1
+        self._acked = max(self._acked, consumed)
+
+    def _room(self, size):
+        """ True if a msg of 'size' bytes fits into the channel """
+        self._update()
+        flow = self._flow
+        if flow.count is not None and len(self._sizes) >= flow.count:
+            return False
+        if flow.size is not None and self._sizes and \
+           self._bytes + size > flow.size:
+            return False
+        return True
+
+    def _account(self, msg):
+        """ Counts msg as sent and unread """
+        size = _size(msg)
+        self._sizes.append(size)
+        self._bytes += size
+
+    def _transmit(self, msgs):
+        if len(msgs) == 1:
+            self._channel.put(msgs[0])
+        elif msgs:
+            self._channel.put_many(msgs)
+
+    def _drop(self, msg):
+        """ Counts msg as dropped and unlinks its shared memory content """
+        self._flow._counters[2 * self._slot + 1] += 1
+        self._channel.discard(msg.get_content())
+
+    def _keep(self, msg):
+        self._held.append(msg)
+        self._held_bytes += _size(msg)
+
+    def _take(self, n=1):
+        """ Removes the first n held msgs and returns them """
+        if isinstance(self._held, list):
+            out = self._held[:n]
+            del self._held[:n]
+        else:
+            out = [self._held.popleft() for i in range(n)]
+        for msg in out:
+            self._held_bytes -= _size(msg)
+        return out
+
+    def _replace(self, i, msg):
+        """ Replaces the held msg at index i by msg and returns it. The
+        last held msg takes its place and msg is appended, so the held msgs
+        change their order. """
+        old = self._held[i]
+        self._held[i] = self._held[-1]
+        self._held[-1] = msg
+        self._held_bytes += _size(msg) - _size(old)
+        return old
+
+    def _take_all(self):
+        """ Removes all held msgs and returns them counted as sent """
+        out = list(self._held)
+        self._held.clear()
+        self._held_bytes = 0
+        self._overflow = 0
+        for msg in out:
+            self._account(msg)
+        return out
+
+    def _hold(self, msg):
+        """ Keeps msg until there is room, dropping according to the
+        policy if the held and the unread msgs reach the capacity. At least
+        one msg is held, even if the unread msgs fill the capacity. """
+        flow = self._flow
+        self._overflow += 1
+        self._update()
+        full = (flow.count is not None and self._held and
+                len(self._held) + len(self._sizes) >= flow.count) or \
+            (flow.size is not None and self._held and
+             self._held_bytes + self._bytes + _size(msg) > flow.size)
+        if not full:
+            self._keep(msg)
+        elif flow.policy == "drop_oldest":
+            self._drop(self._take()[0])
+            self._keep(msg)
+        else:
+            # reservoir sampling in O(1), the sample is not kept in order
+            i = random.randrange(self._overflow)
+            if i < len(self._held):
+                self._drop(self._replace(i, msg))
+            else:
+                self._drop(msg)
+        if self._drainer is None or not self._drainer.is_alive():
+            self._drainer = threading.Thread(target=self._drain_worker,
+                                             daemon=True)
+            self._drainer.start()
+
+    def _drain(self):
+        """ Sends held msgs while there is room """
+        n = 0
+        for msg in self._held:
+            if not self._room(_size(msg)):
+                break
+            self._account(msg)
+            n += 1
+        if n:
+            self._transmit(self._take(n))
+        if not self._held:
+            self._overflow = 0
+
+    def _drain_worker(self):
+        """ Retries held msgs of a plugin which does not send anymore """
+        delay = 0.001
+        while True:
+            time.sleep(delay)
+            delay = min(delay * 2, self._DRAIN_INTERVAL)
+            with self._lock:
+                self._drain()
+                if not self._held:
+                    return
+
+    def send(self, msgs):
+        """ Sends msgs according to the policy """
+        with self._lock:
+            out = []
+            for msg in msgs:
+                if msg.get_status() != "data":
+                    # never dropped, held msgs are sent first to keep order
+                    out.extend(self._take_all())
+                    self._account(msg)
+                    out.append(msg)
+                    continue
+                if self._held:
+                    self._transmit(out)
+                    out = []
+                    self._drain()
+                if not self._held and self._room(_size(msg)):
+                    self._account(msg)
+                    out.append(msg)
+                    continue
+                self._transmit(out)
+                out = []
+                if self._flow.policy == "block":
+                    self._wait(_size(msg))
+                    self._account(msg)
+                    out.append(msg)
+                elif self._flow.policy == "drop_newest":
+                    self._drop(msg)
+                else:
+                    self._hold(msg)
+            self._transmit(out)
+
+    def _wait(self, size):
+        """ Blocks until a msg of 'size' bytes fits into the channel """
+        delay = 0.0001
+        while not self._room(size):
+            time.sleep(delay)
+            delay = min(delay * 2, self._DRAIN_INTERVAL)
+
+    def flush(self):
+        """ Sends all held msgs regardless of the capacity """
+        with self._lock:
+            self._transmit(self._take_all())
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,402 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Disk-backed message journal of a plugin.
+A Journal is the append-only log of all msgs received from a plugin. Msgs
+are appended as records to memory-mapped segment files, each record is the
+length and CRC32 of the pickled msg followed by the msg. Every msg gets the
+next offset, the segment files are named after the offset of their first
+record.
+
+The journal replaces the in-memory queue of the plugin channel: up to
+'threshold' unread msgs are kept in memory, later msgs are only kept on
+disk until the consumer reached them. The offset of the next unread msg is
+stored in the 'position' file, so a PluginManager started after a crash
+delivers the msgs which were not read yet. Already read msgs can be read
+again from any retained offset.
+
+Full segments are closed and truncated to their records (rotation). Read
+msgs older than the last 'retain' msgs are dropped: whole segments are
+deleted, the first segment is rewritten once half of its records are
+dropped (compaction).
+
+$VERSION
+
+"""
+
+import bisect
+import collections
+import mmap
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+from mpps.transport import Wakeup
+
+_RECORD = struct.Struct("<II")          # length, CRC32 of the pickled msg
+_POSITION = struct.Struct("<Q")
+_SUFFIX = ".seg"
+
+
+class _Segment:
+    """ Segment file holding the records from offset 'first' on. Only the
+    active segment is mapped writable. """
+
+    def __init__(self, path, first, size=None):
+        self.path = path
+        self.first = first
+        self.count = 0
+        self.used = 0
+        self._map = None
+        self._writable = size is not None
+        if size is not None:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+
+    def _view(self):
+        if self._map is None and self.used > 0:
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def scan(self, writable=False):
+        """ Counts the valid records of an existing file. A torn record
+        written during a crash ends the segment. If 'writable' is set, the
+        segment is mapped for appending. """
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return
+        with open(self.path, "r+b" if writable else "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE
+                                  if writable else mmap.ACCESS_READ)
+        self._writable = writable
+        pos = 0
+        while pos + _RECORD.size <= size:
+            n, crc = _RECORD.unpack_from(self._map, pos)
+            end = pos + _RECORD.size + n
+            if n == 0 or end > size or \
+               zlib.crc32(self._map[pos + _RECORD.size:end]) != crc:
+                break
+            pos = end
+            self.count += 1
+        self.used = pos
+
+    def append(self, payload):
+        """ Appends a record. Returns False if the segment is full. """
+        end = self.used + _RECORD.size + len(payload)
+        if not self._writable or end > len(self._map):
+            return False
+        self._map[self.used + _RECORD.size:end] = payload
+        _RECORD.pack_into(self._map, self.used, len(payload),
+                          zlib.crc32(payload))
+        self.used = end
+        self.count += 1
+        return True
+
+    def record(self, pos):
+        """ Returns the pickled msg of the record at byte 'pos' and the
+        position of the next record """
+        m = self._view()
+        n = _RECORD.unpack_from(m, pos)[0]
+        end = pos + _RECORD.size + n
+        return m[pos + _RECORD.size:end], end
+
+    def flush(self):
+        if self._writable:
+            self._map.flush()
+
+    def seal(self):
+        """ Ends appending and truncates the file to its records """
+        if self._writable:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._writable = False
+            os.truncate(self.path, self.used)
+
+    def unmap(self):
+        """ Unmaps a sealed segment until it is read again """
+        if not self._writable and self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def remove(self):
+        self.seal()
+        self.unmap()
+        os.unlink(self.path)
+
+
+class Journal:
+    """
+    Journal of one plugin in the folder 'path', which is created if it
+    does not exist. An existing journal is continued.
+    - threshold is the number of unread msgs kept in memory
+    - segment_size is the size of a segment file in bytes, larger msgs get
+    a segment of their own
+    - retain is the number of read msgs kept for replay, None keeps all
+    A Channel with a journal (see Channel.set_journal) uses it as its
+    backlog. Shared memory contents are copied when they are appended.
+    """
+
+    def __init__(self, path, threshold=1024, segment_size=1 << 24,
+                 retain=None):
+        if threshold < 1 or segment_size < 1 or \
+           (retain is not None and retain < 0):
+            raise ValueError("Invalid journal limits")
+        self._path = path
+        self._threshold = threshold
+        self._segment_size = segment_size
+        self._retain = retain
+        self._lock = threading.RLock()
+        self._memory = collections.deque()
+        self._cursor = None         # (segment, byte position, offset)
+        self._wakeup = Wakeup()
+        os.makedirs(path, exist_ok=True)
+        self._segments = self._recover()
+        self._active = None
+        self._end = 0
+        if self._segments:
+            self._active = self._segments[-1]
+            self._end = self._active.first + self._active.count
+        self._position = self._open_position()
+        self._read = min(max(_POSITION.unpack_from(self._position)[0],
+                             self.first_offset()), self._end)
+        if self._read < self._end:
+            self._wakeup.set()
+
+    def _recover(self):
+        """ Opens the segment files of an existing journal """
+        names = sorted(os.listdir(self._path))
+        firsts = []
+        for name in names:
+            if name.endswith(_SUFFIX + ".tmp"):
+                os.unlink(os.path.join(self._path, name))
+            elif name.endswith(_SUFFIX):
+                firsts.append(int(name[:-len(_SUFFIX)]))
+        segments = []
+        for i, first in enumerate(sorted(firsts)):
+            segment = _Segment(self._file(first), first)
+            segment.scan(writable=i == len(firsts) - 1)
+            if segment.count == 0:
+                segment.remove()
+            else:
+                segment.unmap()
+                segments.append(segment)
+        return segments
+
+    def _open_position(self):
+        path = os.path.join(self._path, "position")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _POSITION.size:
+                os.ftruncate(fd, _POSITION.size)
+            return mmap.mmap(fd, _POSITION.size)
+        finally:
+            os.close(fd)
+
+    def _file(self, first):
+        return os.path.join(self._path, "%020d" % first + _SUFFIX)
+
+    def first_offset(self):
+        """ Offset of the oldest retained msg """
+        with self._lock:
+            if not self._segments:
+                return self._end
+            return self._segments[0].first
+
+    def read_offset(self):
+        """ Offset of the next unread msg """
+        return self._read
+
+    def end_offset(self):
+        """ Offset the next appended msg gets """
+        return self._end
+
+    def waitable(self):
+        """ Returns an object usable with multiprocessing.connection.wait
+        which is ready while unread msgs are in the journal """
+        return self._wakeup
+
+    def __len__(self):
+        return self._end - self._read
+
+    def append(self, msg):
+        """ Appends msg """
+        self.extend((msg,))
+
+    def extend(self, msgs):
+        """ Appends all msgs in their order """
+        with self._lock:
+            for msg in msgs:
+                content = msg.get_content()
+                if isinstance(content, memoryview):
+                    content = bytes(content)
+                    msg.release()
+                    msg.set_content(content)
+                payload = pickle.dumps(msg, protocol=5)
+                if self._active is None or not self._active.append(payload):
+                    self._rotate(len(payload))
+                    self._active.append(payload)
+                if self._read + len(self._memory) == self._end and \
+                   len(self._memory) < self._threshold:
+                    self._memory.append(msg)
+                self._end += 1
+            if self._end > self._read:
+                self._wakeup.set()
+
+    def popleft(self):
+        """ Returns the next unread msg. Raises IndexError if there is none.
+        """
+        with self._lock:
+            if not self._memory and self._read < self._end:
+                msgs, self._cursor = self._load(self._read, self._threshold,
+                                                self._cursor)
+                self._memory.extend(msg for offset, msg in msgs)
+            msg = self._memory.popleft()
+            self._read += 1
+            _POSITION.pack_into(self._position, 0, self._read)
+            if self._read == self._end:
+                self._wakeup.clear()
+            if self._retain is not None and len(self._segments) > 1 and \
+               self._read - self._retain >= self._segments[1].first:
+                self.compact()
+            return msg
+
+    def read(self, offset, max_n=1024):
+        """ Returns a list of up to max_n (offset, msg) tuples of the msgs
+        from 'offset' on, read or not. Does not change the read offset.
+        Raises ValueError if 'offset' is not retained. """
+        with self._lock:
+            if not self.first_offset() <= offset <= self._end:
+                raise ValueError("Offset " + str(offset) +
+                                 " is not in the journal")
+            if offset == self._end:
+                return []
+            msgs, cursor = self._load(offset, max_n, None)
+            if self._cursor is None or cursor[0] is not self._cursor[0]:
+                cursor[0].unmap()
+            return msgs
+
+    def seek(self, offset):
+        """ Sets the offset of the next unread msg, so consumers resume from
+        there. Must not be called while msgs are read from the journal.
+        Raises ValueError if 'offset' is not retained. """
+        with self._lock:
+            if not self.first_offset() <= offset <= self._end:
+                raise ValueError("Offset " + str(offset) +
+                                 " is not in the journal")
+            self._memory.clear()
+            self._read = offset
+            _POSITION.pack_into(self._position, 0, offset)
+            if self._read < self._end:
+                self._wakeup.set()
+            else:
+                self._wakeup.clear()
+
+    def _load(self, offset, max_n, cursor):
+        """ Returns up to max_n (offset, msg) tuples from 'offset' on and
+        the cursor after them. A cursor returned before is reused if it
+        points to 'offset'. """
+        if cursor is None or cursor[2] != offset or \
+           cursor[0] not in self._segments:
+            cursor = self._locate(offset)
+        segment, pos, current = cursor
+        msgs = []
+        while len(msgs) < max_n and current < self._end:
+            if current >= segment.first + segment.count:
+                segment.unmap()
+                segment = self._segments[self._segments.index(segment) + 1]
+                pos = 0
+                continue
+            payload, pos = segment.record(pos)
+            msgs.append((current, pickle.loads(payload)))
+            current += 1
+        return msgs, (segment, pos, current)
+
+    def _locate(self, offset):
+        """ Returns the cursor of the record with 'offset' """
+        i = bisect.bisect_right([s.first for s in self._segments], offset)
+        segment = self._segments[max(0, i - 1)]
+        pos = 0
+        for skip in range(offset - segment.first):
+            if skip >= segment.count:
+                break
+            pos = segment.record(pos)[1]
+        return (segment, pos, offset)
+
+    def _rotate(self, size):
+        """ Seals the active segment and starts a new one for a record of
+        'size' bytes """
+        if self._active is not None:
+            self._active.seal()
+        self._active = _Segment(self._file(self._end), self._end,
+                                max(self._segment_size, size + _RECORD.size))
+        self._segments.append(self._active)
+        self.compact()
+
+    def compact(self):
+        """ Drops the read msgs older than the last 'retain' ones """
+        with self._lock:
+            if self._retain is None:
+                return
+            low = self._read - self._retain
+            while len(self._segments) > 1 and self._segments[1].first <= low \
+                    and self._segments[0] is not self._active:
+                self._segments.pop(0).remove()
+            first = self._segments[0] if self._segments else None
+            if first is not None and first is not self._active and \
+               (low - first.first) * 2 >= first.count > 0:
+                self._rewrite(first, low)
+
+    def _rewrite(self, segment, low):
+        """ Replaces 'segment' by a segment holding its records from
+        offset 'low' on """
+        cursor = self._locate(low)
+        tmp = self._file(low) + ".tmp"
+        with open(tmp, "wb") as f:
+            pos = cursor[1]
+            for offset in range(low, segment.first + segment.count):
+                payload, pos = segment.record(pos)
+                f.write(_RECORD.pack(len(payload), zlib.crc32(payload)))
+                f.write(payload)
+        segment.unmap()
+        os.replace(tmp, self._file(low))
+        if low != segment.first:
+            os.unlink(segment.path)
+        replaced = _Segment(self._file(low), low)
+        replaced.scan()
+        replaced.unmap()
+        self._segments[0] = replaced
+
+    def flush(self):
+        """ Writes the appended msgs to disk """
+        with self._lock:
+            if self._active is not None:
+                self._active.flush()
+            self._position.flush()
+
+    def close(self):
+        """ Closes the segment files. Unread msgs stay in the journal. """
+        with self._lock:
+            if self._position is None:
+                return
+            for segment in self._segments:
+                segment.seal()
+                segment.unmap()
+            self._active = None
+            self._memory.clear()
+            self._position.flush()
+            self._position.close()
+            self._position = None
+            self._wakeup.close()
+
+
+if __name__ == "__main__":
+    pass
@@ -4,36 +4,63 @@ $LICENSE
 
 This module is providing a simple plugin infrastructure.
 The plugins are created as separated processes. For the communicaton,
-multiprocessing.Queue is used.
+the channels of a mpps.transport backend are used.
 
 $VERSION
 
 """
 
-import os
-import json
+import signal
+import sys
+import threading
 import time
 
 from queue import Empty
+from mpps.config import get_cache
+from mpps.discovery import reload_module
+from mpps.profiling import Profiler
+from mpps.replica import EndOfWork
+from mpps.replica import Request
 
 
 class MsgClass:
     """
     Class for Messages to use for main process <-> plugin communication.
     This class includes some validations.
+    Messages are pickled as a status code plus content and issuer, the
+    status table is shared by all instances.
+    Messages sent by PluginClass._send carry the time.monotonic() value of
+    the send, which is comparable between the processes of a host.
     """
-    _status = ""
-    _content = ""
-    _issuer = ""
-    _longstatus = None
+    __slots__ = ("_status", "_content", "_issuer", "_replica", "_segment",
+                 "_sent")
 
-    def __init__(self, status="", content="", issuer=""):
+    _longstatus = {"err": "Error", "notify": "Notification",
+                   "data": "Data", "fin": "Finished",
+                   "warn": "Warning", "term": "Terminated"}
+    _codes = ("", "err", "notify", "data", "fin", "warn", "term")
+
+    def __init__(self, status="", content="", issuer="", replica=None,
+                 sent=None):
         self._status = status
         self._content = content
         self._issuer = issuer
-        self._longstatus = {"err": "Error", "notify": "Notification",
-                            "data": "Data", "fin": "Finished",
-                            "warn": "Warning", "term": "Terminated"}
+        self._replica = replica
+        self._segment = None
+        self._sent = sent
+
+    def __reduce__(self):
+        if self._status in self._longstatus or self._status == "":
+            status = self._codes.index(self._status)
+        else:
+            status = self._status
+        if self._sent is not None:
+            return (_from_wire, (status, self._content, self._issuer,
+                                 self._replica, self._sent))
+        if self._replica is None:
+            return (_from_wire, (status, self._content, self._issuer))
+        return (_from_wire, (status, self._content, self._issuer,
+                             self._replica))
 
     def empty(self):
         """ Clears the content of the message """
@@ -53,6 +80,20 @@ class MsgClass:
         """ Sets the message content """
         self._content = content
 
+    def set_segment(self, segment):
+        """ Sets the content to the memoryview of an attached
+        mpps.shm.Segment. The segment is freed by self.release(). """
+        self._segment = segment
+        self._content = segment.view()
+
+    def release(self):
+        """ Frees the shared memory segment holding the content of a large
+        message. The memoryview returned by get_content() is invalid
+        afterwards. Does nothing for other messages. """
+        if self._segment is not None:
+            self._segment.release()
+            self._segment = None
+
     def get_longstatus(self):
         return self._longstatus[self._status]
 
@@ -64,11 +105,64 @@ class MsgClass:
     def get_content(self):
         return self._content
 
+    def get_replica(self):
+        """ Id of the replica which sent the msg. None if the plugin does
+        not run as replicas. """
+        return self._replica
+
     def get_status(self):
         return self._status
 
+    def get_sent_time(self):
+        """ time.monotonic() of the send, None if the msg was not sent by
+        PluginClass._send """
+        return self._sent
+
     def copy(self):
-        return MsgClass(self._status, self._content, self._issuer)
+        return MsgClass(self._status, self._content, self._issuer,
+                        self._replica, self._sent)
+
+
+def _from_wire(status, content, issuer, replica=None, sent=None):
+    """ Recreates a MsgClass object from its pickled form """
+    if status.__class__ is int:
+        status = MsgClass._codes[status]
+    return MsgClass(status, content, issuer, replica, sent)
+
+
+def _payload_size(content):
+    """ Estimated size of a message content in bytes """
+    if isinstance(content, (bytes, bytearray, str)):
+        return len(content)
+    if isinstance(content, memoryview):
+        return content.nbytes
+    return sys.getsizeof(content)
+
+
+class StopPlugin(BaseException):
+    """ Raised in the main thread of a plugin process to end run() when the
+    PluginManager stops the plugin, see PluginClass.on_stop """
+
+
+# calls which must not be interrupted by StopPlugin, a partial transfer
+# corrupts the channel. Channel.export and Channel.put also keep track of the
+# shared memory payloads not sent yet, see Channel.discard_unsent.
+_TRANSFERS = {"multiprocessing.connection": ("send", "recv", "send_bytes",
+                                             "recv_bytes"),
+              "multiprocessing.managers": ("_callmethod",),
+              "mpps.transport": ("_send", "_recv", "put", "put_many",
+                                 "export")}
+
+
+def _in_transfer(frame):
+    """ True if frame or one of its callers transfers data over a
+    multiprocessing connection """
+    while frame is not None:
+        names = _TRANSFERS.get(frame.f_globals.get("__name__"))
+        if names is not None and frame.f_code.co_name in names:
+            return True
+        frame = frame.f_back
+    return False
 
 
 class PluginClass:
@@ -82,9 +176,32 @@ class PluginClass:
     cannot be used.
     """
     _com = None
-    _msg = None
     _config = None
     _name = None
+    _replica = None
+    _work = None
+    _work_taken = None
+    _reply = None
+    _flow = None
+    _profile = None
+    _profiler = None
+    _control = None
+    _controller = None
+    _control_done = None
+    _heartbeat = None
+    _stopping = False
+    _stop_deferred = None
+    _finishing = False
+    _shm_threshold = 1 << 20
+    _buffer = None
+    _buffer_size = 0
+    _buffer_time = None
+    _buffer_limits = None
+    _buffer_lock = None
+    _com_lock = None
+    _flusher = None
+    _flusher_done = None
+    _CONTROL_POLL = 0.5     # seconds until the control thread notices the end
 
     def __init__(self, com, config, name):
         """
@@ -97,52 +214,142 @@ class PluginClass:
         """
         self._name = name
         self._com = com
-        self._msg = MsgClass(issuer=name)
+        self._com_lock = threading.RLock()
         self._load_config(config)
         self._send("notify", "Initialized")
 
     def __del__(self):
         self._com = None
 
+    def __reduce__(self):
+        """ Pickled plugins import their module from its file, so they can
+        be unpickled in spawned processes """
+        module = type(self).__module__
+        path = getattr(sys.modules.get(module), "__file__", None)
+        stamp = getattr(sys.modules.get(module), "__mpps_stamp__", None)
+        return (_restore_plugin, (module, path, type(self).__qualname__,
+                                  self.__getstate__(), stamp))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("_buffer_lock", "_com_lock", "_flusher", "_flusher_done",
+                    "_profiler", "_controller", "_control_done"):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._com_lock = threading.RLock()
+        if self._buffer is not None:
+            self._buffer_lock = threading.Lock()
+
     def __iter__(self):
         return self
 
     def __next__(self):
+        """ Returns the next msg sent by the plugin. Used by the
+        PluginManager side, the plugin itself reads its input with
+        get_work. """
         try:
             return self._com.get_nowait()
         except Empty:
-            empty = True
-
-        if empty:
             raise StopIteration
 
     def __str__(self):
         return self._name
 
     def _load_config(self, path):
-        conf_path = os.path.join(path, self._name + ".conf")
+        """ Sets self._config to the parsed config file. The file is only
+        parsed again if it changed, see mpps.config.ConfigCache. """
+        cache = get_cache(path)
         try:
-            conf_file = open(conf_path, "r")
-            conf_str = conf_file.read()
-            self._config = json.loads(conf_str)
+            self._config = cache.get(self._name)
         except IOError:
             self._config = ()
             self._send(stat="warn",
                        content="Unable to open config file: '"
-                       + conf_path + "'")
+                       + cache.path(self._name) + "'")
+
+    def on_config(self, config):
+        """
+        Called with the new parsed config when the config file of the
+        running plugin changed, see PluginManager.check_configs. The default
+        replaces self._config. Overwrite it to apply tuning parameters
+        without restart. It is called in the control thread of the plugin
+        process while run() continues, exceptions are sent as 'err' msg.
+        """
+        self._config = config
+
+    def _make_msg(self, stat, content):
+        """ Returns a new MsgClass object issued by this plugin. Invalid
+        status values are turned into an 'err' message. Large buffers are
+        placed in shared memory if the serializer of the channel supports
+        it. The status is checked before the content is exported. """
+        now = time.monotonic()
+        if self._heartbeat is not None:
+            self._heartbeat.beat(self._replica or 0, now)
+        msg = MsgClass(issuer=self._name, replica=self._replica, sent=now)
+        try:
+            msg.set_status(stat)
+        except ValueError as e:
+            msg.set_status("err")
+            msg.set_content(str(e))
+            return msg
+        if self._com.shared_memory():
+            content = self._com.export(content, self._shm_threshold)
+        msg.set_content(content)
+        return msg
 
     def _send(self, stat, content=""):
         """ Calling the message self._send sends object of type MsgClass
         through the queue stored at self._com to the PluginManager.
+        If the send buffer is enabled, 'data' messages are coalesced.
         """
-        try:
-            self._msg.set_status(stat)
-            self._msg.set_content(content)
-        except ValueError as e:
-            self._msg = MsgClass(
-                issuer=self._name, status="err", content=str(e))
-        self._com.put(self._msg.copy())
-        self._msg.empty()
+        msg = self._make_msg(stat, content)
+        if self._buffer is None:
+            self._put([msg])
+        else:
+            with self._buffer_lock:
+                self._buffer.append(msg)
+                self._buffer_size += _payload_size(content)
+                if self._buffer_time is None:
+                    self._buffer_time = time.monotonic()
+                count, size, interval = self._buffer_limits
+                if msg.get_status() != "data" or \
+                   (count is not None and len(self._buffer) >= count) or \
+                   (size is not None and self._buffer_size >= size) or \
+                   (interval is not None and
+                        time.monotonic() - self._buffer_time >= interval):
+                    self._flush()
+        if self._profiler is not None and msg.get_status() == "fin":
+            self._profiler.dump()
+
+    def _put(self, msgs):
+        """ Sends a list of msgs with one transfer, through the flow control
+        if a capacity is set. The threads of the plugin, e.g. the control
+        thread calling on_config, send one after another: pooled runs write
+        to a channel without write lock. """
+        if self._heartbeat is not None:
+            # blocking on a full channel is not a hang
+            self._heartbeat.idle(self._replica or 0)
+        if self._com_lock is None:
+            self._transfer(msgs)
+        else:
+            # reentrant, on_stop may send while the main thread holds it
+            with self._com_lock:
+                self._transfer(msgs)
+        if self._heartbeat is not None:
+            self._heartbeat.beat(self._replica or 0)
+        if self._stop_deferred is not None:
+            self._deferred_stop()
+
+    def _transfer(self, msgs):
+        if self._flow is not None:
+            self._flow.send(msgs)
+        elif len(msgs) == 1:
+            self._com.put(msgs[0])
+        else:
+            self._com.put_many(msgs)
 
     def send(self, stat, content=""):
         """ Calling the message self._send sends object of type MsgClass
@@ -150,14 +357,330 @@ class PluginClass:
         """
         self._send(stat, content)
 
+    def send_many(self, msgs):
+        """ Sends all (status, content) tuples in msgs with one transfer.
+        Buffered messages are sent first, so the order is preserved. """
+        batch = [self._make_msg(stat, content) for stat, content in msgs]
+        if self._buffer is None:
+            self._put(batch)
+            return
+        with self._buffer_lock:
+            self._buffer.extend(batch)
+            self._flush()
+
+    def set_shm_threshold(self, size):
+        """ Contents of at least 'size' bytes supporting the buffer protocol
+        are sent through shared memory and received as memoryview. None
+        disables shared memory payloads. Default is 1 MiB. """
+        self._shm_threshold = size
+
+    def set_send_buffer(self, count=None, size=None, interval=None):
+        """
+        Enables coalescing of 'data' messages. Buffered messages are sent
+        with one transfer as soon as
+        - 'count' messages are buffered
+        - the buffered content reaches 'size' bytes
+        - the oldest buffered message is 'interval' seconds old
+        Any other status flushes the buffer immediately. Calling it without
+        limits disables the buffer after flushing it.
+        """
+        if self._buffer is not None:
+            self.flush()
+        if count is None and size is None and interval is None:
+            self._buffer = None
+            return
+        self._buffer_limits = (count, size, interval)
+        self._buffer_lock = threading.Lock()
+        self._buffer_size = 0
+        self._buffer_time = None
+        self._buffer = []
+        self._start_flusher()
+
+    def flush(self):
+        """ Sends all messages from the send buffer """
+        if self._buffer is not None:
+            with self._buffer_lock:
+                self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._put(self._buffer)
+            self._buffer = []
+        self._buffer_size = 0
+        self._buffer_time = None
+
     def get_com(self):
-        """ Returns the Queue object providing the connection to the
-        PluginManager """
+        """ Returns the mpps.transport.Channel object providing the
+        connection to the PluginManager """
         return self._com
 
+    def get_replica(self):
+        """ Returns the replica id of this plugin process. None if the
+        plugin does not run as replicas. """
+        return self._replica
+
+    def _set_work(self, channel, replica=None, taken=None, reply=None,
+                  flow=None):
+        """ Called by the PluginManager before the plugin process is started
+        """
+        self._work = channel
+        self._replica = replica
+        self._work_taken = taken
+        self._reply = reply
+        if flow is not None:
+            self._flow = flow.sender(self._com, replica or 0)
+
+    def _set_profile(self, spec):
+        """ Called by the PluginManager before the plugin process is started
+        if the run is profiled, see mpps.profiling """
+        self._profile = spec
+
+    def _set_control(self, channel):
+        """ Called by the PluginManager before the plugin process is started.
+        'channel' carries the (event, argument) tuples of the PluginManager,
+        see _control_worker. """
+        self._control = channel
+
+    def _set_heartbeat(self, heartbeat):
+        """ Called by the PluginManager before the plugin process is started
+        if the plugin is supervised with a timeout, see mpps.supervisor """
+        self._heartbeat = heartbeat
+
+    def heartbeat(self):
+        """ Tells the supervisor of the PluginManager that the plugin is
+        alive. Sent msgs count as heartbeat, so only plugins computing
+        longer than the supervision timeout without sending have to call
+        it. """
+        if self._heartbeat is not None:
+            self._heartbeat.beat(self._replica or 0)
+
+    def get_work(self, timeout=None):
+        """
+        Returns the next work item put by PluginManager.put_work or a
+        mpps.replica.Request sent by PluginManager.request. Blocks up
+        to 'timeout' seconds, None blocks until an item arrives.
+        Raises queue.Empty on timeout and EOFError if PluginManager.end_work
+        was called.
+        """
+        if self._work is None:
+            raise EOFError("Plugin has no work channel")
+        if self._heartbeat is not None:
+            # waiting for work is not a hang
+            self._heartbeat.idle(self._replica or 0)
+        try:
+            item = self._work.get(True, timeout)
+        finally:
+            if self._heartbeat is not None:
+                self._heartbeat.beat(self._replica or 0)
+        if self._stop_deferred is not None:
+            self._deferred_stop()
+        if isinstance(item, EndOfWork):
+            self._work = None
+            raise EOFError("End of work")
+        if self._work_taken is not None:
+            self._work_taken.value += 1
+        return item
+
+    def work(self):
+        """ Iterates over all work items until PluginManager.end_work """
+        while True:
+            try:
+                yield self.get_work()
+            except EOFError:
+                return
+
+    def reply(self, request, content=None, error=None):
+        """
+        Answers a mpps.replica.Request. The future returned by
+        PluginManager.request gets 'content' as result or, if 'error' is
+        set, a RuntimeError with the error text.
+        """
+        if self._reply is None:
+            raise EOFError("Plugin has no reply channel")
+        if error is None:
+            self._reply.put((request.id, True, content))
+        else:
+            self._reply.put((request.id, False, str(error)))
+        if self._stop_deferred is not None:
+            self._deferred_stop()
+
+    def serve(self):
+        """
+        Answers requests with the return value of self.handle_request until
+        PluginManager.end_work is called. Exceptions raised by
+        handle_request are passed to the requester. Other work items are
+        handed to handle_request as well, their result is dropped.
+        """
+        for item in self.work():
+            if not isinstance(item, Request):
+                self.handle_request(item)
+                continue
+            try:
+                result = self.handle_request(item.payload)
+            except Exception as e:
+                self.reply(item, error=repr(e))
+            else:
+                self.reply(item, result)
+
+    def handle_request(self, payload):
+        """ Called by serve() for every request. Overwrite this method. """
+        raise NotImplementedError("Plugin does not handle requests")
+
     def run(self):
         time.sleep(0.1)
 
+    def stopping(self):
+        """ True once the PluginManager asked the plugin to stop """
+        return self._stopping
+
+    def on_stop(self):
+        """
+        Called in the main thread of the plugin process when the
+        PluginManager asks the plugin to stop (stop_plugin, stop_all). The
+        default raises StopPlugin, which ends run(). Buffered msgs are sent
+        afterwards. Plugins which finish their current work first overwrite
+        it to return, and end run() once stopping() is True.
+        Plugins which do not end in time are terminated, StopPlugin is
+        raised then regardless of on_stop.
+        """
+        raise StopPlugin()
+
+    def _on_signal(self, signum, frame):
+        """ SIGTERM handler of the plugin process. The first signal calls
+        on_stop, the next one raises StopPlugin. Transfers in progress are
+        finished first. """
+        if self._finishing:
+            return
+        forced = self._stopping
+        self._stopping = True
+        if _in_transfer(frame):
+            self._stop_deferred = forced or bool(self._stop_deferred)
+            return
+        self._stop(forced)
+
+    def _stop(self, forced):
+        if forced:
+            raise StopPlugin()
+        self.on_stop()
+
+    def _deferred_stop(self):
+        """ Handles a stop request which arrived during a transfer of the
+        main thread """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        forced = self._stop_deferred
+        self._stop_deferred = None
+        self._stop(forced)
+
+    def _start_flusher(self):
+        """ Starts the thread flushing the send buffer of idle plugins. It
+        is only started inside the plugin process. """
+        if self._flusher_done is None or self._buffer is None or \
+           self._buffer_limits[2] is None:
+            return
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_worker,
+                                             daemon=True)
+            self._flusher.start()
+
+    def _flush_worker(self):
+        """ Flushes buffered messages older than the buffer interval """
+        while self._buffer is not None and \
+                self._buffer_limits[2] is not None:
+            interval = self._buffer_limits[2]
+            if self._flusher_done.wait(interval):
+                break
+            with self._buffer_lock:
+                if self._buffer_time is not None and \
+                   time.monotonic() - self._buffer_time >= interval:
+                    self._flush()
+
+    def _control_worker(self):
+        """ Handles the events of the control channel until run() ended:
+        ("config", config) calls on_config, ("snapshot", None) writes the
+        profile results """
+        while not self._control_done.is_set():
+            try:
+                event, arg = self._control.get(True, self._CONTROL_POLL)
+            except Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            if self._control_done.is_set():
+                return
+            if event == "config":
+                try:
+                    self.on_config(arg)
+                except Exception as e:
+                    self._send("err", "Config update failed: " + repr(e))
+            elif event == "snapshot" and self._profiler is not None:
+                self._profiler.dump()
+
+    def _main(self):
+        """ Entry point of the plugin process. Calls self.run() and flushes
+        the send buffer afterwards. Profiles run() if enabled. SIGTERM asks
+        the plugin to stop, see on_stop. """
+        if self._heartbeat is not None:
+            self._heartbeat.beat(self._replica or 0)
+        if self._flow is not None:
+            self._flow.reset()
+        self._flusher_done = threading.Event()
+        self._start_flusher()
+        if self._profile is not None:
+            name = self._name
+            if self._replica is not None:
+                name += "." + str(self._replica)
+            self._profiler = Profiler(self._profile, name)
+            self._profiler.start()
+        self._control_done = threading.Event()
+        if self._control is not None:
+            self._controller = threading.Thread(target=self._control_worker,
+                                                daemon=True)
+            self._controller.start()
+        saved = None
+        try:
+            if threading.current_thread() is threading.main_thread():
+                saved = signal.signal(signal.SIGTERM, self._on_signal)
+            self.run()
+        except StopPlugin:
+            pass
+        finally:
+            self._finishing = True
+            self._control_done.set()
+            if self._profiler is not None:
+                self._profiler.stop()
+            self._flusher_done.set()
+            try:
+                self.flush()
+                if self._flow is not None:
+                    self._flow.flush()
+            finally:
+                # exported contents of msgs which were never put, e.g.
+                # when run() was stopped in _send
+                self._com.discard_unsent()
+            if saved is not None:
+                # pool workers run further plugins
+                signal.signal(signal.SIGTERM, saved)
+
+
+def _restore_plugin(module, path, qualname, state, stamp=None):
+    """ Recreates a pickled PluginClass object. The plugin module is loaded
+    from 'path' if it is not imported yet or if the imported module has
+    other sources than the one of the pickling process (see
+    mpps.discovery.source_stamp), e.g. in forkservers and pool workers
+    after PluginManager.reload_plugin. """
+    current = sys.modules.get(module)
+    if path is not None and (current is None or (
+            stamp is not None and
+            getattr(current, "__mpps_stamp__", None) != stamp)):
+        reload_module(module, path)
+    cls = sys.modules[module]
+    for name in qualname.split("."):
+        cls = getattr(cls, name)
+    p = cls.__new__(cls)
+    p.__setstate__(state)
+    return p
+
 
 if __name__ == "__main__":
     pass
@@ -4,41 +4,126 @@ $LICENSE
 
 This module is providing a simple plugin infrastructure.
 The plugins are created as separated processes. For the communicaton,
-multiprocessing.Queue is used.
+the channels of a mpps.transport backend are used.
 
 $VERSION
 
 """
 
 import os
-import imp
+import itertools
+import json
 import multiprocessing
+import multiprocessing.forkserver
+import multiprocessing.spawn
+import sys
 import threading
 import time
 
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.connection import wait
 from queue import Empty
 from mpps.plugin import PluginClass
 from mpps.plugin import MsgClass
+from mpps.preload import PRELOAD_ENV
+from mpps.config import Watcher
+from mpps.config import get_cache
+from mpps.profiling import get_spec
+from mpps.serializer import get_serializer
+from mpps.transport import get_transport
+from mpps.transport import Wakeup
+from mpps.discovery import PluginIndex
+from mpps.discovery import load_module
+from mpps.discovery import reload_module
+from mpps.discovery import source_stamp
+from mpps.executor import SerialExecutor
+from mpps.flow import FlowControl
+from mpps.journal import Journal
+from mpps.stats import PluginStats
+from mpps.stats import format_stats
+from mpps.stats import process_usage
+from mpps.supervisor import Heartbeat
+from mpps.supervisor import Policy
+from mpps.supervisor import Supervisor
+from mpps.workerpool import PooledProcess
+from mpps.workerpool import WorkerPool
+from mpps.replica import ProcessGroup
+from mpps.replica import Request
+from mpps.replica import WorkQueue
 
 
 class PluginManager(threading.Thread):
     """
     Plugin Manager to start and manage multiprocessed background plugins.
     Communicaton between starter and plugin manager is implemented with
-    multiprocessing.Queues. Access to queues is encapsulated in the function
-    'next_msg(plugin=None)'.
+    the channels of a mpps.transport backend ("pipe" or "manager"). Access
+    to channels is encapsulated in the function 'next_msg(plugin=None)'.
     """
     _config = None
     _path = None
     _MAINMODULE = "__init__"
+    _POLL_INTERVAL = 0.01       # wait timeout if a channel is not waitable
+    _DRAIN_LIMIT = 64           # max msgs per plugin and dispatch pass
+    _callback_batch = None
+
+    _PRELOAD = ["mpps.preload", "mpps.pluginmanager"]
+    _ctx = None
 
     _plugins = None
+    _index = None
     _loaded_plugins = None
     _running_plugins = None
-    _syncmanagers = None
+    _starting = None
+    _locks = None
+    _rr_lock = None
+    _transport = None
+    _pool = None
     _callbacks = None
+    _executor = None
     _running = None
     _fin = None
+    _wakeup_worker = None
+    _wakeup_readers = None
+    _priorities = None
+    _replicas = None
+    _capacity = None
+    _serializers = None
+    _journals = None
+    _spool_thread = None
+    _wakeup_spool = None
+    _flows = None
+    _stats = None
+    _stats_enabled = True
+    _controls = None
+    _configs = None
+    _config_stamps = None
+    _config_lock = None
+    _watcher = None
+    _WATCH_INTERVAL = 1.0       # seconds between checks for hot_reload
+    _hot_reload = False
+    _reloading = None
+    _reload_failed = None
+    _STOP_TIMEOUT = 5           # seconds a stopped plugin gets to end
+    _KILL_TIMEOUT = 5           # seconds between terminate and kill
+    _EXIT_POLL = 0.05           # seconds between exit checks while stopping
+    _stopping = None
+    _launch_lock = None
+    _supervisor = None
+    _supervision = None
+    _default_policy = None
+    _work = None
+    _replies = None
+    _requests = None
+    _request_ids = None
+    _request_lock = None
+    _reply_lock = None
+    _reply_thread = None
+    _wakeup_replies = None
+    _closed = False
+    _rr_last = None
+    _rr_credit = 0
 
 # ===== START OF LOCK CLASS
 
@@ -46,92 +131,177 @@ class PluginManager(threading.Thread):
         """
         Locks datastructures of a PluginManger object in order to provide
         multithreading support.
+        The locks belong to the PluginManager object (self._locks) and are
+        only taken by writers. The plugin tables are replaced copy-on-write,
+        readers use the current table without locking, so no lock is held
+        while reading from a channel.
         """
-        _lock = threading.Lock()
-        _lock_loaded = threading.Lock()
-        _lock_running = threading.Lock()
-        _lock_callback = threading.Lock()
+        _TARGETS = ("loaded_plugins", "running_plugins", "callbacks")
 
         def __init__(self, target=False):
-            self._target = target
-
-        @classmethod
-        def acquire(cls, target):
-            if not target:
-                cls._lock_loaded.acquire()
-                cls._lock_running.acquire()
-                cls._lock_callback.acquire()
-            elif target == "loaded_plugins":
-                cls._lock_loaded.acquire()
-            elif target == "running_plugins":
-                cls._lock_running.acquire()
-            elif target == "callbacks":
-                cls._lock_callback.acquire()
-            else:
+            if target and target not in self._TARGETS:
                 raise ValueError("Lock target '" + target + "' is not defined")
+            self._target = target
 
-        @classmethod
-        def release(cls, target):
-            if not target:
-                cls._lock_running.release()
-                cls._lock_loaded.release()
-                cls._lock_callback.release()
-            elif target == "running_plugins":
-                cls._lock_running.release()
-            elif target == "loaded_plugins":
-                cls._lock_loaded.release()
-            elif target == "callbacks":
-                cls._lock_callback.release()
-            else:
-                raise ValueError("Lock target '" + target + "' is not defined")
+        def _get(self, manager):
+            if not self._target:
+                return [manager._locks[t] for t in self._TARGETS]
+            return [manager._locks[self._target]]
 
         def __call__(self, func):
-            def _with_getlock(*args, **kwargs):
-                self.acquire(self._target)
+            def _with_getlock(manager, *args, **kwargs):
+                locks = self._get(manager)
+                for lock in locks:
+                    lock.acquire()
                 try:
-                    return func(*args, **kwargs)
-                except:
-                    raise
+                    return func(manager, *args, **kwargs)
                 finally:
-                    self.release(self._target)
+                    for lock in reversed(locks):
+                        lock.release()
             return _with_getlock
 
 # ===== END OF LOCK CLASS
 
-    def __init__(self, pluginpath, configpath):
+    def __init__(self, pluginpath, configpath, transport="pipe",
+                 callback_workers=None, callback_backlog=None,
+                 pool_size=None, pool_max_tasks=None, index_path=None,
+                 start_method=None, preload=None, stats=True,
+                 supervise=False, watch_interval=None, hot_reload=False):
+        """
+        - pluginpath is the folder which is scanned for plugins
+        - configpath is the folder containing the '<plugin>.conf' files
+        - transport is the name of a backend in mpps.transport.TRANSPORTS
+        or an instance of mpps.transport.Transport
+        - callback_workers is the maximum number of threads executing
+        callbacks
+        - callback_backlog is the maximum number of messages waiting for a
+        callback thread. If reached, the callback worker stops reading from
+        the plugins until callbacks are finished. None means unlimited.
+        - pool_size is the number of pre-forked worker processes executing
+        plugin runs. None starts a new process for every run.
+        - pool_max_tasks is the number of runs after which a pool worker is
+        replaced. None means unlimited.
+        - index_path is the file caching the plugin discovery, see
+        mpps.discovery.PluginIndex. Defaults to a file in the user cache
+        folder, see mpps.discovery.default_index.
+        - start_method is the multiprocessing start method of the plugin
+        processes ("fork", "spawn" or "forkserver"). None uses the default
+        of multiprocessing.
+        - preload is a list of module names imported by the forkserver
+        before it forks plugin processes. Names of plugins load the plugin
+        module. Only used with start_method "forkserver".
+        - stats enables the runtime metrics returned by get_stats
+        - supervise supervises all plugins with the default options of
+        set_supervision
+        - watch_interval is the number of seconds between checks of the
+        config files of running plugins, see check_configs. None disables
+        the checks.
+        - hot_reload reloads loaded plugins whose sources changed every
+        watch_interval seconds (default _WATCH_INTERVAL), see reload_plugins
+        """
         self._path = pluginpath
         self._config = configpath
+        self._locks = {t: threading.Lock() for t in self.GetLock._TARGETS}
+        self._rr_lock = threading.Lock()
+        self._launch_lock = threading.Lock()
         self._loaded_plugins = {}
         self._running_plugins = {}
+        self._starting = set()
+        self._stopping = set()
+        self._reloading = set()
+        self._reload_failed = {}
         self._callbacks = {}
-        self._syncmanagers = {}
+        self._callback_batch = frozenset()
+        self._executor = SerialExecutor(callback_workers, callback_backlog)
+        self._ctx = multiprocessing.get_context(start_method)
+        self._transport = get_transport(transport, self._ctx)
         self._plugins = {}
+        self._index = PluginIndex(pluginpath, self._MAINMODULE, index_path)
         self._find_plugins()
+        if self._ctx.get_start_method() == "forkserver":
+            self._start_forkserver(preload or [])
+        if pool_size is not None:
+            # the workers attach the shared memory segments of mpps.stats
+            # and mpps.supervisor, they have to share the resource tracker
+            # of this process
+            resource_tracker.ensure_running()
+            self._pool = WorkerPool(pool_size, pool_max_tasks, self._ctx)
         self._running = False
         self._fin = False
+        self._wakeup_worker = Wakeup()
+        self._wakeup_readers = Wakeup()
+        self._priorities = {}
+        self._replicas = {}
+        self._capacity = {}
+        self._serializers = {}
+        self._journals = {}
+        self._flows = {}
+        self._stats = {}
+        self._stats_enabled = stats
+        self._controls = {}
+        self._configs = get_cache(configpath)
+        self._config_stamps = {}
+        self._config_lock = threading.Lock()
+        self._supervision = {}
+        if supervise:
+            self._default_policy = Policy()
+        self._work = {}
+        self._replies = {}
+        self._requests = {}
+        self._request_ids = itertools.count()
+        self._request_lock = threading.Lock()
+        # serializes the readers of reply channels, a reply read by one
+        # thread is resolved before another one fails the pending requests
+        self._reply_lock = threading.Lock()
+        self._wakeup_replies = Wakeup()
+        self._wakeup_spool = Wakeup()
         super().__init__()
         self.daemon = True
+        self._hot_reload = hot_reload
+        if hot_reload and watch_interval is None:
+            watch_interval = self._WATCH_INTERVAL
+        if watch_interval is not None:
+            self._watcher = Watcher(self, watch_interval)
 
     def __del__(self):
         self._fin = True
+        self._closed = True
+        self._wakeup()
+        if self._watcher is not None:
+            self._watcher.close()
+        if self._supervisor is not None:
+            self._supervisor.close()
         if self._running_plugins is not None:
-            for p in list(self._running_plugins.keys()):
-                self.stop_plugin(p)
+            self.stop_all()
         if self._callbacks is not None:
             for p in list(self._callbacks.keys()):
-                self.end_msg_callback(p)
-        if self._plugins is not None:
-            for p in self._plugins:
-                self._plugins[p][0].close()
+                self.end_callback(p)
         if self._running:
             self.join()
-        if self._syncmanagers is not None:
-            for p in self._syncmanagers:
-                self._syncmanagers[p].shutdown()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        if self._transport is not None:
+            self._transport.shutdown()
+        if self._reply_thread is not None:
+            self._wakeup_replies.set()
+            self._reply_thread.join()
+        if self._spool_thread is not None:
+            self._wakeup_spool.set()
+            self._spool_thread.join()
+        if self._journals is not None:
+            for journal in self._journals.values():
+                journal.close()
+        if self._wakeup_worker is not None:
+            self._wakeup_worker.close()
+            self._wakeup_readers.close()
+            self._wakeup_replies.close()
+            self._wakeup_spool.close()
 
     def __iter__(self):
-        return [self._running_plugins[p][1]
-                for p in self._running_plugins.keys()].__iter__()
+        return [p for mp, p in self._running_plugins.values()].__iter__()
 
     def get_plugins(self):
         """ Returns a list containing all plugins """
@@ -150,56 +320,127 @@ class PluginManager(threading.Thread):
         return list(self._callbacks.keys())
 
     def _find_plugins(self):
-        """ Scans configured folder for plugins.
+        """ Scans configured folder for plugins. Only directories changed
+        since the last scan are examined, see mpps.discovery.PluginIndex.
         Original Plugin System taken from MiJyn, modified by bw0x00
         http://lkubuntu.wordpress.com/2012/10/02/writing-a-python-plugin-api/
         """
-        possibleplugins = os.listdir(self._path)
-        for i in possibleplugins:
-            location = os.path.join(self._path, i)
-            if not os.path.isdir(location) or \
-               not self._MAINMODULE + ".py" in os.listdir(location):
-                    continue
-            self._plugins[i] = imp.find_module(self._MAINMODULE, [location])
-
-    def run(self):
-        """ Worker loop for callback worker Thread """
-
-        class Handler(threading.Thread):
-            """ Inner Class used to set up the Thread to process the message
-            """
-            def __init__(self, handler, msg):
-                self.handler = handler
-                self.msg = msg
-                super().__init__()
-                self.daemon = True
+        self._plugins = self._index.scan()
 
-            def run(self):
-                self.handler(self.msg)
+    def _start_forkserver(self, preload):
+        """ Starts the forkserver with mpps, the __main__ module, the
+        modules in 'preload' and the plugin modules named in 'preload'
+        already imported. The forkserver is shared by all PluginManager
+        objects of a process, the preload list of the first one is used.
+        """
+        plugins = {m: self._plugins[m] for m in preload if m in self._plugins}
+        modules = [m for m in preload if m not in self._plugins]
+        main = multiprocessing.spawn.get_preparation_data("mpps").get(
+            "init_main_from_path")
+        self._ctx.set_forkserver_preload(self._PRELOAD + modules)
+        # the forkserver does not get sys.path of this process
+        env = {PRELOAD_ENV: json.dumps({"main": main, "plugins": plugins}),
+               "PYTHONPATH": os.pathsep.join(p for p in sys.path if p)}
+        saved = {k: os.environ.get(k) for k in env}
+        os.environ.update(env)
+        try:
+            multiprocessing.forkserver.ensure_running()
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
 
+    def run(self):
+        """ Worker loop for callback worker Thread. Messages are handed to
+        the callback executor, which keeps the order per plugin. """
         while not self._fin:
-            delay = 0.1
             cbs = self._callbacks.copy()
-            if len(cbs) != 0:
-                for plugin in cbs.keys():
-                    try:
-                        m = self.next_msg(plugin, True)
-                        t = Handler(msg=m, handler=cbs[plugin])
-                        t.start()
-                        delay = 0
-                    except Empty:
-                        pass
-                    except KeyError:
-                        pass
-            time.sleep(delay)
+            batch = self._callback_batch.copy()
+            for plugin in self._wait_callbacks(cbs):
+                try:
+                    msgs = self.next_msgs(plugin, self._DRAIN_LIMIT, True)
+                except (Empty, KeyError):
+                    continue
+                self._submit(plugin, cbs[plugin], plugin in batch, msgs)
         self._running = False
 
+    def _submit(self, plugin, handler, batch, msgs):
+        """ Hands msgs of plugin to the callback executor """
+        stats = self._stats.get(plugin)
+        if batch:
+            self._executor.submit(plugin, self._call, stats, handler, msgs)
+        else:
+            for m in msgs:
+                self._executor.submit(plugin, self._call, stats, handler, m)
+
+    @staticmethod
+    def _call(stats, handler, arg):
+        """ Executes a callback and records its execution time """
+        if stats is None:
+            handler(arg)
+            return
+        start = time.perf_counter()
+        try:
+            handler(arg)
+        finally:
+            stats.callback(time.perf_counter() - start)
+
+    def _wakeup(self):
+        """ Interrupts the callback worker and the spooler if they are
+        waiting for messages """
+        if self._wakeup_worker is not None:
+            self._wakeup_worker.set()
+            self._wakeup_spool.set()
+
+    def _wait_callbacks(self, cbs):
+        """ Blocks until at least one of the plugins in 'cbs' is readable or
+        the worker is woken up. Returns the list of ready plugins.
+        Channels without a waitable object are checked after at most
+        _POLL_INTERVAL seconds.
+        """
+        waitables = {self._wakeup_worker: None}
+        polled = []
+        pending = False
+        running = self._running_plugins.copy()
+        for plugin in cbs:
+            if plugin not in running:
+                continue
+            com = running[plugin][1].get_com()
+            w = com.waitable()
+            if w is None or com.pending():
+                polled.append(plugin)
+                pending = pending or com.pending()
+            else:
+                waitables[w] = plugin
+        timeout = None
+        if pending:
+            timeout = 0
+        elif polled:
+            timeout = self._POLL_INTERVAL
+        try:
+            ready = wait(list(waitables.keys()), timeout)
+        except (OSError, ValueError):
+            return []                   # channel closed by stop_plugin
+        plugins = polled
+        for w in ready:
+            if w is self._wakeup_worker:
+                self._wakeup_worker.clear()
+            else:
+                plugins.append(waitables[w])
+        return plugins
+
     @GetLock("callbacks")
     def end_callback(self, plugin_in):
         """ Removes callback handler. """
         plugin = str(plugin_in)
         if plugin in self._callbacks:
-            self._callbacks.pop(plugin)
+            callbacks = dict(self._callbacks)
+            callbacks.pop(plugin)
+            self._callbacks = callbacks
+            self._callback_batch = self._callback_batch - {plugin}
+            self._wakeup()
         else:
             raise KeyError("No handler registered for '" + plugin + "'.")
 
@@ -209,17 +450,21 @@ class PluginManager(threading.Thread):
         """
         self._fin = True
         self._running = False
+        self._wakeup()
         self.join()
+        self._executor.shutdown()
         callbacks = list(self._callbacks.keys())
         for c in callbacks:
             self.end_callback(c)
         self._callbacks = {}
 
     @GetLock("callbacks")
-    def add_callback(self, handler, plugin_in):
+    def add_callback(self, handler, plugin_in, batch=False):
         """ Adds message handlers for incoming messages.
         Parameter 'plugin' defines the plugin for which the handler should
         be registered.
+        If 'batch' is set, the handler is called with a list of all messages
+        read in one pass instead of once per message.
         Handlers can only be added for loaded plugins. Furthermore, they are
         removed if the plugin is stopped or finishes.
         """
@@ -230,7 +475,14 @@ class PluginManager(threading.Thread):
             self.start()                    # starts worker for async callbacks
             self._running = True
         if plugin in self._loaded_plugins and hasattr(handler, '__call__'):
-            self._callbacks[plugin] = handler
+            callbacks = dict(self._callbacks)
+            callbacks[plugin] = handler
+            self._callbacks = callbacks
+            if batch:
+                self._callback_batch = self._callback_batch | {plugin}
+            else:
+                self._callback_batch = self._callback_batch - {plugin}
+            self._wakeup()
         elif plugin not in self._plugins:
             raise KeyError("Plugin '" + plugin + "' is not available")
         elif plugin not in self._loaded_plugins:
@@ -238,60 +490,1024 @@ class PluginManager(threading.Thread):
         else:
             raise TypeError("First parameter 'handler' has to be a function")
 
-    @GetLock("loaded_plugins")
     def load_plugin(self, plugin):
         """
         Loads plugin with the name passed in parameter 'plugin' if plugin is
         available.
         If no plugin with given name was found, an exception of type KeyError
         will be risen.
+        The module is imported without holding a lock, so several plugins
+        can be loaded in parallel.
 
         Plugin System from MiJyn, modified by bw0x00
         http://lkubuntu.wordpress.com/2012/10/02/writing-a-python-plugin-api/
         """
         if plugin in self._plugins:
-            self._loaded_plugins[plugin] = imp.load_module(
-                plugin, *self._plugins[plugin])
-            self._syncmanagers[plugin] = multiprocessing.Manager()
+            module = load_module(plugin, self._plugins[plugin])
+            self._set_loaded(plugin, module)
         else:
             raise KeyError("Plugin '" + plugin + "' does not exist.\n")
 
+    @GetLock("loaded_plugins")
+    def _set_loaded(self, plugin, module):
+        loaded = dict(self._loaded_plugins)
+        loaded[plugin] = module
+        self._loaded_plugins = loaded
+
+    def reload_plugin(self, plugin_in, timeout=None):
+        """
+        Imports a loaded plugin again, together with its submodules. If the
+        plugin is running, its run is rolled over: a new run with the
+        replicas and profile of the old one is started first, then msgs are
+        read from, and work items and requests are sent to, the new run.
+        The old processes are stopped afterwards like stop_plugin with
+        'timeout'. Their unread msgs are read before the msgs of the new
+        run, msgs they send while stopping as they arrive. Work items they
+        did not take are handed to the new run, requests they took but did
+        not answer fail. Pooled runs start as soon as a worker is free.
+        Raises the exceptions of load_plugin and run_plugin, the old module
+        and run are kept then. Raises RuntimeError if the plugin is started,
+        stopped or reloaded by another thread.
+        """
+        plugin = str(plugin_in)
+        self._begin_reload(plugin, True)
+        try:
+            self._reload(plugin, timeout)
+        finally:
+            self._end_reload(plugin)
+
+    def reload_plugins(self, timeout=None):
+        """
+        Reloads all loaded plugins whose sources changed since they were
+        imported (see mpps.discovery.source_stamp) like reload_plugin.
+        Other plugins keep running. If a reload fails, an 'err' msg is
+        appended to the msgs of the running plugin and the sources are not
+        tried again before they change. Plugins started, stopped or reloaded
+        by another thread are left out. Called every watch_interval seconds
+        if hot_reload is set. Returns the list of reloaded plugins.
+        """
+        reloaded = []
+        for plugin, module in self._loaded_plugins.items():
+            path = self._plugins.get(plugin)
+            if path is None:
+                continue
+            stamp = source_stamp(path)
+            if stamp == getattr(module, "__mpps_stamp__", None) or \
+               stamp == self._reload_failed.get(plugin):
+                continue
+            if not self._begin_reload(plugin, False):
+                continue
+            try:
+                self._reload(plugin, timeout)
+            except Exception as e:
+                self._reload_failed[plugin] = stamp
+                self._inject(plugin, "err", "Reload of plugin '" + plugin +
+                             "' failed: " + repr(e))
+                continue
+            finally:
+                self._end_reload(plugin)
+            reloaded.append(plugin)
+        return reloaded
+
+    @GetLock("running_plugins")
+    def _begin_reload(self, plugin, strict):
+        """ Marks a loaded plugin as being reloaded. Returns False if it is
+        started, stopped or reloaded by another thread, or raises
+        RuntimeError if 'strict' is set. """
+        for busy, text in ((self._starting, "' is starting."),
+                           (self._stopping, "' is stopping."),
+                           (self._reloading, "' is already reloading.")):
+            if plugin in busy:
+                if strict:
+                    raise RuntimeError("Plugin '" + plugin + text)
+                return False
+        if plugin not in self._loaded_plugins:
+            if plugin in self._plugins:
+                raise KeyError("Plugin '" + plugin + "' is not loaded.")
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+        self._reloading.add(plugin)
+        return True
+
     @GetLock("running_plugins")
-    def run_plugin(self, plugin_in):
+    def _end_reload(self, plugin):
+        self._reloading.discard(plugin)
+
+    def _reload(self, plugin, timeout):
+        """ Reloads a plugin marked by _begin_reload, see reload_plugin """
+        old_module = self._loaded_plugins[plugin]
+        module = reload_module(plugin, self._plugins[plugin])
+        self._set_loaded(plugin, module)
+        self._reload_failed.pop(plugin, None)
+        if plugin not in self._running_plugins:
+            return
+        mp, p = self._running_plugins[plugin]
+        replicas = None
+        if p.get_replica() is not None:
+            replicas = len(mp.processes)
+        profile = False if p._profile is None else p._profile
+        policy = self._supervision.get(plugin, self._default_policy)
+        try:
+            started, heartbeat = self._start_run(plugin, replicas, profile,
+                                                 policy)
+        except BaseException:
+            self._set_loaded(plugin, old_module)
+            sys.modules[plugin] = old_module
+            raise
+        self._roll_over(plugin, started, heartbeat, policy, timeout)
+
+    def _roll_over(self, plugin, started, heartbeat, policy, timeout):
+        """ Replaces the run of a running plugin by the started run, see
+        reload_plugin """
+        if self._supervisor is not None:
+            # waits until a restart in progress is finished
+            self._supervisor.unwatch(plugin)
+        com = started[1][0].get_com()
+        unread = []
+        if com.get_journal() is None:
+            # the runs of a journaled plugin share the journal
+            unread = self._drain(self._running_plugins[plugin][1].get_com())
+        old, pending = self._swap(plugin, started, unread)
+        self._supervise(plugin, started, heartbeat, policy)
+        self._wakeup()
+        self._wakeup_readers.set()
+        (mp, p), work, reply, controls, stats = old
+        self._end_runs([(mp, p)], timeout,
+                       lambda source: self._forward(source, com))
+        self._forward(p.get_com(), com)
+        p.get_com().close()
+        for control in controls:
+            control.close()
+        moved = work.handover(started[2])
+        work.close()
+        while self._read_replies(plugin, reply):
+            pass
+        moved = {item.id for item in moved if isinstance(item, Request)}
+        with self._request_lock:
+            futures = self._requests.get(plugin, {})
+            lost = [futures.pop(i) for i in pending - moved if i in futures]
+        for future in lost:
+            future.set_exception(RuntimeError("Plugin '" + plugin +
+                                              "' was reloaded."))
+        reply.close()
+        if stats is not None:
+            stats.close()
+        self._wakeup()
+        self._wakeup_readers.set()
+
+    @GetLock("running_plugins")
+    def _swap(self, plugin, started, unread):
+        """ Enters the new run of a reloaded plugin into the tables. The
+        msgs 'unread', drained from the old run before, are moved in front
+        of the msgs of the new one. Returns the old run as (process and
+        PluginClass object, work queue, reply channel, control channels,
+        stats) and the ids of its pending requests. """
+        running = self._running_plugins[plugin]
+        old = (running, self._work[plugin], self._replies[plugin],
+               self._controls[plugin], self._stats.get(plugin))
+        if unread:
+            started[1][0].get_com().adopt(unread)
+        with self._request_lock:
+            pending = set(self._requests.get(plugin, {}))
+        self._store(plugin, started)
+        return old, pending
+
+    def _forward(self, source, target):
+        """ Moves the msgs available in the channel of a replaced run to
+        the channel of the new run """
+        if target.get_journal() is not None:
+            source.prefetch()           # into the shared journal
+            return
+        for msg in self._drain(source):
+            target.inject(msg)
+
+    def run_plugin(self, plugin_in, replicas=None, profile=None):
         """
         Runs a previously loaded plugin. Plugin has to be instance of
         'PluginClass' or of other derived class.
+        If 'replicas' (or the value set by set_replicas) is given, the
+        plugin is started as that many processes sharing one message
+        stream. Replicas are always started as new processes.
+        'profile' enables profiling of the run, see mpps.profiling. If it
+        is None, the "profile" entry of the plugin config is used, False
+        disables profiling.
+        The process is started without holding a lock, so different plugins
+        can be started in parallel.
 
         Raises TypeError if plugin to load is not instance of 'PluginClass'.
         Raises KeyError if plugin was not loaded or is not available
+        Raises RuntimeError if the plugin is started by another thread
+        Raises ValueError if the profile configuration is invalid
         """
         plugin = str(plugin_in)
-        if plugin in self._loaded_plugins:
-            com = self._syncmanagers[plugin].Queue()
-            p = self._loaded_plugins[plugin].init(com, self._config, plugin)
-            if not isinstance(p, PluginClass):
-                raise TypeError(
-                    "'" + plugin + "' is not instance of 'PluginClass'")
-            mp = multiprocessing.Process(target=p.run)
-            mp.start()
-            self._running_plugins[plugin] = (mp, p)
+        self._reserve(plugin)
+        policy = self._supervision.get(plugin, self._default_policy)
+        try:
+            started, heartbeat = self._start_run(plugin, replicas, profile,
+                                                 policy)
+        except BaseException:
+            self._register(plugin, None)
+            raise
+        self._register(plugin, started)
+        self._supervise(plugin, started, heartbeat, policy)
+        self._wakeup()
+        self._wakeup_readers.set()
+
+    def _start_run(self, plugin, replicas, profile, policy):
+        """ Starts the processes of a run of plugin, see run_plugin.
+        Returns the run as stored by _store and its heartbeat. """
+        # taken before init() reads the config, a change meanwhile is
+        # pushed by the next check_configs
+        stamp = self._configs.stamp(plugin)
+        flow = stats = heartbeat = None
+        try:
+            if replicas is None:
+                replicas = self._replicas.get(plugin)
+            if plugin in self._capacity:
+                flow = FlowControl(*self._capacity[plugin],
+                                   slots=replicas or 1)
+            if self._stats_enabled:
+                stats = PluginStats(replicas or 1)
+            if policy is not None and policy.timeout is not None:
+                heartbeat = Heartbeat(replicas or 1)
+            if replicas is None:
+                started = self._start_plugin(plugin, flow, stats, profile,
+                                             heartbeat)
+            else:
+                started = self._start_replicas(plugin, replicas, flow, stats,
+                                               profile, heartbeat)
+        except BaseException:
+            if stats is not None:
+                stats.close()
+            if heartbeat is not None:
+                heartbeat.close()
+            raise
+        return started + (flow, stats, stamp), heartbeat
+
+    def _supervise(self, plugin, started, heartbeat, policy):
+        """ Hands a started run to the supervisor if policy is set """
+        if policy is not None:
+            if self._supervisor is None:
+                self._start_supervisor()
+            self._supervisor.watch(plugin, started[0], started[1], heartbeat,
+                                   policy)
+
+    @GetLock("running_plugins")
+    def _reserve(self, plugin):
+        """ Marks plugin as being started by run_plugin """
+        if plugin in self._starting:
+            raise RuntimeError("Plugin '" + plugin + "' is already starting.")
+        elif plugin in self._stopping:
+            raise RuntimeError("Plugin '" + plugin + "' is stopping.")
+        elif plugin in self._reloading:
+            raise RuntimeError("Plugin '" + plugin + "' is reloading.")
+        elif plugin in self._loaded_plugins:
+            self._starting.add(plugin)
         elif plugin in self._plugins:
             raise KeyError("Plugin '" + plugin + "' is not loaded.")
         else:
-            self._lock.release()
             raise KeyError("Plugin '" + plugin + "' does not exist.")
 
     @GetLock("running_plugins")
-    def stop_plugin(self, plugin_in):
+    def _start_supervisor(self):
+        if self._supervisor is None:
+            self._supervisor = Supervisor(self)
+
+    @GetLock("running_plugins")
+    def _register(self, plugin, started):
+        """ Stores a plugin started by run_plugin. 'started' is None if the
+        start failed. """
+        self._starting.discard(plugin)
+        if started is not None:
+            self._store(plugin, started)
+
+    def _store(self, plugin, started):
+        """ Enters a started run into the tables. Requires the
+        running_plugins lock. """
+        mp, plugins, work, reply, controls, flow, stats, stamp = started
+        with self._config_lock:
+            self._config_stamps[plugin] = stamp
+        self._controls = {**self._controls, plugin: controls}
+        self._flows = {**self._flows, plugin: flow}
+        self._stats = {**self._stats, plugin: stats}
+        self._work = {**self._work, plugin: work}
+        self._replies = {**self._replies, plugin: reply}
+        self._running_plugins = {**self._running_plugins,
+                                 plugin: (mp, plugins[0])}
+
+    def start_all(self, plugins, parallelism=None, replicas=None):
+        """
+        Loads (if not loaded yet) and runs all plugins in the list 'plugins'
+        on up to 'parallelism' threads, default is one thread per plugin,
+        at most 32. Returns once every plugin is started, its init() has
+        sent 'Initialized', or failed. Failures do not abort the other
+        starts, they are returned as dict of plugin name: exception.
+        """
+        plugins = [str(p) for p in plugins]
+        failed = {}
+        if not plugins:
+            return failed
+        if parallelism is None:
+            parallelism = min(32, len(plugins))
+
+        def start(plugin):
+            if plugin not in self._loaded_plugins:
+                self.load_plugin(plugin)
+            self.run_plugin(plugin, replicas)
+
+        with ThreadPoolExecutor(max_workers=parallelism,
+                                thread_name_prefix="mpps-start") as pool:
+            futures = {plugin: pool.submit(start, plugin)
+                       for plugin in plugins}
+        for plugin, future in futures.items():
+            if future.exception() is not None:
+                failed[plugin] = future.exception()
+        return failed
+
+    def _init_plugin(self, plugin, com):
+        """ Calls init() of the plugin module """
+        p = self._loaded_plugins[plugin].init(com, self._config, plugin)
+        if not isinstance(p, PluginClass):
+            raise TypeError(
+                "'" + plugin + "' is not instance of 'PluginClass'")
+        return p
+
+    def _profile_run(self, p, profile):
+        """ Enables profiling of the plugin object p if configured by
+        'profile' or the plugin config """
+        if profile is None and isinstance(p._config, dict):
+            profile = p._config.get("profile")
+        spec = get_spec(profile)
+        if spec is not None:
+            p._set_profile(spec)
+
+    def _control_run(self, p, single_writer=False):
+        """ Creates the control channel of the plugin object p, used by
+        check_configs and profile_snapshot """
+        control = self._transport.channel(single_writer=single_writer,
+                                          reverse=True)
+        p._set_control(control)
+        return control
+
+    def _start_plugin(self, plugin, flow=None, stats=None, profile=None,
+                      heartbeat=None):
+        """ Starts one plugin process or pool run. Returns the process, the
+        list of PluginClass objects, the WorkQueue, the reply channel and
+        the list of control channels. Plugins with flow control are
+        always started as new process. """
+        pooled = self._pool is not None and flow is None
+        com = self._transport.channel(single_writer=pooled)
+        com.set_flow(flow)
+        com.set_stats(stats)
+        com.set_serializer(self._serializers.get(plugin))
+        com.set_journal(self._journals.get(plugin))
+        if flow is not None and flow.policy != "block":
+            # msgs are dropped at the capacity, not when the pipe is full
+            com.set_spooled()
+        p = self._init_plugin(plugin, com)
+        work = self._transport.channel(single_writer=pooled, reverse=True)
+        reply = self._transport.channel(single_writer=pooled)
+        p._set_work(work, reply=reply, flow=flow)
+        self._profile_run(p, profile)
+        control = self._control_run(p, pooled)
+        p._set_heartbeat(heartbeat)
+        mp = self._launch(plugin, [p], pooled)
+        return mp, [p], WorkQueue([work]), reply, [control]
+
+    def _start_replicas(self, plugin, replicas, flow=None, stats=None,
+                        profile=None, heartbeat=None):
+        """ Starts the replica processes of a plugin, see _start_plugin """
+        if replicas < 1:
+            raise ValueError("Replicas have to be at least 1")
+        com = self._transport.channel()
+        com.set_flow(flow)
+        com.set_stats(stats)
+        com.set_serializer(self._serializers.get(plugin))
+        com.set_journal(self._journals.get(plugin))
+        if flow is not None and flow.policy != "block":
+            com.set_spooled()
+        reply = self._transport.channel()
+        plugins = []
+        channels = []
+        taken = []
+        controls = []
+        for i in range(replicas):
+            p = self._init_plugin(plugin, com)
+            channels.append(self._transport.channel(reverse=True))
+            taken.append(self._ctx.RawValue("Q", 0))
+            p._set_work(channels[i], i, taken[i], reply, flow)
+            self._profile_run(p, profile)
+            controls.append(self._control_run(p))
+            p._set_heartbeat(heartbeat)
+            plugins.append(p)
+        mp = self._launch(plugin, plugins)
+        return mp, plugins, WorkQueue(channels, taken), reply, controls
+
+    def _launch(self, plugin, plugins, pooled=False):
+        """ Starts the processes (or the pool run) executing the PluginClass
+        objects 'plugins' and returns the process object """
+        if pooled:
+            return self._pool.run(plugin, self._plugins[plugin], plugins[0])
+        if plugins[0].get_replica() is None:
+            mp = self._ctx.Process(target=plugins[0]._main)
+        else:
+            mp = ProcessGroup([self._ctx.Process(target=p._main)
+                               for p in plugins])
+        with self._launch_lock:
+            # a process forked by another thread meanwhile would inherit
+            # the sentinel pipe, which is not ready before both ended
+            mp.start()
+        return mp
+
+    def _relaunch(self, plugin, process, plugins):
+        """ Called by the Supervisor after the processes of a supervised
+        plugin ended. Starts new processes for its PluginClass objects,
+        which keep the channels of the run. Returns the new process, None if
+        the plugin was stopped meanwhile. """
+        plugins[0].get_com().reset_writer()
+        mp = self._launch(plugin, plugins, isinstance(process, PooledProcess))
+        if not self._replace_process(plugin, process, mp):
+            mp.terminate()
+            mp.join()
+            return None
+        self._wakeup()
+        self._wakeup_readers.set()
+        return mp
+
+    @GetLock("running_plugins")
+    def _replace_process(self, plugin, process, mp):
+        running = self._running_plugins.get(plugin)
+        if running is None or running[0] is not process:
+            return False
+        self._running_plugins = {**self._running_plugins,
+                                 plugin: (mp, running[1])}
+        return True
+
+    def _inject(self, plugin, status, content):
+        """ Appends a msg issued by the PluginManager to the msgs of a
+        running plugin. Msgs the plugin processes send meanwhile may arrive
+        before it. """
+        running = self._running_plugins.get(plugin)
+        if running is None:
+            return
+        msg = MsgClass(status, content, plugin, sent=time.monotonic())
+        try:
+            running[1].get_com().inject(msg)
+        except (EOFError, OSError):
+            return                      # stopped meanwhile
+        self._wakeup()
+        self._wakeup_readers.set()
+
+    def set_supervision(self, plugin_in, restart="never", timeout=None,
+                        max_restarts=None, backoff=0.1, max_backoff=30.0,
+                        stable=60.0):
+        """
+        Supervises the runs of a plugin, see mpps.supervisor. When the
+        processes of a supervised plugin end, they are joined, pending
+        requests fail and a msg is appended to the msgs of the plugin:
+        'term' if it exited with exit code 0, otherwise 'err'.
+        - restart is "never", "on-failure" (failed or hung runs are
+        restarted) or "always". Restarted processes keep the channels of
+        the run and send 'notify' "Restarted" first. Work items not taken
+        by the ended processes are handed to the new ones.
+        - timeout is the number of seconds without heartbeat after which
+        a plugin is considered hung. Hung plugins get an 'err' msg and are
+        terminated. Heartbeats are sent by every msg, by waiting in
+        PluginClass.get_work and by PluginClass.heartbeat. None disables
+        the hang detection.
+        - max_restarts is the number of consecutive restarts after which
+        the supervisor gives up with an 'err' msg. None means unlimited.
+        - backoff is the delay of the first restart in seconds, doubled
+        with every consecutive restart up to max_backoff.
+        - stable is the runtime in seconds after which a run counts as
+        successful, the next restart is not consecutive.
+        Runs which are not restarted stay running until stop_plugin.
+        Takes effect with the next run_plugin, restart None ends the
+        supervision. Raises ValueError for invalid options.
+        """
+        plugin = str(plugin_in)
+        if plugin not in self._plugins:
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+        if restart is None:
+            self._supervision[plugin] = None
+            return
+        self._supervision[plugin] = Policy(restart, timeout, max_restarts,
+                                           backoff, max_backoff, stable)
+
+    def set_replicas(self, plugin_in, replicas=None):
+        """ Sets the number of replicas run_plugin starts for plugin.
+        Default is os.cpu_count(). 1 starts a single replica. """
+        plugin = str(plugin_in)
+        if plugin not in self._plugins:
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+        if replicas is None:
+            replicas = os.cpu_count() or 1
+        self._replicas[plugin] = replicas
+
+    @GetLock("running_plugins")
+    def set_capacity(self, plugin_in, count=None, size=None,
+                     policy="block"):
+        """
+        Limits the unread messages of a plugin to 'count' messages and
+        'size' content bytes. If reached, 'data' messages are handled as
+        defined by 'policy' (see mpps.flow.POLICIES): the plugin blocks in
+        _send ("block"), new messages are dropped ("drop_newest") or the
+        plugin holds back the messages and drops the oldest ("drop_oldest")
+        or a random part ("sample") of them. The held and the unread
+        messages together are limited to the capacity, plus the newest held
+        message. Other messages are never dropped. Replicas share the
+        capacity. With the other policies, the
+        msgs of the plugin are moved from the pipe into memory as they
+        arrive, so the plugin is limited by the capacity and not by the
+        pipe buffer. Takes effect with the next run_plugin, calling it
+        without limits removes the capacity.
+        """
+        plugin = str(plugin_in)
+        if plugin not in self._plugins:
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+        if count is None and size is None:
+            self._capacity.pop(plugin, None)
+            return
+        FlowControl(count, size, policy)        # validates the arguments
+        self._capacity[plugin] = (count, size, policy)
+        if policy != "block":
+            self._start_spooler()
+
+    def set_serializer(self, plugin_in, serializer="pickle"):
+        """
+        Sets the serializer of the msgs of a plugin, the name of one of
+        mpps.serializer.SERIALIZERS or a mpps.serializer.Serializer object.
+        "pickle5" sends large binary contents without copies through the
+        pipe, "json" encodes the msgs as JSON lines. Takes effect with the
+        next run_plugin, "pickle" is the default.
+        """
+        plugin = str(plugin_in)
+        if plugin not in self._plugins:
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+        serializer = get_serializer(serializer)
+        if serializer is None:
+            self._serializers.pop(plugin, None)
+            return
+        self._serializers[plugin] = serializer
+
+    @GetLock("running_plugins")
+    def set_journal(self, plugin_in, path=None, threshold=1024,
+                    segment_size=1 << 24, retain=None):
         """
-        Stops the passed plugin and closes the corresponding Queue.
+        Keeps the msgs of a plugin in a mpps.journal.Journal in the folder
+        'path'/<plugin>. The journal is opened at once and continued if it
+        exists, see get_journal. While the plugin runs, its msgs are moved
+        to the journal as they arrive, so the plugin never waits for slow
+        consumers. Up to 'threshold' unread msgs are kept in memory, the
+        others are read back from disk. Unread msgs of an earlier run, also
+        of a stopped or crashed PluginManager, are read first. stop_plugin
+        leaves them in the journal. 'segment_size' and
+        'retain' (read msgs kept for replay, None keeps all) are passed to
+        the Journal. Takes effect with the next run_plugin, calling it
+        without path closes the journal.
+        Raises RuntimeError if the plugin is running.
         """
         plugin = str(plugin_in)
+        if plugin not in self._plugins:
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+        if plugin in self._running_plugins or plugin in self._starting:
+            raise RuntimeError("Plugin '" + plugin + "' is running.")
+        journal = None
+        if path is not None:
+            journal = Journal(os.path.join(path, plugin), threshold,
+                              segment_size, retain)
+        old = self._journals.pop(plugin, None)
+        if old is not None:
+            old.close()
+        if journal is None:
+            return
+        self._journals[plugin] = journal
+        self._start_spooler()
+
+    def get_journal(self, plugin_in):
+        """ Returns the mpps.journal.Journal of a plugin, None if it has
+        none. Journal.read returns msgs from any retained offset. """
+        plugin = str(plugin_in)
+        if plugin not in self._plugins:
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+        return self._journals.get(plugin)
+
+    def _start_spooler(self):
+        """ Starts the thread running _spool_worker. Requires the
+        running_plugins lock. """
+        if self._spool_thread is None:
+            self._spool_thread = threading.Thread(target=self._spool_worker,
+                                                  daemon=True)
+            self._spool_thread.start()
+
+    def _spool_worker(self):
+        """ Worker loop moving the msgs of running plugins with a journal
+        or a dropping capacity from their channels to the journal or the
+        backlog of the channel, see Channel.set_spooled """
+        while not self._closed:
+            waitables = {self._wakeup_spool: None}
+            polled = []
+            for plugin, (mp, p) in self._running_plugins.items():
+                com = p.get_com()
+                if not com.spooled():
+                    continue
+                if com.source() is None:
+                    polled.append(com)
+                else:
+                    waitables[com.source()] = com
+            timeout = self._POLL_INTERVAL if polled else None
+            try:
+                ready = wait(list(waitables.keys()), timeout)
+            except (OSError, ValueError):
+                ready = []              # channel closed by stop_plugin
+            coms = polled
+            for w in ready:
+                if w is self._wakeup_spool:
+                    self._wakeup_spool.clear()
+                else:
+                    coms.append(waitables[w])
+            for com in coms:
+                try:
+                    com.prefetch()
+                except Exception:
+                    # closed by stop_plugin or replaced meanwhile, the
+                    # proxies of the manager transport raise RemoteError
+                    pass
+
+    def get_dropped(self, plugin_in):
+        """ Returns the number of messages dropped by the last run of a
+        plugin because of its capacity """
+        plugin = str(plugin_in)
+        if plugin not in self._plugins:
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+        flow = self._flows.get(plugin)
+        if flow is None:
+            return 0
+        return flow.dropped()
+
+    def get_stats(self, plugin_in=None):
+        """
+        Returns the runtime metrics of the current or last run of a plugin
+        as dict. Without plugin, a dict of plugin name: metrics of all
+        plugins started since the PluginManager was created is returned.
+        - sent, received: dict of status: (messages, bytes). Bytes are
+        counted for bytes-like, str and shared memory contents.
+        - depth: messages sent but not read yet
+        - dropped: messages dropped because of the capacity
+        - latency: histogram of the seconds from PluginClass._send to the
+        read, see mpps.stats.Histogram.snapshot
+        - callbacks: histogram of the execution time of callbacks
+        - cpu, rss: CPU seconds and resident bytes of the plugin processes,
+        None if the plugin is not running or /proc is not available
+        - running: True if the plugin is running
+        - restarts: restarts of the run by the supervisor
+        """
+        if plugin_in is not None:
+            plugin = str(plugin_in)
+            if plugin not in self._plugins:
+                raise KeyError("Plugin '" + plugin + "' does not exist.")
+            if self._stats.get(plugin) is None:
+                raise KeyError("No stats for plugin '" + plugin + "'.")
+            return self._plugin_stats(plugin, self._stats[plugin])
+        return {plugin: self._plugin_stats(plugin, stats)
+                for plugin, stats in self._stats.items()
+                if stats is not None}
+
+    def _plugin_stats(self, plugin, stats):
+        result = stats.snapshot()
+        result["dropped"] = self.get_dropped(plugin)
+        running = self._running_plugins.get(plugin)
+        result["running"] = running is not None
+        result["restarts"] = 0
+        if self._supervisor is not None:
+            result["restarts"] = self._supervisor.restarts(plugin)
+        result["cpu"] = result["rss"] = None
+        if running is not None:
+            processes = getattr(running[0], "processes", [running[0]])
+            result["cpu"], result["rss"] = process_usage(
+                [p.pid for p in processes if p.pid is not None])
+        return result
+
+    def write_stats(self, path):
+        """ Writes get_stats() of all plugins in the Prometheus text format
+        to the file 'path'. The file is replaced atomically. """
+        tmp = path + "." + str(os.getpid())
+        with open(tmp, "w") as f:
+            f.write(format_stats(self.get_stats()))
+        os.replace(tmp, path)
+
+    def put_work(self, plugin_in, item, key=None):
+        """
+        Sends a work item to a running plugin, which receives it with
+        PluginClass.get_work. For replicated plugins, items with a 'key'
+        are sharded by key, other items go to the least busy replica.
+        Blocks while the work channel is full.
+        """
+        self._get_work(str(plugin_in)).put(item, key)
+
+    def end_work(self, plugin_in):
+        """ Tells all replicas of a plugin that no more work will be put.
+        PluginClass.get_work raises EOFError afterwards. """
+        self._get_work(str(plugin_in)).end()
+
+    def _get_work(self, plugin):
+        work = self._work.get(plugin)
+        if work is None:
+            self._check_running(plugin)
+            raise KeyError("Plugin '" + plugin + "' is not running.")
+        return work
+
+    def request(self, plugin_in, payload, key=None):
+        """
+        Sends payload as mpps.replica.Request to a running plugin and
+        returns a concurrent.futures.Future, which is resolved with the
+        content the plugin passes to PluginClass.reply. 'key' shards the
+        requests of replicated plugins like put_work. Pending futures fail
+        with a RuntimeError when the plugin is stopped.
+        """
+        plugin = str(plugin_in)
+        work = self._get_work(plugin)
+        future = Future()
+        with self._request_lock:
+            if self._reply_thread is None:
+                self._reply_thread = threading.Thread(
+                    target=self._reply_worker, daemon=True)
+                self._reply_thread.start()
+            request_id = next(self._request_ids)
+            self._requests.setdefault(plugin, {})[request_id] = future
+        self._wakeup_replies.set()
+        try:
+            work.put(Request(request_id, payload), key)
+        except Exception as e:
+            with self._request_lock:
+                self._requests[plugin].pop(request_id, None)
+            future.set_exception(e)
+        return future
+
+    def _reply_worker(self):
+        """ Worker loop resolving the futures of requests with the replies
+        read from the reply channels """
+        while not self._closed:
+            waitables = {self._wakeup_replies: None}
+            polled = []
+            with self._request_lock:
+                for plugin in self._requests:
+                    reply = self._replies.get(plugin)
+                    if reply is None or not self._requests[plugin]:
+                        continue
+                    w = reply.waitable()
+                    if w is None or reply.pending():
+                        polled.append(plugin)
+                    else:
+                        waitables[w] = plugin
+            timeout = self._POLL_INTERVAL if polled else None
+            try:
+                ready = wait(list(waitables.keys()), timeout)
+            except (OSError, ValueError):
+                ready = []              # channel closed by stop_plugin
+            plugins = polled
+            for w in ready:
+                if w is self._wakeup_replies:
+                    self._wakeup_replies.clear()
+                else:
+                    plugins.append(waitables[w])
+            for plugin in plugins:
+                self._read_replies(plugin)
+
+    def _read_replies(self, plugin, reply=None):
+        """ Resolves the futures of up to _DRAIN_LIMIT available replies of
+        plugin, read from 'reply' or the reply channel of the current run.
+        Returns the number of replies. The request lock is not held while
+        the channel is read. """
+        with self._reply_lock:
+            if reply is None:
+                reply = self._replies.get(plugin)
+            if reply is None:
+                return 0
+            try:
+                replies = reply.get_many(self._DRAIN_LIMIT)
+            except (EOFError, OSError):
+                return 0
+            with self._request_lock:
+                futures = self._requests.get(plugin, {})
+                resolved = [(futures.pop(i, None), ok, content)
+                            for i, ok, content in replies]
+        for future, ok, content in resolved:
+            if future is None:
+                continue
+            if ok:
+                future.set_result(content)
+            else:
+                future.set_exception(RuntimeError(content))
+        return len(resolved)
+
+    def _end_requests(self, plugin):
+        """ Called by stop_plugin. Resolves the requests answered before
+        the plugin was stopped and fails the pending ones. """
+        self._fail_requests(plugin, "Plugin '" + plugin + "' was stopped.")
+        with self._request_lock:
+            replies = dict(self._replies)
+            reply = replies.pop(plugin)
+            self._replies = replies
+        reply.close()
+
+    def _fail_requests(self, plugin, reason):
+        """ Resolves the requests answered so far and fails the pending
+        ones with RuntimeError(reason) """
+        self._read_replies(plugin)
+        with self._request_lock:
+            futures = self._requests.pop(plugin, {})
+        for future in futures.values():
+            future.set_exception(RuntimeError(reason))
+
+    def stop_plugin(self, plugin_in, timeout=None):
+        """
+        Stops the passed plugin and closes the corresponding channels.
+        The plugin is asked to stop (see PluginClass.on_stop) and gets up to
+        'timeout' seconds to end, default is _STOP_TIMEOUT. Its msgs are
+        received meanwhile, so it does not block on a full channel. Plugins
+        which do not end in time are terminated and, after _KILL_TIMEOUT
+        seconds, killed. 0 terminates the plugin at once. The processes are
+        joined.
+        Returns the list of msgs which were not read yet, e.g. the 'fin' msg
+        sent while stopping. If a callback is registered, these msgs are
+        passed to the callback instead and the list is empty. The unread
+        msgs of a plugin with a journal stay in the journal for its next
+        run, the list is empty then too.
+        Raises RuntimeError if the plugin is stopped by another thread.
+        """
+        plugin = str(plugin_in)
+        self._begin_stop([plugin], True)
+        return self._stop_plugins([plugin], timeout)[plugin]
+
+    def stop_all(self, timeout=None, plugins=None):
+        """
+        Stops all running plugins, or the running plugins in the list
+        'plugins', like stop_plugin. All plugins are asked to stop at once
+        and share the timeout, so any number of plugins is stopped within
+        'timeout' plus _KILL_TIMEOUT seconds. Plugins stopped by another
+        thread are left out. Returns a dict of plugin name: list of unread
+        msgs.
+        """
+        if plugins is None:
+            plugins = self._running_plugins.keys()
+        plugins = self._begin_stop([str(p) for p in plugins], False)
+        return self._stop_plugins(plugins, timeout)
+
+    @GetLock("running_plugins")
+    def _begin_stop(self, plugins, strict):
+        """ Marks running plugins as being stopped and returns them. If
+        'strict' is set, a plugin which is not running raises KeyError and
+        a plugin stopped by another thread RuntimeError, otherwise they are
+        left out. """
+        marked = []
+        for plugin in plugins:
+            if plugin in self._stopping or plugin in marked:
+                if strict:
+                    raise RuntimeError("Plugin '" + plugin +
+                                       "' is already stopping.")
+            elif plugin in self._reloading:
+                if strict:
+                    raise RuntimeError("Plugin '" + plugin +
+                                       "' is reloading.")
+            elif plugin in self._running_plugins:
+                marked.append(plugin)
+            elif strict:
+                self._check_running(plugin)
+        self._stopping.update(marked)
+        return marked
+
+    def _stop_plugins(self, plugins, timeout):
+        """ Stops the plugins marked by _begin_stop, see stop_plugin """
+        runs = []
+        for plugin in plugins:
+            if self._supervisor is not None:
+                # waits until a restart in progress is finished
+                self._supervisor.unwatch(plugin)
+            runs.append(self._running_plugins[plugin])
+        self._end_runs(runs, timeout)
+        return {plugin: self._finish_stop(plugin) for plugin in plugins}
+
+    def _end_runs(self, runs, timeout, forward=None):
+        """ Asks the processes of all (process, PluginClass object) tuples
+        in 'runs' to stop, terminates and kills them if they do not end in
+        time and joins them. 'forward' is passed to _await_exit. """
+        if timeout is None:
+            timeout = self._STOP_TIMEOUT
+        if timeout > 0:
+            for mp, p in runs:
+                if not mp.is_alive():
+                    continue
+                if isinstance(mp, PooledProcess):
+                    mp.interrupt()
+                else:
+                    mp.terminate()      # handled by PluginClass.on_stop
+            self._await_exit(runs, time.monotonic() + timeout, forward)
+        alive = [(mp, p) for mp, p in runs if mp.is_alive()]
+        for mp, p in alive:
+            mp.terminate()
+        self._await_exit(alive, time.monotonic() + self._KILL_TIMEOUT,
+                         forward)
+        for mp, p in alive:
+            if mp.is_alive():
+                mp.kill()
+        for mp, p in runs:
+            mp.join()
+
+    def _await_exit(self, runs, deadline, forward=None):
+        """ Waits until the processes of all (process, PluginClass object)
+        tuples in 'runs' ended or the deadline is reached. The channels of
+        running plugins are emptied into their backlog meanwhile, or passed
+        to 'forward' if set. """
+        while True:
+            sentinels = {}
+            channels = {}
+            for mp, p in runs:
+                for member in getattr(mp, "processes", [mp]):
+                    if member.is_alive():
+                        sentinels[member.sentinel] = member
+                        com = p.get_com()
+                        if com.source() is not None:
+                            channels[com.source()] = com
+            timeout = deadline - time.monotonic()
+            if not sentinels or timeout <= 0:
+                return
+            try:
+                # sentinels may be held by processes forked elsewhere
+                ready = wait(list(sentinels) + list(channels),
+                             min(timeout, self._EXIT_POLL))
+            except (OSError, ValueError):
+                return
+            for w in ready:
+                if w in sentinels:
+                    # the sentinel is ready before the exit code
+                    sentinels[w].join()
+                elif forward is None:
+                    channels[w].prefetch()
+                else:
+                    forward(channels[w])
+
+    def _finish_stop(self, plugin):
+        """ Removes a stopped plugin and closes its channels. Returns the
+        unread msgs, or hands them to the callback of the plugin. Journaled
+        msgs are left in the journal. """
+        mp, p, work = self._unregister(plugin)
+        handler = self._callbacks.get(plugin)
+        batch = plugin in self._callback_batch
+        try:
+            self.end_callback(plugin)
+        except KeyError:
+            pass
+        for control in self._controls.get(plugin) or ():
+            control.close()
+        with self._config_lock:
+            self._config_stamps.pop(plugin, None)
+        com = p.get_com()
+        msgs = []
+        if com.get_journal() is None:
+            msgs = self._drain(com)
+        com.close()                 # moves the rest into the journal
+        work.close()
+        self._end_requests(plugin)
+        if handler is not None and msgs:
+            self._submit(plugin, handler, batch, msgs)
+            msgs = []
+        stats = self._stats.get(plugin)
+        if stats is not None:
+            stats.close()
+        return msgs
+
+    def _drain(self, com):
+        """ Reads all msgs left in a channel. Shared memory contents are
+        copied, the channel frees the segments when it is closed. """
+        msgs = []
+        try:
+            while True:
+                batch = com.get_many(self._DRAIN_LIMIT)
+                if not batch:
+                    break
+                msgs.extend(batch)
+        except (EOFError, OSError):
+            pass
+        for msg in msgs:
+            if isinstance(msg.get_content(), memoryview):
+                content = bytes(msg.get_content())
+                msg.release()
+                msg.set_content(content)
+        return msgs
+
+    @GetLock("running_plugins")
+    def _unregister(self, plugin):
+        """ Removes a running plugin from the tables. Returns the process,
+        the PluginClass object and the WorkQueue. """
         if plugin in self._running_plugins:
-            if plugin in self._callbacks:
-                self.end_callback(plugin)
-            self._running_plugins[plugin][0].terminate()
-            self._running_plugins.pop(plugin)
+            running = dict(self._running_plugins)
+            mp, p = running.pop(plugin)
+            work = dict(self._work)
+            queue = work.pop(plugin)
+            self._running_plugins = running
+            self._work = work
+            self._stopping.discard(plugin)
+            return mp, p, queue
         elif plugin in self._loaded_plugins:
             raise KeyError("Plugin '" + plugin + "' is not running.")
         elif plugin in self._plugins:
@@ -299,35 +1515,117 @@ class PluginManager(threading.Thread):
         else:
             raise KeyError("Plugin '" + plugin + "' does not exist.")
 
-    @GetLock("running_plugins")
-    def next_msg(self, plugin=None, callback=False):
+    def profile_snapshot(self, plugin_in):
+        """ Tells the processes of a profiled plugin to write the results
+        collected so far, see mpps.profiling. The plugin keeps running, the
+        files are written asynchronously. Raises RuntimeError if the run is
+        not profiled. """
+        plugin = str(plugin_in)
+        if self._get_running(plugin)[1]._profile is None:
+            raise RuntimeError("Plugin '" + plugin + "' is not profiled.")
+        self._control(plugin, ("snapshot", None))
+
+    def _control(self, plugin, event):
+        """ Sends an (event, argument) tuple to all processes of a running
+        plugin, see PluginClass._control_worker. Returns False if the plugin
+        was stopped meanwhile. """
+        try:
+            for control in self._controls.get(plugin) or ():
+                control.put(event)
+        except (EOFError, OSError):
+            return False
+        return True
+
+    def check_configs(self):
+        """
+        Pushes the config files of running plugins which changed since the
+        plugin was started or last updated to the plugin processes, see
+        PluginClass.on_config. A config which cannot be read or parsed is
+        not pushed, a 'warn' msg is appended to the msgs of the plugin
+        instead. Called every watch_interval seconds if set. Returns the
+        list of updated plugins.
+        """
+        updated = []
+        for plugin in self._running_plugins:
+            with self._config_lock:
+                if plugin not in self._config_stamps:
+                    continue            # stopped meanwhile
+                stamp = self._configs.stamp(plugin)
+                if stamp == self._config_stamps[plugin]:
+                    continue
+                self._config_stamps[plugin] = stamp
+            try:
+                config = self._configs.get(plugin)
+            except (OSError, ValueError) as e:
+                self._inject(plugin, "warn", "Config of plugin '" + plugin +
+                             "' not updated: " + str(e))
+                continue
+            if self._control(plugin, ("config", config)):
+                updated.append(plugin)
+        return updated
+
+    def _watch(self):
+        """ Called by the mpps.config.Watcher every watch_interval """
+        self.check_configs()
+        if self._hot_reload:
+            self.reload_plugins()
+
+    def set_priority(self, plugin_in, weight):
+        """ Sets the weight of a plugin for next_msg(plugin=None). A plugin
+        with weight n is served up to n messages in a row before the next
+        plugin is read. Default weight is 1. """
+        plugin = str(plugin_in)
+        if plugin not in self._plugins:
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+        if weight < 1:
+            raise ValueError("Weight has to be at least 1")
+        self._priorities[plugin] = int(weight)
+
+    def next_msg(self, plugin=None, callback=False, timeout=0):
         """
         Trying to read the next message for provided plugin. If plugin is not
-        specified, all running plugins are iterated and the first msg found is
-        passed back to caller.
+        specified, all running plugins are read round-robin (weighted by
+        set_priority) and the first msg found is passed back to caller.
+        'timeout' is the maximum time in seconds to wait for a message. The
+        default 0 does not block, None blocks until a message arrives.
         If no message is found, queue.Empty is raised.
         Returned messages are instances of 'MsgClass'.
         """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self._read_msg(plugin, callback)
+            except Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+            self._wait_readable(plugin, callback, deadline)
+
+    def _read_msg(self, plugin, callback):
+        """ Non-blocking part of next_msg """
         msg = None
-        if plugin in self._running_plugins:
-            if plugin not in self._callbacks or \
-               (plugin in self._callbacks and callback):
-                msg = self._running_plugins[plugin][1].get_com().get_nowait()
+        running = self._running_plugins     # tables are replaced on change
+        callbacks = self._callbacks
+        self._check_running(plugin)
+        if plugin in running:
+            if plugin not in callbacks or callback:
+                msg = self._get_nowait(plugin, running[plugin][1])
         elif plugin is None:
-            for p in self._running_plugins:
-                if p not in self._callbacks:
-                    try:
-                        msg = self._running_plugins[p][1].get_com().\
-                            get_nowait()
-                        break
-                    except Empty:
-                        pass
-        elif plugin in self._loaded_plugins:
-            raise KeyError("Plugin '" + plugin + "' is not running.")
-        elif plugin in self._plugins:
-            raise KeyError("Plugin '" + plugin + "' is not loaded.")
-        else:
-            raise KeyError("Plugin '" + plugin + "' does not exist.")
+            with self._rr_lock:
+                order = self._fair_order(running, callbacks)
+            for p in order:
+                try:
+                    msg = running[p][1].get_com().get_nowait()
+                except (Empty, EOFError, OSError):
+                    continue                # empty or stopped meanwhile
+                with self._rr_lock:
+                    if p == self._rr_last:
+                        self._rr_credit -= 1
+                    else:
+                        self._rr_last = p
+                        self._rr_credit = self._priorities.get(p, 1) - 1
+                break
 
         if msg is None:
             raise Empty  # raise Empty if no plugin has a message
@@ -336,6 +1634,121 @@ class PluginManager(threading.Thread):
 
         return msg
 
+    def _get_nowait(self, plugin, p, n=None):
+        """ Reads one msg (n None) or up to n msgs from the channel of a
+        running plugin. A channel closed by a concurrent stop_plugin raises
+        KeyError like a plugin which is not running. """
+        com = p.get_com()
+        try:
+            return com.get_nowait() if n is None else com.get_many(n)
+        except (EOFError, OSError):
+            self._check_running(plugin)
+            raise KeyError("Plugin '" + plugin + "' is not running.")
+
+    def _fair_order(self, running, callbacks):
+        """ Returns the running plugins without callback in the order they
+        are read by next_msg(plugin=None). The last served plugin comes
+        first while it has credit left, last otherwise. Requires
+        self._rr_lock. """
+        plugins = [p for p in running if p not in callbacks]
+        if self._rr_last in plugins:
+            i = plugins.index(self._rr_last)
+            if self._rr_credit <= 0:
+                i += 1
+            plugins = plugins[i:] + plugins[:i]
+        return plugins
+
+    def _wait_readable(self, plugin, callback, deadline):
+        """ Blocks until a channel next_msg would read from is readable, a
+        plugin is started or the deadline is reached. """
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - time.monotonic())
+        waitables = [self._wakeup_readers]
+        callbacks = self._callbacks
+        for p, (mp, pl) in self._running_plugins.items():
+            if plugin is None and p in callbacks:
+                continue
+            if plugin is not None and (p != plugin or (
+                    p in callbacks and not callback)):
+                continue
+            com = pl.get_com()
+            if com.pending():
+                return
+            if com.waitable() is None:
+                if timeout is None or timeout > self._POLL_INTERVAL:
+                    timeout = self._POLL_INTERVAL
+            else:
+                waitables.append(com.waitable())
+        try:
+            ready = wait(waitables, timeout)
+        except (OSError, ValueError):
+            return                      # channel closed by stop_plugin
+        if self._wakeup_readers in ready:
+            self._wakeup_readers.clear()
+
+    def next_msgs(self, plugin=None, max_n=64, callback=False):
+        """
+        Reads up to max_n messages which are available without blocking.
+        If plugin is not specified, the messages of all running plugins
+        without callback are collected. Messages of one plugin are returned
+        in the order they were sent.
+        If no message is found, queue.Empty is raised.
+        """
+        msgs = []
+        running = self._running_plugins
+        callbacks = self._callbacks
+        self._check_running(plugin)
+        if plugin is None:
+            plugins = [p for p in running if p not in callbacks]
+        elif plugin not in callbacks or callback:
+            plugins = [plugin] if plugin in running else []
+        else:
+            plugins = []
+        for p in plugins:
+            try:
+                msgs.extend(self._get_nowait(p, running[p][1],
+                                             max_n - len(msgs)))
+            except KeyError:
+                if plugin is not None:
+                    raise
+                continue                    # stopped meanwhile
+            if len(msgs) >= max_n:
+                break
+
+        if not msgs:
+            raise Empty
+        for msg in msgs:
+            if not isinstance(msg, MsgClass):
+                raise TypeError(
+                    "'" + str(msg) + "' is not instance of 'MsgClass'")
+        return msgs
+
+    def _get_running(self, plugin):
+        """ Returns the tuple (process, PluginClass object) of a running
+        plugin. Raises KeyError if plugin is not running. """
+        running = self._running_plugins.get(plugin)
+        if running is None:
+            self._check_running(plugin)
+            raise KeyError("Plugin '" + plugin + "' is not running.")
+        return running
+
+    def _supervised(self, plugin):
+        """ True while a plugin is supervised, see Supervisor.watches """
+        return self._supervisor is not None and \
+            self._supervisor.watches(plugin)
+
+    def _check_running(self, plugin):
+        """ Raises KeyError if plugin is neither None nor running """
+        if plugin is None or plugin in self._running_plugins:
+            return
+        elif plugin in self._loaded_plugins:
+            raise KeyError("Plugin '" + plugin + "' is not running.")
+        elif plugin in self._plugins:
+            raise KeyError("Plugin '" + plugin + "' is not loaded.")
+        else:
+            raise KeyError("Plugin '" + plugin + "' does not exist.")
+
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,53 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Preloading of plugin modules in the forkserver process.
+The PluginManager puts this module on the forkserver preload list and
+passes a JSON object in the environment variable PRELOAD_ENV:
+- "main": path of the __main__ module of the PluginManager process
+- "plugins": object of plugin module name: path
+Importing the module in the forkserver imports the main module (which
+multiprocessing.forkserver itself does not do for scripts) and the plugin
+modules, so processes forked from it start with all code already imported.
+
+$VERSION
+
+"""
+
+PRELOAD_ENV = "MPPS_PRELOAD"       # defined first, the main module may
+                                    # import mpps.pluginmanager
+import json
+import os
+import traceback
+
+from multiprocessing import process
+from multiprocessing import spawn
+from mpps.discovery import load_module
+
+
+def _preload():
+    try:
+        preload = json.loads(os.environ.get(PRELOAD_ENV, "{}"))
+    except ValueError:
+        return
+    if preload.get("main") is not None:
+        process.current_process()._inheriting = True
+        try:
+            spawn.import_main_path(preload["main"])
+        except Exception:
+            traceback.print_exc()   # imported by every plugin process again
+        finally:
+            del process.current_process()._inheriting
+    for name, path in preload.get("plugins", {}).items():
+        try:
+            load_module(name, path)
+        except Exception:
+            traceback.print_exc()   # the plugin is loaded on start again
+
+
+_preload()
+
+
+if __name__ == "__main__":
+    pass
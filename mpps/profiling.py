@@ -0,0 +1,172 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Opt-in profiling of plugin processes.
+The profile of a plugin run is configured by the "profile" object of the
+plugin's .conf file or the 'profile' argument of PluginManager.run_plugin:
+- "cpu": profiles run() with cProfile, written as <name>.pstats (pstats)
+- "sample": seconds between samples of the stack of run() instead of
+  cProfile, written as <name>.samples in the collapsed stack format of
+  flame graph tools. Cheap enough for long-running plugins.
+- "memory": traces allocations with tracemalloc, written as
+  <name>.tracemalloc (tracemalloc.Snapshot.load)
+- "frames": number of frames stored per allocation, default 1
+- "path": folder of the result files, default is the working directory
+<name> is the plugin name, followed by the replica id for replicas.
+Results are written when the plugin sends 'fin', when run() returns, when
+the plugin is stopped and on PluginManager.profile_snapshot.
+
+$VERSION
+
+"""
+
+import collections
+import cProfile
+import marshal
+import os
+import sys
+import threading
+import tracemalloc
+
+_KEYS = ("cpu", "sample", "memory", "frames", "path")
+
+
+def get_spec(profile):
+    """ Returns the profile configuration 'profile' as dict. True enables
+    cProfile. None, False and an empty dict return None. Raises ValueError
+    for unknown keys. """
+    if profile is None or profile is False:
+        return None
+    if profile is True:
+        return {"cpu": True}
+    if not isinstance(profile, dict):
+        raise ValueError("Profile has to be a dict or True")
+    for key in profile:
+        if key not in _KEYS:
+            raise ValueError("Profile option '" + str(key) +
+                             "' is not defined")
+    if not (profile.get("cpu") or profile.get("sample") or
+            profile.get("memory")):
+        return None
+    return dict(profile)
+
+
+class Sampler:
+    """ Samples the stack of a thread every 'interval' seconds. Frames
+    above the frame 'root' are left out. """
+
+    def __init__(self, interval, thread_id, root=None):
+        self._interval = interval
+        self._thread_id = thread_id
+        self._root = root
+        self._stacks = collections.Counter()
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._done.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._done.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(getattr(code, "co_qualname", code.co_name) +
+                             " (" + os.path.basename(code.co_filename) +
+                             ":" + str(frame.f_lineno) + ")")
+                if frame is self._root:
+                    break
+                frame = frame.f_back
+            if stack:
+                with self._lock:
+                    self._stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with self._lock:
+            stacks = list(self._stacks.items())
+        with open(path, "w") as f:
+            for stack, count in stacks:
+                f.write(stack + " " + str(count) + "\n")
+
+
+class Profiler:
+    """
+    Profiles the plugin process. Created by PluginClass._main with the
+    profile configuration 'spec' and the file name base 'name'. Snapshots
+    requested by the PluginManager are written by the control thread of
+    the plugin. Has to be started in the main thread.
+    """
+
+    def __init__(self, spec, name):
+        self._spec = spec
+        self._base = os.path.join(spec.get("path") or ".", name)
+        self._cprofile = None
+        self._sampler = None
+        self._lock = threading.RLock()     # dump may be interrupted by
+                                            # StopPlugin
+        self._done = threading.Event()
+
+    def start(self):
+        """ Starts profiling. Sampled stacks start at the caller. """
+        if self._spec.get("memory"):
+            tracemalloc.start(self._spec.get("frames") or 1)
+        if self._spec.get("sample"):
+            self._sampler = Sampler(float(self._spec["sample"]),
+                                    threading.get_ident(), sys._getframe(1))
+            self._sampler.start()
+        elif self._spec.get("cpu"):
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def dump(self):
+        """ Writes the results collected so far. The profilers keep
+        running. """
+        with self._lock:
+            if self._cprofile is not None:
+                # snapshot_stats does not disable the profiler like
+                # dump_stats, so it can be called from the control thread
+                self._cprofile.snapshot_stats()
+                self._write(".pstats", self._dump_pstats)
+            if self._sampler is not None:
+                self._write(".samples", self._sampler.dump)
+            if tracemalloc.is_tracing():
+                self._write(".tracemalloc", tracemalloc.take_snapshot().dump)
+
+    def _dump_pstats(self, path):
+        with open(path, "wb") as f:
+            marshal.dump(self._cprofile.stats, f)
+
+    def _write(self, suffix, dump):
+        """ Writes a result file atomically with dump(path) """
+        path = self._base + suffix
+        tmp = path + "." + str(os.getpid())
+        try:
+            dump(tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Writing profile '" + path + "' failed: " + str(e),
+                  file=sys.stderr)
+
+    def stop(self):
+        """ Stops the profilers and writes the results """
+        if self._done.is_set():
+            return
+        self._done.set()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self._sampler is not None:
+            self._sampler.stop()
+        self.dump()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,146 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Helpers for plugins running as several replicas and for the work input
+of running plugins.
+
+$VERSION
+
+"""
+
+import threading
+import time
+
+
+class EndOfWork:
+    """ Marker put into the work channels by WorkQueue.end() """
+    __slots__ = ()
+
+
+class Request:
+    """ Work item sent by PluginManager.request. The plugin answers it with
+    PluginClass.reply. """
+    __slots__ = ("id", "payload")
+
+    def __init__(self, id, payload):
+        self.id = id
+        self.payload = payload
+
+    def __reduce__(self):
+        return (Request, (self.id, self.payload))
+
+
+class ProcessGroup:
+    """
+    Replica processes of one plugin. Provides the subset of the
+    multiprocessing.Process interface used by the PluginManager.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+
+    @property
+    def sentinels(self):
+        return [p.sentinel for p in self.processes]
+
+    def start(self):
+        for p in self.processes:
+            p.start()
+
+    def is_alive(self):
+        """ True while at least one replica is running """
+        return any(p.is_alive() for p in self.processes)
+
+    def join(self, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        for p in self.processes:
+            if deadline is None:
+                p.join()
+            else:
+                p.join(max(0, deadline - time.monotonic()))
+
+    def terminate(self):
+        for p in self.processes:
+            p.terminate()
+
+    def kill(self):
+        for p in self.processes:
+            p.kill()
+
+    @property
+    def exitcode(self):
+        """ None while a replica is running, otherwise the first non-zero
+        exit code or 0 """
+        codes = [p.exitcode for p in self.processes]
+        if None in codes:
+            return None
+        return next((c for c in codes if c), 0)
+
+
+class WorkQueue:
+    """
+    Distributes work items over the work channels of the replicas of a
+    plugin. Items with a key are sharded, the same key always goes to the
+    same replica. Items without key go to the replica with the fewest
+    outstanding items. 'taken' holds shared counters of the items read by
+    each replica, None if there is only one replica.
+    """
+
+    def __init__(self, channels, taken=None):
+        self._channels = channels
+        self._taken = taken
+        self._put = [0] * len(channels)
+        self._lock = threading.Lock()
+
+    def _select(self, key):
+        n = len(self._channels)
+        if n == 1:
+            return 0
+        if key is not None:
+            return hash(key) % n
+        return min(range(n),
+                   key=lambda i: self._put[i] - self._taken[i].value)
+
+    def put(self, item, key=None):
+        """ Sends item to one replica """
+        with self._lock:
+            i = self._select(key)
+            self._put[i] += 1
+        self._channels[i].put(item)
+
+    def end(self):
+        """ Tells all replicas that no more work will be put """
+        for channel in self._channels:
+            channel.put(EndOfWork())
+
+    def handover(self, queue):
+        """ Moves the items no replica has taken to the WorkQueue 'queue' of
+        a new run. The items of replica i go to replica i, so sharded keys
+        stay together if both runs have the same number of replicas.
+        Returns the list of moved items. """
+        moved = []
+        for i, channel in enumerate(self._channels):
+            target = i % len(queue._channels)
+            try:
+                items = channel.get_many(64)
+                while items:
+                    for item in items:
+                        with queue._lock:
+                            queue._put[target] += 1
+                        queue._channels[target].put(item)
+                    moved.extend(items)
+                    items = channel.get_many(64)
+            except Exception:
+                continue        # partially read by a killed replica
+        return moved
+
+    def close(self):
+        for channel in self._channels:
+            channel.close()
+
+
+if __name__ == "__main__":
+    pass
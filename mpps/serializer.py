@@ -0,0 +1,266 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Serializers for the transfers of a plugin channel.
+A Serializer encodes the msgs sent by PluginClass._send into frames, which
+the channel writes one by one, and decodes them again for
+PluginManager.next_msg. The first frame of a transfer is the header, the
+following frames are buffers which are written and read without copying
+them into the header.
+
+Available serializers, selected per plugin by PluginManager.set_serializer:
+- "pickle": default pickling of the channel, no Serializer object (default)
+- "pickle5": pickle protocol 5. Large bytes, bytearray, memoryview and
+  array.array contents are sent as out-of-band buffer frames, single msgs
+  with str or bytes content are encoded without pickling.
+- "json": one JSON line per msg for consumers written in other languages.
+  Contents have to be JSON serializable, bytes-like contents are encoded as
+  {"$bytes": "<base64>"}. Large contents are not placed in shared memory.
+
+$VERSION
+
+"""
+
+import array
+import base64
+import io
+import json
+import pickle
+import struct
+
+from mpps.plugin import MsgClass
+
+_HEAD = struct.Struct("<BI")            # kind, number of buffer frames
+_BUFFER = struct.Struct("<QB")          # size, writable
+# kind, status code, str or bytes content, content in a buffer frame, sent
+# time, replica, length of the issuer
+_MSG = struct.Struct("<BBBBdiH")
+_PICKLED = 0
+_FAST = 1
+
+
+class Serializer:
+    """
+    Encoding of the transfers of a channel. A transfer is one msg or a list
+    of msgs sent by put_many.
+    'shared_memory' is False if the serializer cannot transfer
+    mpps.shm.SharedPayload contents, large contents are sent inline then.
+    """
+    name = None
+    shared_memory = True
+
+    def dumps(self, obj):
+        """ Returns the list of frames of transfer obj, the header first.
+        Frames are bytes-like objects. """
+        raise NotImplementedError
+
+    def buffers(self, header):
+        """ Returns one entry for each buffer frame following 'header': a
+        writable buffer of the frame size to receive the frame into, or None
+        to receive it as bytes """
+        return ()
+
+    def loads(self, header, buffers):
+        """ Returns the transfer encoded by 'header' and its buffer frames
+        """
+        raise NotImplementedError
+
+
+def _restore_view(buffer, format, shape):
+    """ Recreates a memoryview from its buffer frame """
+    if shape:
+        return memoryview(buffer).cast(format, shape)
+    return memoryview(buffer).cast(format)
+
+
+def _restore_array(typecode, buffer):
+    """ Recreates an array.array from its buffer frame """
+    content = array.array(typecode)
+    content.frombytes(buffer)
+    return content
+
+
+class _Pickler(pickle.Pickler):
+    """ Pickler passing large buffers to 'buffers' instead of copying them
+    into the pickle stream """
+
+    def __init__(self, file, buffers, threshold):
+        super().__init__(file, protocol=5, buffer_callback=buffers.append)
+        self._threshold = threshold
+
+    def reducer_override(self, obj):
+        # bytes and bytearray objects never get here, they are passed as
+        # buffers if they are the content of a msg
+        cls = obj.__class__
+        if cls is MsgClass:
+            content = obj.get_content()
+            if (content.__class__ is not bytes and
+                content.__class__ is not bytearray) or \
+               len(content) < self._threshold:
+                return NotImplemented
+            reduced = obj.__reduce__()
+            return (reduced[0], (reduced[1][0], pickle.PickleBuffer(content))
+                    + reduced[1][2:])
+        if cls is memoryview:
+            fmt, shape = obj.format, list(obj.shape)
+            try:
+                memoryview(b"").cast(fmt)
+            except ValueError:
+                fmt, shape = "B", None  # not castable, deliver the raw bytes
+            if obj.nbytes < self._threshold or not obj.c_contiguous:
+                return (_restore_view, (obj.tobytes(), fmt, shape))
+            return (_restore_view, (pickle.PickleBuffer(obj), fmt, shape))
+        if cls is array.array:
+            if obj.itemsize * len(obj) < self._threshold:
+                return NotImplemented
+            return (_restore_array, (obj.typecode, pickle.PickleBuffer(obj)))
+        return NotImplemented
+
+
+class PickleSerializer(Serializer):
+    """
+    Pickle protocol 5 with out-of-band buffers. Buffers of at least
+    'threshold' bytes are sent as frames of their own, smaller ones are
+    copied anyway when the channel writes them.
+    """
+    name = "pickle5"
+
+    def __init__(self, threshold=16384):
+        self._threshold = threshold
+
+    def dumps(self, obj):
+        if obj.__class__ is MsgClass:
+            frames = self._dump_msg(obj)
+            if frames is not None:
+                return frames
+        buffers = []
+        f = io.BytesIO()
+        _Pickler(f, buffers, self._threshold).dump(obj)
+        frames = [None]
+        head = [_HEAD.pack(_PICKLED, len(buffers))]
+        for buffer in buffers:
+            view = buffer.raw()
+            head.append(_BUFFER.pack(view.nbytes, not view.readonly))
+            frames.append(view)
+        head.append(f.getbuffer())
+        frames[0] = b"".join(head)
+        return frames
+
+    def _dump_msg(self, msg):
+        """ Fast path for a msg with str or bytes content. Returns None if
+        the msg has to be pickled. """
+        content, status = msg.get_content(), msg.get_status()
+        if content.__class__ is str:
+            data, text = content.encode(), True
+        elif content.__class__ is bytes:
+            data, text = content, False
+        else:
+            return None
+        if status not in MsgClass._codes or \
+           msg.get_issuer().__class__ is not str:
+            return None
+        issuer = msg.get_issuer().encode()
+        replica, sent = msg.get_replica(), msg.get_sent_time()
+        if len(issuer) > 0xffff or \
+           (replica is not None and not 0 <= replica < 2 ** 31):
+            return None
+        separate = len(data) >= self._threshold
+        head = _MSG.pack(_FAST, MsgClass._codes.index(status), text,
+                         separate, float("nan") if sent is None else sent,
+                         -1 if replica is None else replica, len(issuer))
+        if separate:
+            return [head + issuer, data]
+        return [head + issuer + data]
+
+    def buffers(self, header):
+        if header[0] == _FAST:
+            return [None] if header[3] else []
+        targets = []
+        offset = _HEAD.size
+        for i in range(_HEAD.unpack_from(header)[1]):
+            size, writable = _BUFFER.unpack_from(header, offset)
+            targets.append(bytearray(size) if writable else None)
+            offset += _BUFFER.size
+        return targets
+
+    def loads(self, header, buffers):
+        if header[0] == _FAST:
+            kind, status, text, separate, sent, replica, n = \
+                _MSG.unpack_from(header)
+            offset = _MSG.size + n
+            issuer = str(header[_MSG.size:offset], "utf-8")
+            data = buffers[0] if separate else header[offset:]
+            return MsgClass(MsgClass._codes[status],
+                            str(data, "utf-8") if text else bytes(data),
+                            issuer, None if replica < 0 else replica,
+                            None if sent != sent else sent)
+        offset = _HEAD.size + len(buffers) * _BUFFER.size
+        return pickle.loads(memoryview(header)[offset:], buffers=buffers)
+
+
+def _json_default(content):
+    try:
+        view = memoryview(content)
+    except TypeError:
+        raise TypeError("Content of type '" + type(content).__name__ +
+                        "' is not JSON serializable") from None
+    return {"$bytes": base64.b64encode(view.cast("B")).decode("ascii")}
+
+
+def _json_hook(obj):
+    if len(obj) == 1 and "$bytes" in obj:
+        return base64.b64decode(obj["$bytes"])
+    return obj
+
+
+class JSONSerializer(Serializer):
+    """ Encodes a transfer as JSON lines, one object with the keys status,
+    content, issuer, replica and sent per msg """
+    name = "json"
+    shared_memory = False
+
+    def dumps(self, obj):
+        if not isinstance(obj, list):
+            obj = [obj]
+        lines = []
+        for msg in obj:
+            if not isinstance(msg, MsgClass):
+                raise TypeError("Serializer 'json' only transfers msgs")
+            lines.append(json.dumps(
+                {"status": msg.get_status(), "content": msg.get_content(),
+                 "issuer": msg.get_issuer(), "replica": msg.get_replica(),
+                 "sent": msg.get_sent_time()},
+                separators=(",", ":"), default=_json_default))
+        lines.append("")
+        return ["\n".join(lines).encode()]
+
+    def loads(self, header, buffers):
+        msgs = []
+        for line in bytes(header).splitlines():
+            entry = json.loads(line, object_hook=_json_hook)
+            msgs.append(MsgClass(entry["status"], entry["content"],
+                                 entry["issuer"], entry["replica"],
+                                 entry["sent"]))
+        return msgs
+
+
+SERIALIZERS = {"pickle": None,
+               "pickle5": PickleSerializer,
+               "json": JSONSerializer}
+
+
+def get_serializer(serializer):
+    """ Returns a Serializer object, None for the default pickling.
+    'serializer' is either an instance of 'Serializer' or the name of one
+    of the serializers in SERIALIZERS. """
+    if serializer is None or isinstance(serializer, Serializer):
+        return serializer
+    if serializer in SERIALIZERS:
+        cls = SERIALIZERS[serializer]
+        return None if cls is None else cls()
+    raise ValueError("Serializer '" + str(serializer) + "' is not defined")
+
+
+if __name__ == "__main__":
+    pass
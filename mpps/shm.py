@@ -0,0 +1,138 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Shared memory payloads for large message contents.
+The sending plugin copies a large buffer once into a new
+multiprocessing.shared_memory segment and only sends a SharedPayload handle.
+The reading channel attaches the segment and hands a memoryview to the
+consumer.
+
+Lifetime: a segment belongs to the reading side as soon as the handle is
+sent. It is unlinked when the message is released with MsgClass.release()
+or, at the latest, when the channel of the plugin is closed by
+PluginManager.stop_plugin. Segments of messages which were exported but not
+sent when the plugin stops are unlinked by Channel.discard_unsent.
+
+$VERSION
+
+"""
+
+import os
+import threading
+
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+
+class SharedPayload:
+    """ Handle of a message content placed in a shared memory segment """
+    __slots__ = ("name", "size", "format", "shape")
+
+    def __init__(self, name, size, format="B", shape=None):
+        self.name = name
+        self.size = size
+        self.format = format
+        self.shape = shape
+
+    def __reduce__(self):
+        return (SharedPayload, (self.name, self.size, self.format,
+                                self.shape))
+
+
+class Segment:
+    """
+    Shared memory segment attached by the reading side. Attached segments
+    are stored in 'registry' until they are released.
+    """
+
+    def __init__(self, payload, registry):
+        self._shm = shared_memory.SharedMemory(payload.name)
+        self._view = self._shm.buf[:payload.size]
+        if payload.shape is not None:
+            self._view = self._view.cast(payload.format, payload.shape)
+        elif payload.format != "B":
+            self._view = self._view.cast(payload.format)
+        self._registry = registry
+        registry[payload.name] = self
+
+    def view(self):
+        """ Returns the memoryview of the payload """
+        return self._view
+
+    def release(self):
+        """ Detaches and unlinks the segment. The memoryview is invalid
+        afterwards. """
+        if self._shm is None:
+            return
+        self._registry.pop(self._shm.name, None)
+        try:
+            self._view.release()
+            self._shm.close()
+        except BufferError:
+            pass        # views derived from the payload keep the mapping
+        self._shm.unlink()
+        self._shm = None
+
+
+def export(content, threshold):
+    """
+    Places content in a new shared memory segment if it is a C-contiguous
+    buffer (bytes, bytearray, memoryview, array.array, ...) of at least
+    'threshold' bytes. Returns the SharedPayload handle or content itself.
+    """
+    if threshold is None or isinstance(content, str):
+        return content
+    try:
+        view = memoryview(content)
+    except TypeError:
+        return content
+    if view.nbytes < threshold or not view.c_contiguous:
+        return content
+    fmt, shape = view.format, None
+    if view.ndim > 1:
+        shape = list(view.shape)
+    try:
+        memoryview(b"").cast(fmt)
+    except ValueError:
+        fmt, shape = "B", None      # not castable, deliver the raw bytes
+    shm = shared_memory.SharedMemory(create=True, size=view.nbytes)
+    shm.buf[:view.nbytes] = view.cast("B")
+    payload = SharedPayload(shm.name, view.nbytes, fmt, shape)
+    # the reading side owns the segment, the resource tracker of this
+    # process must not unlink it on exit
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return payload
+
+
+def discard(content):
+    """ Unlinks the segment of a SharedPayload which is not sent, e.g. the
+    content of a dropped message. Does nothing for other contents. """
+    if not isinstance(content, SharedPayload):
+        return
+    try:
+        shm = shared_memory.SharedMemory(content.name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _after_fork():
+    """ Another thread of the parent may have held the lock of the resource
+    tracker while this process was forked. The forked plugin process would
+    block forever on its first shared memory segment. """
+    tracker = resource_tracker._resource_tracker
+    if isinstance(tracker._lock, type(threading.RLock())):
+        tracker._lock = threading.RLock()
+    else:
+        tracker._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+if __name__ == "__main__":
+    pass
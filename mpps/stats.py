@@ -0,0 +1,320 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Runtime metrics of plugin runs.
+Every msg put on the message channel of a plugin is counted per status in a
+shared memory segment by the sending process, every msg read is counted by
+the PluginManager. The difference is the queue depth. The time from
+PluginClass._send to the read (MsgClass.get_sent_time) and the execution
+time of callbacks are collected in histograms with fixed buckets. Counting
+costs a few integer operations per msg, so the metrics are always enabled
+unless the PluginManager is created with stats=False.
+
+$VERSION
+
+"""
+
+import bisect
+import os
+import threading
+import time
+import weakref
+
+from multiprocessing import shared_memory
+from mpps.plugin import MsgClass
+from mpps.shm import SharedPayload
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+           0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STATUSES = MsgClass._codes[1:]
+_INDEX = {status: i for i, status in enumerate(MsgClass._codes)}
+_WIDTH = 2 * len(MsgClass._codes)   # msgs and bytes of every status code
+
+try:
+    _TICKS = os.sysconf("SC_CLK_TCK")
+    _PAGE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _TICKS = _PAGE = None
+
+
+def _size(content):
+    """ Size in bytes of str, bytes-like and shared memory contents, 0 for
+    other contents """
+    cls = content.__class__
+    if cls is str or cls is bytes or cls is bytearray:
+        return len(content)
+    if cls is memoryview:
+        return content.nbytes
+    if cls is SharedPayload:
+        return content.size
+    return 0
+
+
+class Histogram:
+    """ Histogram of values in seconds with the upper bounds BUCKETS """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """ Returns a dict with the cumulative 'buckets' as list of
+        (upper bound, count), 'sum' and 'count' """
+        buckets = []
+        total = 0
+        for le, n in zip(BUCKETS + (float("inf"),), self.counts):
+            total += n
+            buckets.append((le, total))
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+_instances = weakref.WeakSet()      # PluginStats of this process
+
+
+def _after_fork():
+    """ get_stats may have held the lock of a PluginStats in another thread
+    of the parent while a plugin process was forked, e.g. by the supervisor.
+    The plugin would block forever on its first send. """
+    for stats in list(_instances):
+        stats._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class PluginStats:
+    """
+    Metrics of one plugin run. The PluginManager sets it on the message
+    channel of the plugin (Channel.set_stats), so it is pickled along with
+    the channel to the plugin process. Only the name of the counter segment
+    is pickled, the plugin process attaches it on the first send.
+    'slots' is the number of replicas, every replica counts in its own row.
+    """
+
+    def __init__(self, slots=1):
+        self._slots = slots
+        self._size = slots * _WIDTH * 8
+        self._shm = shared_memory.SharedMemory(create=True, size=self._size)
+        self._name = self._shm.name
+        self._view = self._shm.buf[:self._size].cast("Q")
+        self._owner = True
+        self._init()
+
+    def _init(self):
+        self._lock = threading.Lock()
+        _instances.add(self)
+        self._closed = False
+        self._final = None                  # sent counters after close()
+        self._received = [0] * _WIDTH
+        self.latency = Histogram()
+        self.callbacks = Histogram()
+
+    def __getstate__(self):
+        return {"_slots": self._slots, "_size": self._size,
+                "_name": self._name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = None
+        self._view = None
+        self._owner = False
+        self._init()
+
+    def _attach(self):
+        try:
+            self._shm = shared_memory.SharedMemory(self._name)
+        except OSError:
+            self._closed = True             # run already stopped
+            return
+        self._view = self._shm.buf[:self._size].cast("Q")
+
+    def sent(self, msgs):
+        """ Counts msgs put on the channel. Called by the sending process.
+        """
+        with self._lock:
+            if self._view is None:
+                if self._closed:
+                    return
+                self._attach()
+                if self._closed:
+                    return
+            view = self._view
+            for msg in msgs:
+                i = 2 * _INDEX.get(msg._status, 0)
+                if msg._replica:
+                    i += (msg._replica % self._slots) * _WIDTH
+                view[i] += 1
+                view[i + 1] += _size(msg._content)
+
+    def received(self, msgs):
+        """ Counts msgs read from the channel and their latency. Called by
+        the reading side with the channel lock held. """
+        if not msgs:
+            return
+        now = time.monotonic()
+        received = self._received
+        latency = self.latency
+        for msg in msgs:
+            i = 2 * _INDEX.get(msg._status, 0)
+            received[i] += 1
+            received[i + 1] += _size(msg._content)
+            if msg._sent is not None:
+                # Histogram.observe inlined, this runs for every msg
+                value = now - msg._sent
+                latency.counts[bisect.bisect_left(BUCKETS, value)] += 1
+                latency.sum += value
+                latency.count += 1
+
+    def callback(self, seconds):
+        """ Records the execution time of a callback """
+        self.callbacks.observe(seconds)
+
+    def _sent(self):
+        """ Sent msgs and bytes per status code, summed over the replicas
+        """
+        with self._lock:
+            if self._final is not None:
+                return self._final
+            counts = [0] * _WIDTH
+            if self._view is not None:
+                for slot in range(self._slots):
+                    row = self._view[slot * _WIDTH:(slot + 1) * _WIDTH]
+                    counts = [a + b for a, b in zip(counts, row)]
+            return counts
+
+    def snapshot(self):
+        """ Returns the counters as dict, see PluginManager.get_stats """
+        sent = self._sent()
+        received = list(self._received)
+        depth = sum(sent[0::2]) - sum(received[0::2])
+        return {
+            "sent": {s: (sent[2 * i + 2], sent[2 * i + 3])
+                     for i, s in enumerate(STATUSES)},
+            "received": {s: (received[2 * i + 2], received[2 * i + 3])
+                         for i, s in enumerate(STATUSES)},
+            "depth": max(0, depth),
+            "latency": self.latency.snapshot(),
+            "callbacks": self.callbacks.snapshot()}
+
+    def close(self):
+        """ Keeps the final counters and frees the segment. The creating
+        process unlinks it. """
+        self._final = self._sent()
+        with self._lock:
+            self._closed = True
+            self._detach()
+
+    def _detach(self):
+        if self._view is None:
+            return
+        self._view.release()        # the segment cannot be closed before
+        self._view = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __del__(self):
+        if self._view is not None and not self._owner:
+            self._detach()
+
+
+def process_usage(pids):
+    """ Returns the tuple (CPU seconds, RSS bytes) of the processes 'pids'
+    read from /proc. (None, None) if not available. """
+    if _TICKS is None:
+        return None, None
+    cpu = 0.0
+    rss = 0
+    try:
+        for pid in pids:
+            with open("/proc/" + str(pid) + "/stat", "rb") as f:
+                fields = f.read().rsplit(b")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / _TICKS
+            with open("/proc/" + str(pid) + "/statm", "rb") as f:
+                rss += int(f.read().split()[1]) * _PAGE
+    except (OSError, ValueError, IndexError):
+        return None, None
+    return cpu, rss
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace(
+            "\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(k + "=\"" + escape(v) + "\""
+                          for k, v in labels.items()) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+
+def format_stats(stats):
+    """ Returns the dict of PluginManager.get_stats() in the Prometheus
+    text exposition format """
+    out = []
+
+    def header(name, kind, text):
+        out.append("# HELP " + name + " " + text)
+        out.append("# TYPE " + name + " " + kind)
+
+    def sample(name, value, **labels):
+        if value is not None:
+            out.append(name + _labels(**labels) + " " + _number(value))
+
+    for direction in ("sent", "received"):
+        for i, unit in enumerate(("messages", "bytes")):
+            name = "mpps_" + unit + "_" + direction + "_total"
+            header(name, "counter", unit.capitalize() + " " + direction +
+                   " per plugin and status")
+            for plugin, s in stats.items():
+                for status, counts in s[direction].items():
+                    sample(name, counts[i], plugin=plugin, status=status)
+    for name, key, kind, text in (
+            ("mpps_queue_depth", "depth", "gauge",
+             "Messages sent but not read yet"),
+            ("mpps_messages_dropped_total", "dropped", "counter",
+             "Messages dropped because of the capacity"),
+            ("mpps_cpu_seconds_total", "cpu", "counter",
+             "CPU time of the plugin processes"),
+            ("mpps_resident_memory_bytes", "rss", "gauge",
+             "Resident memory of the plugin processes"),
+            ("mpps_running", "running", "gauge",
+             "1 if the plugin is running"),
+            ("mpps_restarts_total", "restarts", "counter",
+             "Restarts of the plugin processes by the supervisor")):
+        header(name, kind, text)
+        for plugin, s in stats.items():
+            sample(name, int(s[key]) if isinstance(s[key], bool)
+                   else s[key], plugin=plugin)
+    for name, key, text in (
+            ("mpps_latency_seconds", "latency",
+             "Time from PluginClass._send to the read of a message"),
+            ("mpps_callback_seconds", "callbacks",
+             "Execution time of callbacks")):
+        header(name, "histogram", text)
+        for plugin, s in stats.items():
+            for le, count in s[key]["buckets"]:
+                sample(name + "_bucket", count, plugin=plugin,
+                       le=_number(le))
+            sample(name + "_sum", s[key]["sum"], plugin=plugin)
+            sample(name + "_count", s[key]["count"], plugin=plugin)
+    return "\n".join(out) + "\n"
+
+
+if __name__ == "__main__":
+    pass
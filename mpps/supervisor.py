@@ -0,0 +1,361 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Supervision of plugin processes.
+The Supervisor thread of a PluginManager waits for the process sentinels of
+supervised plugins and checks their heartbeats. When the processes of a
+plugin end or hang, the PluginManager appends a 'term' or 'err' msg to the
+msgs of the plugin and, depending on the restart policy, starts new
+processes with exponential backoff. Restarted processes use the channels
+of the run, so consumers keep reading the same msg stream.
+
+$VERSION
+
+"""
+
+import threading
+import time
+import weakref
+
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+from mpps.transport import Wakeup
+
+RESTART = ("never", "on-failure", "always")
+
+_IDLE = float("inf")
+
+
+class Policy:
+    """
+    Supervision options of a plugin, see PluginManager.set_supervision.
+    Raises ValueError for invalid options.
+    """
+
+    def __init__(self, restart="never", timeout=None, max_restarts=None,
+                 backoff=0.1, max_backoff=30.0, stable=60.0):
+        if restart not in RESTART:
+            raise ValueError("Restart policy '" + str(restart) +
+                             "' is not defined")
+        if timeout is not None and timeout <= 0:
+            raise ValueError("Timeout has to be positive")
+        if max_restarts is not None and max_restarts < 0:
+            raise ValueError("Restarts have to be at least 0")
+        if backoff < 0 or max_backoff < backoff:
+            raise ValueError("Backoff has to be between 0 and max_backoff")
+        self.restart = restart
+        self.timeout = timeout
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable = stable
+
+    def restarts(self, failed):
+        """ True if a run which ended (failed or not) is restarted """
+        return self.restart == "always" or \
+            (failed and self.restart == "on-failure")
+
+    def delay(self, restarts):
+        """ Seconds before the restart after 'restarts' consecutive
+        restarts """
+        return min(self.max_backoff, self.backoff * 2 ** restarts)
+
+
+class Heartbeat:
+    """
+    Time of the last sign of life of every replica of a plugin run, kept in
+    a shared memory segment. Only the name of the segment is pickled, the
+    plugin process attaches it on the first beat. A replica waiting for
+    input is marked idle and never considered hung.
+    """
+
+    def __init__(self, slots=1):
+        self._slots = slots
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * 8)
+        self._name = self._shm.name
+        self._view = self._shm.buf[:slots * 8].cast("d")
+        self._owner = True
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        return {"_slots": self._slots, "_name": self._name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = None
+        self._view = None
+        self._owner = False
+        self._lock = threading.Lock()
+
+    def _attach(self):
+        with self._lock:
+            if self._view is None and self._name is not None:
+                try:
+                    self._shm = shared_memory.SharedMemory(self._name)
+                except OSError:
+                    self._name = None       # run already stopped
+                    return None
+                self._view = self._shm.buf[:self._slots * 8].cast("d")
+            return self._view
+
+    def beat(self, slot=0, now=None):
+        """ Records a sign of life of replica 'slot' at time.monotonic()
+        'now' """
+        view = self._view or self._attach()
+        if view is not None:
+            view[slot] = time.monotonic() if now is None else now
+
+    def idle(self, slot=0):
+        """ Marks replica 'slot' as waiting for input until the next beat
+        """
+        view = self._view or self._attach()
+        if view is not None:
+            view[slot] = _IDLE
+
+    def silent(self, slot, since):
+        """ Seconds without a beat of replica 'slot', counted from 'since'
+        at the latest. 0 for idle replicas. """
+        last = self._view[slot]
+        if last == _IDLE:
+            return 0
+        return time.monotonic() - max(last, since)
+
+    def reset(self):
+        for slot in range(self._slots):
+            self._view[slot] = 0.0
+
+    def close(self):
+        """ Frees the segment. The creating process unlinks it. """
+        with self._lock:
+            self._name = None
+            self._detach()
+
+    def _detach(self):
+        if self._view is None:
+            return
+        self._view.release()
+        self._view = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __del__(self):
+        if self._view is not None and not self._owner:
+            self._detach()
+
+
+def _members(process):
+    """ The processes of a multiprocessing.Process, mpps.workerpool
+    PooledProcess or mpps.replica.ProcessGroup """
+    return getattr(process, "processes", [process])
+
+
+class _Watch:
+    """ A supervised plugin run """
+
+    def __init__(self, plugin, process, plugins, heartbeat, policy):
+        self.plugin = plugin
+        self.process = process
+        self.plugins = plugins
+        self.heartbeat = heartbeat
+        self.policy = policy
+        self.started = time.monotonic()
+        self.restarts = 0               # consecutive restarts
+        self.restart_at = None
+
+
+class Supervisor:
+    """
+    Watches the supervised plugins of a PluginManager in a daemon thread.
+    Only holds a weak reference to the manager, which calls
+    PluginManager._inject, _fail_requests and _relaunch with the lock of
+    the Supervisor held.
+    """
+    _KILL_TIMEOUT = 1       # seconds between terminate and kill of hangs
+
+    def __init__(self, manager):
+        self._manager = weakref.ref(manager)
+        self._watches = {}
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._wakeup = Wakeup()
+        self._closed = False
+        self._thread = threading.Thread(target=self._main, daemon=True,
+                                        name="mpps-supervisor")
+        self._thread.start()
+
+    def watch(self, plugin, process, plugins, heartbeat, policy):
+        """ Supervises a started plugin. 'plugins' are the PluginClass
+        objects of the processes, used for restarts. """
+        with self._lock:
+            self._watches[plugin] = _Watch(plugin, process, plugins,
+                                           heartbeat, policy)
+            self._totals[plugin] = 0
+        self._wakeup.set()
+
+    def unwatch(self, plugin):
+        """ Ends the supervision of a plugin. Waits until a restart in
+        progress is finished. """
+        with self._lock:
+            watch = self._watches.pop(plugin, None)
+        if watch is not None and watch.heartbeat is not None:
+            watch.heartbeat.close()
+        self._wakeup.set()
+
+    def watches(self, plugin):
+        """ True while a plugin is supervised, including the time until it
+        is restarted """
+        return plugin in self._watches
+
+    def restarts(self, plugin):
+        """ Number of restarts of the current or last run of plugin """
+        return self._totals.get(plugin, 0)
+
+    def close(self):
+        """ Stops the supervisor thread """
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+            self._wakeup.close()
+
+    def _main(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                watches = list(self._watches.values())
+            waitables = [self._wakeup]
+            timeout = None
+            now = time.monotonic()
+            for watch in watches:
+                deadline = watch.restart_at
+                if deadline is None:
+                    for p in _members(watch.process):
+                        if p.exitcode is None:
+                            waitables.append(p.sentinel)
+                    if watch.heartbeat is not None:
+                        # checked twice per timeout
+                        deadline = now + watch.policy.timeout / 2
+                if deadline is not None:
+                    delay = max(0, deadline - now)
+                    if timeout is None or delay < timeout:
+                        timeout = delay
+            try:
+                ready = wait(waitables, timeout)
+            except (OSError, ValueError):
+                ready = []                  # process of a stopped plugin
+            if self._wakeup in ready:
+                self._wakeup.clear()
+            manager = self._manager()
+            if manager is None:
+                return
+            with self._lock:
+                for watch in list(self._watches.values()):
+                    if not self._closed:
+                        self._check(manager, watch)
+            manager = None
+
+    def _check(self, manager, watch):
+        """ Handles the end or hang of a plugin run and due restarts.
+        Requires self._lock. """
+        plugin = watch.plugin
+        if watch.restart_at is not None:
+            if time.monotonic() >= watch.restart_at:
+                self._restart(manager, watch)
+            return
+        members = _members(watch.process)
+        for p in members:
+            if p.exitcode is None and wait([p.sentinel], 0):
+                # the sentinel is ready before the exit code
+                p.join()
+        name = "Plugin '" + plugin + "'"
+        codes = [p.exitcode for p in members]
+        failed = [(i, c) for i, c in enumerate(codes) if c]
+        if failed:
+            i, code = failed[0]
+            if len(members) > 1:
+                name = "Replica " + str(i) + " of plugin '" + plugin + "'"
+            if code < 0:
+                text = name + " was killed by signal " + str(-code) + "."
+            else:
+                text = name + " died with exit code " + str(code) + "."
+            manager._inject(plugin, "err", text)
+        elif None not in codes:
+            manager._inject(plugin, "term", name + " exited.")
+        elif watch.heartbeat is not None and self._hung(watch, members):
+            manager._inject(plugin, "err", name + " sent no heartbeat for " +
+                            str(watch.policy.timeout) + " seconds.")
+            failed = True
+        else:
+            return
+        self._end(watch)
+        manager._fail_requests(plugin, name + " ended.")
+        policy = watch.policy
+        if time.monotonic() - watch.started >= policy.stable:
+            watch.restarts = 0
+        if not policy.restarts(bool(failed)):
+            self._drop(watch)
+        elif policy.max_restarts is not None and \
+                watch.restarts >= policy.max_restarts:
+            manager._inject(plugin, "err", "Plugin '" + plugin +
+                            "' was restarted " + str(watch.restarts) +
+                            " times, giving up.")
+            self._drop(watch)
+        else:
+            watch.restart_at = time.monotonic() + \
+                policy.delay(watch.restarts)
+
+    def _hung(self, watch, members):
+        for slot, p in enumerate(members):
+            if p.exitcode is None and getattr(p, "pid", 0) is not None and \
+               watch.heartbeat.silent(slot, watch.started) > \
+               watch.policy.timeout:
+                return True
+        return False
+
+    def _end(self, watch):
+        """ Terminates the remaining processes of a run, kills them if they
+        do not end in time and joins them """
+        process = watch.process
+        if process.exitcode is None:
+            process.terminate()
+            process.join(self._KILL_TIMEOUT)
+            if any(p.exitcode is None for p in _members(process)):
+                process.kill()
+        process.join()
+
+    def _restart(self, manager, watch):
+        watch.restart_at = None
+        if watch.heartbeat is not None:
+            watch.heartbeat.reset()
+        manager._inject(watch.plugin, "notify", "Restarted")
+        try:
+            process = manager._relaunch(watch.plugin, watch.process,
+                                        watch.plugins)
+        except Exception as e:
+            manager._inject(watch.plugin, "err", "Restart of plugin '" +
+                            watch.plugin + "' failed: " + str(e))
+            process = None
+        if process is None:
+            self._drop(watch)
+            return
+        watch.process = process
+        watch.started = time.monotonic()
+        watch.restarts += 1
+        self._totals[watch.plugin] += 1
+
+    def _drop(self, watch):
+        """ Ends the supervision of a run which is not restarted. Requires
+        self._lock. """
+        self._watches.pop(watch.plugin, None)
+        if watch.heartbeat is not None:
+            watch.heartbeat.close()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,532 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Transport backends for the plugin <-> PluginManager communication.
+A Transport creates one Channel per plugin run. The Channel is handed to
+the plugin as 'com' and provides the queue-like interface used by
+PluginClass._send and PluginManager.next_msg. Reverse channels carry work
+items from the PluginManager to the plugin.
+
+Transfers are pickled by the channel unless a mpps.serializer.Serializer
+is set, which encodes them into frames written one by one.
+
+Available backends:
+- "pipe": native multiprocessing.Pipe per plugin run, no server process and
+  no proxy round-trip (default)
+- "manager": proxied queue.Queue objects of a single SyncManager which is
+  shared by all plugins of a PluginManager
+
+$VERSION
+
+"""
+
+import collections
+import multiprocessing
+import os
+import threading
+
+from queue import Empty
+from mpps.plugin import MsgClass
+from mpps.shm import Segment
+from mpps.shm import SharedPayload
+from mpps.shm import discard
+from mpps.shm import export
+
+
+class Channel:
+    """
+    Connection between one running plugin and the PluginManager.
+    Messages are put by the plugin process and read by the PluginManager,
+    the other way round for reverse channels.
+    A transfer contains either one msg or a list of msgs sent by put_many.
+    Lists are unpacked into a local backlog on the reading side, so get and
+    get_many always return single msgs in the order they were sent.
+    Shared memory payloads are attached while unpacking and released at
+    the latest when the channel is closed. On the writing side, payloads
+    created by export are unlinked by discard_unsent until they are put.
+    With a mpps.journal.Journal, the received msgs are kept in the journal
+    instead of the backlog.
+    """
+    _flow = None
+    _stats = None
+    _serializer = None
+    _journal = None
+    _ready = None
+
+    def __init__(self):
+        self._backlog = collections.deque()
+        self._rlock = threading.Lock()
+        self._segments = {}
+        self._unsent = set()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_backlog")
+        state.pop("_rlock")
+        state.pop("_segments")
+        state.pop("_unsent")
+        state.pop("_journal", None)
+        state.pop("_ready", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._backlog = collections.deque()
+        self._rlock = threading.Lock()
+        self._segments = {}
+        self._unsent = set()
+
+    def _put(self, obj):
+        """ Transfers obj to the reading side """
+        raise NotImplementedError
+
+    def _get(self, block, timeout):
+        """ Returns the next transfer. Raises queue.Empty if there is none.
+        """
+        raise NotImplementedError
+
+    def _unpack(self, obj):
+        if not isinstance(obj, list):
+            obj = [obj]
+        for msg in obj:
+            if isinstance(msg, MsgClass) and \
+               isinstance(msg.get_content(), SharedPayload):
+                msg.set_segment(Segment(msg.get_content(), self._segments))
+        self._backlog.extend(obj)
+        if self._ready is not None:
+            self._ready.set()
+
+    def _consumed(self, msgs):
+        """ Called with the msgs returned by get and get_many """
+        if self._ready is not None and not self._backlog:
+            self._ready.clear()
+        if self._flow is not None:
+            self._flow.consumed(msgs)
+        if self._stats is not None:
+            self._stats.received(msgs)
+
+    def put(self, msg):
+        """ Sends msg to the reading side """
+        if self._stats is not None:
+            self._stats.sent((msg,))
+        self._put(msg)
+        if self._unsent:
+            self._sent((msg,))
+
+    def put_many(self, msgs):
+        """ Sends all msgs in one transfer. The order is preserved. """
+        msgs = list(msgs)
+        if msgs:
+            if self._stats is not None:
+                self._stats.sent(msgs)
+            self._put(msgs)
+            if self._unsent:
+                self._sent(msgs)
+
+    def _sent(self, msgs):
+        """ The reading side owns the payloads of put msgs """
+        for msg in msgs:
+            if isinstance(msg, MsgClass):
+                self._unsent.discard(msg.get_content())
+
+    def export(self, content, threshold):
+        """ Returns content placed in shared memory by mpps.shm.export, or
+        content itself. The segment belongs to the writing side until the
+        msg carrying it is put. """
+        content = export(content, threshold)
+        if isinstance(content, SharedPayload):
+            self._unsent.add(content)
+        return content
+
+    def discard(self, content):
+        """ Unlinks the segment of an exported content which will not be
+        put, e.g. of a dropped msg """
+        self._unsent.discard(content)
+        discard(content)
+
+    def discard_unsent(self):
+        """ Unlinks the segments of all exported contents which were not
+        put, e.g. when the plugin was stopped while sending """
+        while self._unsent:
+            discard(self._unsent.pop())
+
+    def get_nowait(self):
+        """ Returns the next msg. Raises queue.Empty if there is none. """
+        return self.get(False)
+
+    def get(self, block=True, timeout=None):
+        """ Returns the next msg. Blocks up to 'timeout' seconds if 'block'
+        is set. Raises queue.Empty if there is no msg. """
+        with self._rlock:
+            if not self._backlog:
+                self._unpack(self._get(block, timeout))
+            msg = self._backlog.popleft()
+            self._consumed((msg,))
+        return msg
+
+    def get_many(self, max_n):
+        """ Returns a list of up to max_n msgs which are available without
+        blocking. The list is empty if there is no msg. """
+        msgs = []
+        with self._rlock:
+            while len(msgs) < max_n:
+                if not self._backlog:
+                    try:
+                        self._unpack(self._get(False, None))
+                    except Empty:
+                        break
+                msgs.append(self._backlog.popleft())
+            self._consumed(msgs)
+        return msgs
+
+    def prefetch(self):
+        """ Moves all transfers available without blocking to the backlog,
+        so the writer does not block on a full channel. The msgs are read as
+        usual. """
+        with self._rlock:
+            self._prefetch()
+
+    def _prefetch(self):
+        while True:
+            try:
+                self._unpack(self._get(False, None))
+            except Empty:
+                return
+
+    def inject(self, msg):
+        """ Appends msg to the reading side after all msgs transferred so
+        far. Used by the PluginManager for its own msgs about a plugin.
+        Msgs written by other processes meanwhile may come first. """
+        with self._rlock:
+            self._prefetch()
+            if self._stats is not None:
+                self._stats.sent((msg,))
+            self._backlog.append(msg)
+            if self._ready is not None:
+                self._ready.set()
+
+    def adopt(self, msgs):
+        """ Puts msgs in front of all msgs not read yet. Used by the
+        PluginManager for the unread msgs of a replaced plugin run. Not
+        supported with a journal. """
+        with self._rlock:
+            if self._stats is not None:
+                self._stats.sent(msgs)
+            self._backlog.extendleft(reversed(msgs))
+            if self._ready is not None and self._backlog:
+                self._ready.set()
+
+    def reset_writer(self):
+        """ Called before a new writer process is started after the
+        previous ones ended """
+        pass
+
+    def set_flow(self, flow):
+        """ Reports read msgs to the mpps.flow.FlowControl 'flow' """
+        self._flow = flow
+
+    def set_stats(self, stats):
+        """ Counts sent and read msgs in the mpps.stats.PluginStats 'stats'
+        """
+        self._stats = stats
+
+    def set_serializer(self, serializer):
+        """ Encodes the transfers with the mpps.serializer.Serializer
+        'serializer', None pickles them. Has to be set before the channel is
+        used. """
+        self._serializer = serializer
+
+    def set_journal(self, journal):
+        """ Keeps the received msgs in the mpps.journal.Journal 'journal',
+        which may be shared with the channels of later runs of the plugin.
+        None keeps them in memory. Has to be set before the channel is used.
+        """
+        self._journal = journal
+        self._backlog = collections.deque() if journal is None else journal
+
+    def get_journal(self):
+        return self._journal
+
+    def set_spooled(self):
+        """ Lets a reader thread prefetch the transfers of the channel into
+        the backlog, see PluginManager._spool_worker. waitable() is ready
+        while msgs wait in the backlog then. Only channels with a source()
+        are spooled, channels with a journal always are. Has to be set
+        before the channel is used. """
+        if self.source() is not None and self._journal is None and \
+           self._ready is None:
+            self._ready = Wakeup()
+
+    def spooled(self):
+        """ True if the transfers are prefetched by a reader thread, into
+        the backlog or the journal """
+        return self._journal is not None or self._ready is not None
+
+    def shared_memory(self):
+        """ True if contents may be sent as mpps.shm.SharedPayload """
+        return self._serializer is None or self._serializer.shared_memory
+
+    def pending(self):
+        """ True if already received msgs are waiting in the backlog """
+        return len(self._backlog) != 0
+
+    def waitable(self):
+        """ Returns an object usable with multiprocessing.connection.wait
+        which becomes ready when a msg arrives, or is ready while unread
+        msgs wait in the journal or the backlog of a spooled channel. None
+        if the channel has to be polled. """
+        if self._journal is not None:
+            return self._journal.waitable()
+        if self._ready is not None:
+            return self._ready
+        return self.source()
+
+    def source(self):
+        """ Like waitable, but ready when a transfer arrives, also with a
+        journal. Used to move transfers into the journal. """
+        return None
+
+    def close(self):
+        """ Frees all resources held by the channel. Shared memory payloads
+        of unread and unreleased msgs are unlinked. With a journal, the
+        transfers not received yet are moved to the journal first, the
+        unread msgs stay there. """
+        if self._journal is not None:
+            with self._rlock:
+                try:
+                    self._prefetch()
+                except (EOFError, OSError):
+                    pass
+                self.set_journal(None)
+        try:
+            while self.get_many(64):
+                pass
+        except (EOFError, OSError):
+            pass
+        for segment in list(self._segments.values()):
+            segment.release()
+        if self._ready is not None:
+            self._ready.close()
+
+
+class ManagerChannel(Channel):
+    """ Channel using a proxied queue.Queue of a SyncManager """
+
+    def __init__(self, queue):
+        super().__init__()
+        self._queue = queue
+
+    def _put(self, obj):
+        if self._serializer is not None:
+            obj = [bytes(frame) for frame in self._serializer.dumps(obj)]
+        self._queue.put(obj)
+
+    def _get(self, block, timeout):
+        obj = self._queue.get(block, timeout)
+        if self._serializer is None:
+            return obj
+        frames = iter(obj[1:])
+        buffers = []
+        for target in self._serializer.buffers(obj[0]):
+            frame = next(frames)
+            if target is not None:
+                target[:] = frame
+                frame = target
+            buffers.append(frame)
+        return self._serializer.loads(obj[0], buffers)
+
+
+class PipeChannel(Channel):
+    """
+    Channel using a unidirectional multiprocessing.Pipe. Writers are
+    serialized with a process shared lock, so the channel can be used by the
+    PluginManager and the plugin process at the same time.
+    Channels with 'single_writer' set have no lock and can be pickled to
+    already running processes. Only the end used by the plugin process is
+    pickled: the writing end, or the reading end for 'reverse' channels
+    which send from the PluginManager to the plugin.
+    'ctx' is the multiprocessing context the plugin processes are started
+    with.
+    """
+
+    def __init__(self, single_writer=False, reverse=False, ctx=None):
+        super().__init__()
+        ctx = ctx or multiprocessing.get_context()
+        self._reader, self._writer = ctx.Pipe(duplex=False)
+        self._reverse = reverse
+        self._ctx = ctx
+        self._wlock = None
+        if not single_writer:
+            self._wlock = ctx.Lock()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop("_ctx", None)
+        if self._reverse:
+            state["_writer"] = None
+            state["_wlock"] = None
+        else:
+            state["_reader"] = None
+        return state
+
+    def _put(self, obj):
+        if self._serializer is not None:
+            obj = self._serializer.dumps(obj)
+        if self._wlock is None:
+            self._send(obj)
+            return
+        with self._wlock:
+            self._send(obj)
+
+    def _send(self, obj):
+        """ Writes a transfer, the frames of a serializer one by one """
+        if self._serializer is None:
+            self._writer.send(obj)
+            return
+        for frame in obj:
+            self._writer.send_bytes(frame)
+
+    def _get(self, block, timeout):
+        if not self._reader.poll(timeout if block else 0):
+            raise Empty
+        return self._recv()
+
+    def _recv(self):
+        """ Reads a transfer, the buffer frames of a serializer into the
+        buffers it provides """
+        if self._serializer is None:
+            return self._reader.recv()
+        header = self._reader.recv_bytes()
+        buffers = []
+        for target in self._serializer.buffers(header):
+            if target is None:
+                buffers.append(self._reader.recv_bytes())
+            else:
+                self._reader.recv_bytes_into(target)
+                buffers.append(target)
+        return self._serializer.loads(header, buffers)
+
+    def source(self):
+        return self._reader
+
+    def reset_writer(self):
+        """ Replaces the write lock, a killed writer may still hold it """
+        if self._wlock is not None:
+            self._wlock = self._ctx.Lock()
+
+    def close(self):
+        self._writer.close()
+        super().close()
+        self._reader.close()
+
+
+class Wakeup:
+    """
+    Non-blocking self-pipe used to interrupt
+    multiprocessing.connection.wait. set() never blocks, clear() drains all
+    pending wakeups.
+    """
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        os.set_blocking(self._r, False)
+        os.set_blocking(self._w, False)
+
+    def fileno(self):
+        return self._r
+
+    def set(self):
+        """ Makes the wakeup readable """
+        if self._w is None:
+            return
+        try:
+            os.write(self._w, b"\0")
+        except (BlockingIOError, OSError):
+            pass                    # pipe full or closed, already readable
+
+    def clear(self):
+        """ Drains the pipe """
+        if self._r is None:
+            return
+        try:
+            while os.read(self._r, 4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        if self._r is not None:
+            os.close(self._r)
+            os.close(self._w)
+            self._r = self._w = None
+
+
+class Transport:
+    """ Factory for the Channels of all plugins of a PluginManager. 'ctx'
+    is the multiprocessing context used for the plugin processes, None is
+    the default context. """
+
+    def __init__(self, ctx=None):
+        self._ctx = ctx or multiprocessing.get_context()
+
+    def channel(self, single_writer=False, reverse=False):
+        """ Returns a new Channel for a plugin run. If 'single_writer' is
+        set, only one process writes to the channel and it has to be
+        picklable to already running processes. 'reverse' channels are
+        written by the PluginManager and read by the plugin. """
+        raise NotImplementedError
+
+    def shutdown(self):
+        """ Frees all resources held by the transport """
+        pass
+
+
+class ManagerTransport(Transport):
+    """
+    Transport creating all queues in one SyncManager. The manager server
+    process is started with the first channel and shared by all plugins.
+    """
+
+    def __init__(self, ctx=None):
+        super().__init__(ctx)
+        self._manager = None
+        self._lock = threading.Lock()
+
+    def channel(self, single_writer=False, reverse=False):
+        with self._lock:
+            if self._manager is None:
+                self._manager = self._ctx.Manager()
+            return ManagerChannel(self._manager.Queue())
+
+    def shutdown(self):
+        with self._lock:
+            if self._manager is not None:
+                self._manager.shutdown()
+                self._manager = None
+
+
+class PipeTransport(Transport):
+    """ Transport creating a native PipeChannel for every plugin run """
+
+    def channel(self, single_writer=False, reverse=False):
+        return PipeChannel(single_writer, reverse, self._ctx)
+
+
+TRANSPORTS = {"pipe": PipeTransport,
+              "manager": ManagerTransport}
+
+
+def get_transport(transport, ctx=None):
+    """ Returns a Transport object. 'transport' is either an instance of
+    'Transport' or the name of one of the backends in TRANSPORTS, which is
+    created for the multiprocessing context 'ctx'. """
+    if isinstance(transport, Transport):
+        return transport
+    if transport in TRANSPORTS:
+        return TRANSPORTS[transport](ctx)
+    raise ValueError("Transport '" + str(transport) + "' is not defined")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,309 @@
+#!/bin/env python3
+"""
+$LICENSE
+
+Pool of pre-forked worker processes executing plugin runs.
+The PluginManager initializes the plugin object as usual and hands it to
+an idle worker, which loads the plugin module once and calls run(). Workers
+are reused for many runs and recycled after 'max_tasks' runs.
+
+$VERSION
+
+"""
+
+import atexit
+import multiprocessing
+import os
+import pickle
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from multiprocessing.connection import wait
+from multiprocessing.reduction import ForkingPickler
+from mpps.discovery import load_module
+from mpps.transport import Wakeup
+
+
+def _load_module(name, path):
+    """ Imports the plugin module at path under name, once per worker. A
+    module whose sources changed is imported again while unpickling the
+    plugin. """
+    if name in sys.modules:
+        return sys.modules[name]
+    return load_module(name, path)
+
+
+def _worker_main(conn, max_tasks):
+    """ Main loop of a worker process """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # a stop request arriving after the run finished must not end the worker
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    tasks = 0
+    while max_tasks is None or tasks < max_tasks:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        name, path, payload = task
+        exitcode = 0
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            _load_module(name, path)
+            p = pickle.loads(payload)
+            p._main()
+        except Exception:
+            traceback.print_exc()
+            exitcode = 1
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        p = None
+        tasks += 1
+        conn.send(exitcode)
+
+
+class PooledProcess:
+    """
+    Handle of a plugin run executed by a WorkerPool. Provides the subset
+    of the multiprocessing.Process interface used by the PluginManager.
+    'sentinel' becomes readable when the run is finished.
+    """
+
+    def __init__(self, pool, name, task):
+        self._pool = pool
+        self._task = task
+        self._done_r, self._done_w = os.pipe()
+        self._finished = threading.Event()
+        self._killed = None         # worker process terminated for the run
+        self.name = name
+        self.exitcode = None
+        self.pid = None
+
+    @property
+    def sentinel(self):
+        return self._done_r
+
+    def is_alive(self):
+        return not self._finished.is_set()
+
+    def join(self, timeout=None):
+        """ Waits until the run is finished and, if it was terminated,
+        until the worker process exited """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        if not self._finished.wait(timeout) or self._killed is None:
+            return
+        if deadline is not None:
+            timeout = max(0, deadline - time.monotonic())
+        try:
+            wait([self._killed.sentinel], timeout)
+        except (OSError, ValueError):
+            pass                        # worker already closed
+
+    def terminate(self):
+        """ Ends the run. The worker executing it is terminated, the run
+        ends when the worker exits or its plugin handled SIGTERM. """
+        self._pool._terminate(self, signal.SIGTERM)
+
+    def kill(self):
+        self._pool._terminate(self, signal.SIGKILL)
+
+    def interrupt(self):
+        """ Sends SIGTERM to the worker executing the run, which asks the
+        plugin to stop. The run ends as usual and the worker is reused. """
+        self._pool._interrupt(self)
+
+    def _finish(self, exitcode):
+        if self._finished.is_set():
+            return
+        self.exitcode = exitcode
+        self._finished.set()
+        os.write(self._done_w, b"\0")
+
+    def __del__(self):
+        if self._done_r is not None:
+            os.close(self._done_r)
+            os.close(self._done_w)
+            self._done_r = self._done_w = None
+
+
+class _Worker:
+    """ Parent side of a worker process """
+
+    def __init__(self, max_tasks, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(child_conn, max_tasks), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.run = None
+        self.tasks = 0
+        self.killed = False
+
+
+class WorkerPool:
+    """
+    Pre-forked worker processes for plugin runs.
+    - size is the number of worker processes
+    - max_tasks is the number of runs after which a worker is replaced by a
+    fresh process. None means unlimited.
+    - ctx is the multiprocessing context used to start the workers
+    Runs are queued if all workers are busy.
+    """
+
+    def __init__(self, size, max_tasks=None, ctx=None):
+        if size < 1:
+            raise ValueError("Pool size has to be at least 1")
+        self._size = size
+        self._max_tasks = max_tasks
+        self._ctx = ctx or multiprocessing.get_context()
+        self._lock = threading.Lock()
+        self._wakeup = Wakeup()
+        self._backlog = []
+        self._closed = False
+        self._workers = [_Worker(max_tasks, self._ctx)
+                         for i in range(size)]
+        self._monitor = threading.Thread(target=self._monitor_main,
+                                         daemon=True)
+        self._monitor.start()
+        # the monitor thread must end before daemon threads are frozen
+        atexit.register(self.close)
+
+    def run(self, name, path, plugin):
+        """
+        Executes plugin._main() in a worker. 'name' and 'path' identify the
+        plugin module which has to be imported to unpickle 'plugin'.
+        Returns a PooledProcess handle.
+        """
+        payload = bytes(ForkingPickler.dumps(plugin))
+        run = PooledProcess(self, name, (name, path, payload))
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Worker pool is closed")
+            self._backlog.append(run)
+            self._dispatch()
+        return run
+
+    def _dispatch(self):
+        """ Hands queued runs to idle workers. Requires self._lock. """
+        for worker in self._workers:
+            if not self._backlog:
+                return
+            if worker.run is None and not worker.killed and \
+               worker.process.is_alive() and \
+               (self._max_tasks is None or worker.tasks < self._max_tasks):
+                run = self._backlog.pop(0)
+                try:
+                    worker.conn.send(run._task)
+                except OSError:
+                    self._backlog.insert(0, run)
+                    continue
+                run._task = None
+                run.pid = worker.process.pid
+                worker.run = run
+                worker.tasks += 1
+
+    def _terminate(self, run, sig):
+        with self._lock:
+            if run in self._backlog:
+                self._backlog.remove(run)
+                run._finish(-sig)
+                return
+            for worker in self._workers:
+                if worker.run is not run:
+                    continue
+                # the worker is replaced by the monitor thread
+                os.kill(worker.process.pid, sig)
+                run._killed = worker.process
+                if not worker.killed:
+                    worker.killed = True
+                    try:
+                        # ends a worker whose plugin handles SIGTERM, its
+                        # run is finished when it reports the exit code
+                        worker.conn.send(None)
+                    except OSError:
+                        pass
+                if sig == signal.SIGKILL:
+                    worker.run = None
+                    run._finish(-sig)
+
+    def _interrupt(self, run):
+        with self._lock:
+            if run in self._backlog:
+                self._backlog.remove(run)
+                run._finish(-signal.SIGTERM)
+                return
+            for worker in self._workers:
+                if worker.run is run:
+                    os.kill(worker.process.pid, signal.SIGTERM)
+
+    def _monitor_main(self):
+        """ Collects finished runs, replaces ended workers and dispatches
+        queued runs """
+        while True:
+            with self._lock:
+                if self._closed:
+                    break
+                workers = list(self._workers)
+            waitables = [self._wakeup]
+            for worker in workers:
+                waitables.append(worker.conn)
+                waitables.append(worker.process.sentinel)
+            ready = wait(waitables, None)
+            with self._lock:
+                if self._wakeup in ready:
+                    self._wakeup.clear()
+                for i, worker in enumerate(self._workers):
+                    if worker.conn in ready:
+                        try:
+                            exitcode = worker.conn.recv()
+                        except (EOFError, OSError):
+                            exitcode = None
+                        if worker.run is not None and exitcode is not None:
+                            worker.run._finish(exitcode)
+                            worker.run = None
+                    if worker.process.sentinel in ready or \
+                       not worker.process.is_alive():
+                        worker.process.join()
+                        if worker.run is not None:
+                            worker.run._finish(worker.process.exitcode)
+                        worker.conn.close()
+                        if not self._closed:
+                            self._workers[i] = _Worker(self._max_tasks,
+                                                       self._ctx)
+                self._dispatch()
+
+    def close(self):
+        """ Ends all workers. Queued runs are dropped, running runs are
+        terminated. """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for run in self._backlog:
+                run._finish(-signal.SIGTERM)
+            self._backlog = []
+            for worker in self._workers:
+                if worker.run is not None:
+                    worker.process.terminate()
+                    worker.run._finish(-signal.SIGTERM)
+                    worker.run = None
+                try:
+                    worker.conn.send(None)
+                except OSError:
+                    pass
+        atexit.unregister(self.close)
+        self._wakeup.set()
+        self._monitor.join()
+        for worker in self._workers:
+            worker.process.join()
+            worker.conn.close()
+        self._wakeup.close()
+
+
+if __name__ == "__main__":
+    pass